@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+""" Generate a synthetic repository with FHIR resources, to benchmark the QA tooling on.
+
+    The repository mimics the layout of a real profiling repository: profiles, terminology resources and examples in
+    nested directories, in both XML and JSON, with a qa.yaml file with overlapping patterns. It's a git repository
+    where a work branch has changed some files compared to the main branch, and where some new files haven't been
+    committed yet, so all file selection modes have something to do.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+
+FHIR_NS = "http://hl7.org/fhir"
+
+# The kinds of resources to generate, with their relative frequency, the directory they go in and their file name
+# prefix.
+KINDS = [
+    ("StructureDefinition", 2, "profiles",    "zib-"),
+    ("ValueSet",            1, "terminology", "valueset-"),
+    ("CodeSystem",          1, "terminology", "codesystem-"),
+    ("Patient",             3, "examples",    "patient-"),
+    ("Observation",         5, "examples",    "observation-")
+]
+
+QA_YAML = """main branch: main
+
+patterns:
+  profiles: resources/**/zib-*.xml
+  terminology:
+  - resources/**/valueset-*.*
+  - resources/**/codesystem-*.*
+  examples: resources/**/*.xml
+  json examples: resources/**/*.json
+  rest: resources/**/*
+
+steps:
+  validate profiles:
+    patterns: profiles
+    profile: http://nictiz.nl/fhir/StructureDefinition/ProfilingGuidelinesR4-StructureDefinitions-Zib-Profiles
+  validate terminology:
+    patterns: terminology
+  validate examples:
+    patterns:
+    - examples
+    - json examples
+"""
+
+def makeResource(resource_type, resource_id, size, rng):
+    """ Return a resource as a dict of its elements. The size determines the number of repeated elements, so that
+        there's a realistic spread in file sizes. """
+    resource = {"resourceType": resource_type, "id": resource_id}
+    if resource_type in ("StructureDefinition", "ValueSet", "CodeSystem"):
+        resource["url"] = f"http://example.org/fhir/{resource_type}/{resource_id}"
+        resource["status"] = "draft"
+    if resource_type == "StructureDefinition":
+        resource["kind"] = "resource"
+        resource["type"] = "Patient"
+        resource["baseDefinition"] = "http://hl7.org/fhir/StructureDefinition/Patient"
+        resource["differential"] = {"element": [{"id": f"Patient.extension:ext{i}", "path": "Patient.extension", "short": "x" * rng.randint(10, 80)} for i in range(size)]}
+    elif resource_type == "ValueSet":
+        resource["compose"] = {"include": [{"system": "http://snomed.info/sct", "concept": [{"code": str(100000 + i), "display": f"Concept {i}"} for i in range(size)]}]}
+    elif resource_type == "CodeSystem":
+        resource["content"] = "complete"
+        resource["concept"] = [{"code": f"c{i}", "display": f"Concept {i}"} for i in range(size)]
+    elif resource_type == "Patient":
+        resource["meta"] = {"profile": ["http://example.org/fhir/StructureDefinition/zib-Patient"]}
+        resource["name"] = [{"family": f"Family{i}", "given": ["Given"]} for i in range(max(1, size // 10))]
+    else:
+        resource["status"] = "final"
+        resource["component"] = [{"code": {"text": f"Component {i}"}, "valueString": "y" * rng.randint(5, 40)} for i in range(size)]
+    return resource
+
+def toXml(value, name, indent = ""):
+    """ Render a (simplified) FHIR JSON structure as FHIR XML. """
+    if isinstance(value, list):
+        return "".join([toXml(item, name, indent) for item in value])
+    if isinstance(value, dict):
+        children = "".join([toXml(child, key, indent + "  ") for key, child in value.items() if key != "resourceType"])
+        return f"{indent}<{name}>\n{children}{indent}</{name}>\n"
+    return f'{indent}<{name} value="{value}"/>\n'
+
+def writeResource(path, resource):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, "w") as f:
+        if path.endswith(".json"):
+            json.dump(resource, f, indent = 2)
+        else:
+            children = "".join([toXml(child, key, "  ") for key, child in resource.items() if key != "resourceType"])
+            f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<{resource["resourceType"]} xmlns="{FHIR_NS}">\n{children}</{resource["resourceType"]}>\n')
+
+def generate(repo_dir, num_files, seed = 1, json_ratio = 0.3, depth = 3, changed_ratio = 0.05, mismatch_ratio = 0.01):
+    """ Generate a repository with num_files resources in repo_dir. Returns the list of generated paths, relative to
+        the repository. """
+    rng = random.Random(seed)
+    os.makedirs(repo_dir, exist_ok = True)
+    with open(os.path.join(repo_dir, "qa.yaml"), "w") as f:
+        f.write(QA_YAML)
+
+    weights = [kind[1] for kind in KINDS]
+    paths   = []
+    for i in range(num_files):
+        resource_type, _, area, prefix = rng.choices(KINDS, weights)[0]
+        # Spread the files over nested directories, like resources/examples/d3/d1/patient-123.xml
+        sub_dirs = [f"d{rng.randint(0, 9)}" for _ in range(rng.randint(0, depth))]
+        resource_id = f"{prefix}{i}"[:64].rstrip("-")
+        extension = ".json" if rng.random() < json_ratio else ".xml"
+        path = "/".join(["resources", area] + sub_dirs + [resource_id + extension])
+        if rng.random() < mismatch_ratio: # Some resources have an id that doesn't match the file name
+            resource_id += "-mismatch"
+        size = int(rng.paretovariate(1.5) * 5) # Most files are small, some are huge
+        writeResource(os.path.join(repo_dir, path), makeResource(resource_type, resource_id, min(size, 5000), rng))
+        paths.append(path)
+
+    git = ["git", "-c", "user.name=Benchmark", "-c", "user.email=benchmark@example.org", "-c", "init.defaultBranch=main"]
+    subprocess.run(git + ["init", "-q"], cwd = repo_dir, check = True)
+    subprocess.run(git + ["add", "-A"], cwd = repo_dir, check = True)
+    subprocess.run(git + ["commit", "-q", "-m", "Initial version"], cwd = repo_dir, check = True)
+    subprocess.run(git + ["checkout", "-q", "-b", "work"], cwd = repo_dir, check = True)
+
+    # Change some files on the work branch, some committed and some not, and add some new ones
+    changed = rng.sample(paths, int(len(paths) * changed_ratio))
+    for j, path in enumerate(changed):
+        with open(os.path.join(repo_dir, path), "a") as f:
+            f.write("\n")
+        if j == len(changed) // 2:
+            subprocess.run(git + ["commit", "-q", "-a", "-m", "Change some files"], cwd = repo_dir, check = True)
+    for j in range(max(1, len(changed) // 5)):
+        path = f"resources/examples/new/observation-new-{j}.xml"
+        writeResource(os.path.join(repo_dir, path), makeResource("Observation", f"observation-new-{j}", 5, rng))
+        paths.append(path)
+    return paths
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Generate a synthetic FHIR repository for benchmarking.")
+    parser.add_argument("repo_dir", help = "The directory to create the repository in.")
+    parser.add_argument("--files", type = int, default = 1000, help = "The number of resources to generate.")
+    parser.add_argument("--seed", type = int, default = 1, help = "The seed for the random generator.")
+    parser.add_argument("--json-ratio", type = float, default = 0.3, help = "The fraction of resources in JSON format.")
+    parser.add_argument("--depth", type = int, default = 3, help = "The maximum directory nesting below each area.")
+    args = parser.parse_args()
+    paths = generate(args.repo_dir, args.files, args.seed, args.json_ratio, args.depth)
+    print(f"Generated {len(paths)} resources in {args.repo_dir}")
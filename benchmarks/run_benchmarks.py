@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+""" Benchmarks for the QA tooling, run on synthetic repositories (see generate_repo.py).
+
+    The following is measured for each repository size:
+    - resolve/<mode>:         resolving the qa.yaml patterns using FileCollection in each mode, walking the repo
+    - resolve-indexed/<mode>: the same, using an up-to-date FileIndex
+    - builtin/check-id:       the builtin resource id check over all files
+    - output/printer:         writing lines of colored output through the Printer into a RunLog
+    - e2e/batch:              a full batch run using a stub Validator (see stub_validator.py)
+    - e2e/batch-cached:       the same run again, with the result cache filled
+
+    Everything runs offline: the Validator is replaced by a stub, and terminology checking is disabled. The results
+    are written as JSON. When a baseline (an earlier result file) is given, every benchmark that got slower than the
+    tolerance allows is reported, and the exit status is non-zero.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import entrypoint
+import generate_repo
+import yaml
+
+FORMAT_VERSION = 1
+
+class NullPrinter:
+    """ Printer that discards all output, so the benchmarks only measure the work itself. """
+
+    write_github = False
+
+    async def writeLine(self, message):
+        pass
+
+    async def write(self, message):
+        pass
+
+def measure(function, repeats):
+    """ Call the function repeats times and return the fastest and the median duration in seconds. """
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return min(durations), statistics.median(durations)
+
+def benchmarkResolve(repo_dir, repeats):
+    results = {}
+    with open(os.path.join(repo_dir, "qa.yaml")) as f:
+        config = yaml.safe_load(f)
+    modes = [(entrypoint.FileCollection.Mode.ALL, None), (entrypoint.FileCollection.Mode.FILTERED, ["zib", "valueset"]), (entrypoint.FileCollection.Mode.CHANGED, None)]
+    for indexed in (False, True):
+        file_collection = entrypoint.FileCollection(config)
+        if indexed:
+            file_collection.setIndex(entrypoint.FileIndex(file_collection))
+        for mode, filters in modes:
+            file_collection.setMode(mode, filters)
+            fastest, median = measure(file_collection.resolve, repeats)
+            name = f"{'resolve-indexed' if indexed else 'resolve'}/{mode.name}"
+            results[name] = {"seconds": fastest, "median": median, "files": sum([len(files) for files in file_collection.values()])}
+    return results
+
+def benchmarkBuiltinCheck(files, repeats):
+    check = entrypoint.BuiltinCheck.REGISTRY["check-id"]()
+    fastest, median = measure(lambda: asyncio.run(check.run(files, NullPrinter())), repeats)
+    return {"builtin/check-id": {"seconds": fastest, "median": median, "files": len(files)}}
+
+def benchmarkOutput(num_lines, repeats):
+    lines = [f"\033[1;37mresources/examples/observation-{i}.xml\033[0m\n  \033[0;33mWarning\033[0m @ Observation.code: message {i}" for i in range(num_lines)]
+    async def writeAll():
+        printer = entrypoint.Printer()
+        printer.BATCH_INTERVAL = 0 # Don't measure the time the Printer waits for output to accumulate
+        printer.setRunLog(entrypoint.RunLog())
+        for line in lines:
+            await printer.writeLine(line)
+        await printer.flush()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        fastest, median = measure(lambda: asyncio.run(writeAll()), repeats)
+    return {"output/printer": {"seconds": fastest, "median": median, "lines": num_lines}}
+
+def benchmarkBatch(repo_dir, work_dir, repeats):
+    """ Run the tool in batch mode as a separate process, with the stub Validator in place of java. """
+    bin_dir = os.path.join(work_dir, "bin")
+    os.makedirs(bin_dir, exist_ok = True)
+    java = os.path.join(bin_dir, "java")
+    shutil.copy(os.path.join(BENCHMARK_DIR, "stub_validator.py"), java)
+    os.chmod(java, 0o755)
+
+    env = dict(os.environ)
+    env["PATH"]              = bin_dir + os.pathsep + env["PATH"]
+    env["REPO_DIR"]          = repo_dir
+    env["USER_SCRIPT_DIR"]   = os.path.join(work_dir, "user_scripts")
+    env["CACHE_DIR"]         = os.path.join(work_dir, "cache")
+    env["GIT_CONFIG_GLOBAL"] = os.path.join(work_dir, "gitconfig")
+    command = [sys.executable, os.path.join(os.path.dirname(BENCHMARK_DIR), "entrypoint.py"), "--batch", "--no-tx",
+               "--validator-daemon=false", "--tx-cache=false", "--ig-cache=false"]
+
+    results = {}
+    for name, extra_args in [("e2e/batch", ["--no-cache"]), ("e2e/batch-cached", [])]:
+        if name == "e2e/batch-cached": # Fill the cache first
+            subprocess.run(command, env = env, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        fastest, median = measure(lambda: subprocess.run(command + extra_args, env = env, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL), repeats)
+        results[name] = {"seconds": fastest, "median": median}
+    return results
+
+def compare(results, baseline, tolerance):
+    """ Compare the results to the baseline. Returns a list of descriptions of the regressions. """
+    regressions = []
+    for key, result in results.items():
+        if key in baseline and baseline[key]["seconds"] > 0:
+            ratio = result["seconds"] / baseline[key]["seconds"]
+            if ratio > 1 + tolerance:
+                regressions.append(f"{key}: {baseline[key]['seconds']:.4f}s -> {result['seconds']:.4f}s ({ratio:.2f}x)")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the QA tooling on synthetic repositories.")
+    parser.add_argument("--sizes", default = "1000,10000", help = "Comma separated list of the numbers of resources in the generated repositories.")
+    parser.add_argument("--repeats", type = int, default = 3, help = "The number of times each benchmark is run; the fastest run counts.")
+    parser.add_argument("--output", default = "benchmark-results.json", help = "The file to write the results to.")
+    parser.add_argument("--baseline", help = "A result file of an earlier run to compare with.")
+    parser.add_argument("--tolerance", type = float, default = 0.25, help = "The fraction a benchmark may be slower than the baseline.")
+    parser.add_argument("--skip-e2e", action = "store_true", help = "Skip the end-to-end batch runs.")
+    parser.add_argument("--work-dir", help = "The directory to generate the repositories in (a temporary directory by default).")
+    args = parser.parse_args()
+
+    work_root = args.work_dir if args.work_dir else tempfile.mkdtemp(prefix = "qa-benchmark-")
+    os.environ["GIT_CONFIG_GLOBAL"] = os.path.join(work_root, "gitconfig") # FileCollection adds to the git config
+    start_dir = os.getcwd()
+    results = {}
+    try:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            work_dir = os.path.join(work_root, str(size))
+            repo_dir = os.path.join(work_dir, "repo")
+            shutil.rmtree(work_dir, ignore_errors = True)
+            print(f"Generating a repository with {size} resources")
+            files = generate_repo.generate(repo_dir, size)
+
+            size_results = {}
+            os.chdir(repo_dir)
+            size_results.update(benchmarkResolve(repo_dir, args.repeats))
+            size_results.update(benchmarkBuiltinCheck(files, args.repeats))
+            size_results.update(benchmarkOutput(size, args.repeats))
+            os.chdir(start_dir)
+            if not args.skip_e2e:
+                size_results.update(benchmarkBatch(repo_dir, work_dir, args.repeats))
+
+            for name, result in size_results.items():
+                results[f"{name}@{size}"] = result
+                print(f"  {name:30} {result['seconds']:10.4f}s")
+    finally:
+        os.chdir(start_dir)
+        if not args.work_dir:
+            shutil.rmtree(work_root, ignore_errors = True)
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "format": FORMAT_VERSION,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "results": results
+        }, f, indent = 2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("format") != FORMAT_VERSION:
+            sys.exit(f"The baseline has format {baseline.get('format')}, expected {FORMAT_VERSION}")
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if len(regressions) > 0:
+            print("Regressions compared to the baseline:")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("No regressions compared to the baseline")
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+""" Stand-in for `java -jar validator.jar`, to benchmark the QA tooling without a JVM, a Validator or a terminology
+    server.
+
+    It accepts the Validator command line, and writes a Bundle of OperationOutcomes to the -output file like the
+    Validator does: an informational issue for each file, and a warning for some of them. The time the Validator
+    needs to start and to validate each file can be simulated using the STUB_STARTUP and STUB_COST_PER_FILE
+    environment variables (in seconds).
+"""
+
+import os
+import sys
+import time
+import zlib
+from xml.sax.saxutils import quoteattr
+
+# The options of the Validator that take a value
+OPTIONS_WITH_VALUE = set(["-jar", "-version", "-ig", "-profile", "-sct", "-tx", "-best-practice", "-output", "-server", "-txCache"])
+
+def main(args):
+    out_path = None
+    recurse  = False
+    inputs   = []
+    i = 0
+    while i < len(args):
+        if args[i] in OPTIONS_WITH_VALUE:
+            if args[i] == "-output":
+                out_path = args[i + 1]
+            i += 2
+            continue
+        if args[i] == "-recurse":
+            recurse = True
+        elif not args[i].startswith("-"):
+            inputs.append(args[i])
+        i += 1
+
+    files = []
+    for path in inputs:
+        if os.path.isdir(path) and recurse:
+            for root, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                files += [os.path.join(root, file_name) for file_name in sorted(file_names) if file_name.endswith((".xml", ".json"))]
+        else:
+            files.append(path)
+
+    time.sleep(float(os.environ.get("STUB_STARTUP", "0")) + float(os.environ.get("STUB_COST_PER_FILE", "0")) * len(files))
+    if out_path == None:
+        return 0
+
+    with open(out_path, "w") as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n<Bundle xmlns="http://hl7.org/fhir"><type value="collection"/>')
+        for file_path in files:
+            out.write('<entry><resource><OperationOutcome>')
+            out.write(f'<extension url="http://hl7.org/fhir/StructureDefinition/operationoutcome-file"><valueString value={quoteattr(file_path)}/></extension>')
+            out.write(f'<issue><severity value="information"/><code value="informational"/><details><text value="All OK"/></details></issue>')
+            if zlib.crc32(file_path.encode("UTF-8")) % 10 == 0: # A stable selection of files gets a warning
+                out.write(f'<issue><severity value="warning"/><code value="business-rule"/><details><text value={quoteattr("Stub warning for " + file_path)}/></details><expression value="Resource.id"/></issue>')
+            out.write('</OperationOutcome></resource></entry>')
+        out.write('</Bundle>\n')
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -4,26 +4,52 @@ import aiohttp
 from aiohttp import web
 import argparse
 import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextvars
+import copy
 import enum
+import errno
 import fnmatch
 import glob
+import hashlib
+import io
+import json
 import mimetypes
 import os
 import pathlib
 import re
 import requests
+import resource
+import shlex
 import shutil
+import signal
+import socket
+import sqlite3
 import stat
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
+import time
+import types
+import xml.etree.ElementTree as ET
 import yaml
+import zipfile
 
 REPO_DIR           = "/repo"
 TOOLS_DIR          = "/tools"
 USER_SCRIPT_DIR    = "/user_scripts"
-BUILTIN_SCRIPT_DIR = "/builtin_scripts"
 CONFIG_FILE        = "qa.yaml"
+VALIDATOR_JAR      = TOOLS_DIR + "/validator/validator.jar"
+CACHE_DIR          = "/cache"
+FHIR_PACKAGE_CACHE = os.path.expanduser("~/.fhir/packages")
+GITHUB_RUNNER_TEMP = "/github/runner_temp" # Where the temp dir of the runner is mounted in Docker container actions
+
+FHIR_NS = "http://hl7.org/fhir"
+ET.register_namespace("", FHIR_NS)
 
 class Printer:
     ''' Class to route and format output to the desired location '''
@@ -51,34 +77,46 @@ class Printer:
         }
     }
 
+    # All ANSI codes we're interested in: a color, or a reset
+    ANSI_CODES = re.compile("\x1b\\[(?:(0|1);3(.)|0)m")
+
+    # Output for the web interface is collected and added to the run log in batches, at most once per BATCH_INTERVAL
+    # seconds
+    BATCH_INTERVAL = 0.1
+
     def __init__(self, write_github = False):
-        self.socket = None
+        self.run_log = None
         self.write_github = write_github
         os.environ["write_github"] = "1" if write_github else "0"
+
+        self.pending = []
+        self.sender  = None
     
-    def setSocket(self, socket):
-        ''' Set a web socket to send the output to. '''
-        self.socket = socket
+    def setRunLog(self, run_log):
+        ''' Set a RunLog to record the output in, so it can be followed using the web interface. '''
+        self.run_log = run_log
 
     async def writeLine(self, message):
-        """ Write a line to the terminal. If a web socket is set and available for writing, the output will be echoed
-            there as well. """
+        """ Write a line to the terminal. If a run log is set, the output will be recorded there as well. """
         await self.write(message + "\n")
 
     async def write(self, message):
-        """ Write out the output to the terminal. If a web socket is set and available for writing, the output will be
-            echoed there as well. """
+        """ Write out the output to the terminal. If a run log is set, the output will be recorded there as well. """
         print(message, end = '')
 
-        if self.socket != None and not self.socket.closed:
+        if self.run_log != None:
             # Set the message to "terminal colors" (lightgrey on black). Rewrite all ANSI color codes to HTML tags.
-            html_msg = re.sub('\x1b\[(0|1);3(.)m', self._ansiToHTML, message)
-            html_msg = re.sub('\x1b\[0m', "</span><span style='color: lightgrey'>", html_msg)
+            html_msg = self.ANSI_CODES.sub(self._ansiToHTML, message)
             html_msg = f"<span style='color: lightgrey;'>{html_msg}</span>"
 
-            await self.socket.send_json({
-                "output": html_msg
-            })
+            self.pending.append(html_msg)
+            if self.sender == None or self.sender.done():
+                self.sender = asyncio.create_task(self._sendPending())
+
+    async def flush(self):
+        """ Wait until all output has been added to the run log. """
+        if self.sender != None:
+            await self.sender
 
     def writeGithubOutput(self, key, value):
         """ Set an output value when executed on Github. """
@@ -96,6 +134,8 @@ class Printer:
 
     def _ansiToHTML(self, match_obj):
         ''' Helper method to rewrite an ASNI color code to a HTML style tag. '''
+        if match_obj.group(1) == None:
+            return "</span><span style='color: lightgrey'>"
         try:
             color = self.ANSI_TO_HTML[match_obj.group(1)][match_obj.group(2)]
         except KeyError:
@@ -103,6 +143,160 @@ class Printer:
         
         return f"</span><span style='color: {color}'>"
 
+    async def _sendPending(self):
+        """ Add the pending output to the run log after giving it some time to accumulate. """
+        await asyncio.sleep(self.BATCH_INTERVAL)
+        batch, self.pending = self.pending, []
+        if self.run_log != None:
+            self.run_log.append("".join(batch))
+
+class BufferedPrinter:
+    """ Stand-in for a Printer that holds back all output until it's released. This way, the output of concurrently
+        running steps can be printed in a fixed order. After release, output is passed on to the Printer directly. """
+
+    def __init__(self, printer):
+        self.printer      = printer
+        self.write_github = printer.write_github
+        self.buffer       = []
+        self.live         = False
+
+    async def release(self):
+        """ Send out all output held back so far, and pass on any further output directly. """
+        # Output might be added while we're flushing, which will then be handled in the same loop
+        while len(self.buffer) > 0:
+            method, args = self.buffer.pop(0)
+            result = method(*args)
+            if asyncio.iscoroutine(result):
+                await result
+        self.live = True
+
+    async def writeLine(self, message):
+        await self.write(message + "\n")
+
+    async def write(self, message):
+        if self.live:
+            await self.printer.write(message)
+        else:
+            self.buffer.append((self.printer.write, [message]))
+
+    def writeGithubOutput(self, key, value):
+        self._call(self.printer.writeGithubOutput, key, value)
+
+    def startGithubGroup(self, title):
+        self._call(self.printer.startGithubGroup, title)
+
+    def endGithubGroup(self):
+        self._call(self.printer.endGithubGroup)
+
+    def _call(self, method, *args):
+        if self.live:
+            method(*args)
+        else:
+            self.buffer.append((method, args))
+
+class Tracer:
+    """ Lightweight instrumentation of the phases of a run.
+
+        Phases are timed using spans, which also record the CPU time and peak memory of the subprocesses that ended
+        while the span was open (as far as the operating system reports them, which is only accurate when nothing else
+        runs concurrently). Additionally, counters can be kept for things like the number of files. Only a bounded
+        number of spans is kept; the totals per span name are kept for the whole lifetime of the process. The trace can
+        be written as JSON and the totals can be exposed in the Prometheus text format.
+    """
+
+    MAX_SPANS = 10000
+
+    class Span:
+        def __init__(self, tracer, name, attributes):
+            self.tracer     = tracer
+            self.name       = name
+            self.attributes = attributes
+
+        def set(self, key, value):
+            self.attributes[key] = value
+
+        def __enter__(self):
+            self.start    = time.time()
+            self.children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            duration = time.time() - self.start
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = (children.ru_utime + children.ru_stime) - (self.children.ru_utime + self.children.ru_stime)
+            if exc_type != None:
+                self.attributes["error"] = exc_type.__name__
+            self.tracer._finish(self, duration, cpu, children.ru_maxrss * 1024)
+            return False
+
+    def __init__(self):
+        self.origin   = time.time()
+        self.spans    = collections.deque(maxlen = self.MAX_SPANS)
+        self.totals   = {} # Span name -> [count, seconds, subprocess CPU seconds]
+        self.counters = {} # (name, tuple of label items) -> value
+        self.max_rss  = 0  # The peak memory of the largest subprocess so far, in bytes
+
+    def span(self, name, **attributes):
+        """ Return a context manager that times the code it encloses. """
+        return Tracer.Span(self, name, attributes)
+
+    def count(self, name, value = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def writeTrace(self, path):
+        """ Write all spans and counters as JSON. """
+        trace = {
+            "start":    self.origin,
+            "spans":    list(self.spans),
+            "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self.counters.items()],
+            "subprocess_max_rss": self.max_rss
+        }
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(trace, f, indent = 1)
+        os.replace(tmp_path, path)
+
+    def formatMetrics(self):
+        """ Return the totals in the Prometheus text format. """
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        lines = [
+            "# TYPE qa_span_count counter",
+            "# TYPE qa_span_seconds counter",
+            "# TYPE qa_span_subprocess_cpu_seconds counter"
+        ]
+        for name, (count, seconds, cpu) in sorted(self.totals.items()):
+            lines.append(f'qa_span_count{{span="{escape(name)}"}} {count}')
+            lines.append(f'qa_span_seconds{{span="{escape(name)}"}} {seconds:.6f}')
+            lines.append(f'qa_span_subprocess_cpu_seconds{{span="{escape(name)}"}} {cpu:.6f}')
+        names = sorted(set([name for name, _ in self.counters]))
+        for name in names:
+            lines.append(f"# TYPE qa_{name} counter")
+            for (counter_name, labels), value in self.counters.items():
+                if counter_name == name:
+                    label_text = ",".join([f'{key}="{escape(label)}"' for key, label in labels])
+                    lines.append(f"qa_{name}{{{label_text}}} {value}" if label_text else f"qa_{name} {value}")
+        lines.append("# TYPE qa_subprocess_max_rss_bytes gauge")
+        lines.append(f"qa_subprocess_max_rss_bytes {self.max_rss}")
+        return "\n".join(lines) + "\n"
+
+    def _finish(self, span, duration, cpu, max_rss):
+        entry = {"name": span.name, "start": round(span.start - self.origin, 6), "duration": round(duration, 6)}
+        if cpu > 0:
+            entry["subprocess_cpu"] = round(cpu, 6)
+        if span.attributes:
+            entry["attributes"] = span.attributes
+        self.spans.append(entry)
+
+        totals = self.totals.setdefault(span.name, [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += duration
+        totals[2] += cpu
+        self.max_rss = max(self.max_rss, max_rss)
+
+TRACER = Tracer()
+
 class FileCollection(dict):
     """ Class to select the relevant files per step, as specified using the patterns in the qa.yaml file.
 
@@ -132,7 +326,10 @@ class FileCollection(dict):
         else:
             self.main_branch = "origin/main"
 
+        self.index        = None
+        self.dependencies = None
         self.setMode(mode)
+        self._compilePatterns()
 
         # As a safety precaution, git refuses to work in directory's not owned by the current user, unless it's
         # explicitly told that the repo can be trusted. Since we're running in a container, we assume that it's safe
@@ -149,31 +346,263 @@ class FileCollection(dict):
 
         # Internally, filters are converted to globs by appending and prepending a "*" to them. When no actual
         # filtering needs to be done, we set our globbing patterns simply to a catch-all wildcard.
-        if self.mode == FileCollection.Mode.ALL or (self.mode == FileCollection.Mode.FILTERED and file_name_filters == None):
-            self.file_name_globs = ["*"]
-        elif self.mode == FileCollection.Mode.FILTERED:
+        if self.mode == FileCollection.Mode.FILTERED and file_name_filters != None:
             self.file_name_globs = [f"*{filter.strip()}*" for filter in file_name_filters]
+        else:
+            self.file_name_globs = ["*"]
+        self.file_name_regex = re.compile("|".join([fnmatch.translate(fn_glob) for fn_glob in self.file_name_globs]))
    
-    def resolve(self):
+    def setDependencyIndex(self, dependencies):
+        """ Use a DependencyIndex to extend the changed files with the files that depend on them in CHANGED mode. """
+        self.dependencies = dependencies
+
+    def setIndex(self, index):
+        """ Use a FileIndex to resolve the patterns, rather than inspecting the file system on each call. """
+        self.index = index
+
+    def resolve(self, refresh = True):
+        """ Resolve the patterns to the files in the repo, according to the current mode. When a FileIndex is used,
+            the index is brought up to date first, unless refresh is False, in which case the answer is given from
+            the index as it is. """
         # Reset all file lists
         for pattern_name in self.keys():
             self[pattern_name] = []
 
+        if self.index != None:
+            if refresh:
+                self.index.refresh()
+            if self.mode == FileCollection.Mode.CHANGED:
+                changed_files = self.index.getChangedFiles()
+            check_name = self.mode == FileCollection.Mode.FILTERED
+            for path, pattern_name in self.index.getAssignments():
+                if self.mode == FileCollection.Mode.CHANGED:
+                    if path not in changed_files:
+                        continue
+                elif check_name and not self.file_name_regex.match(path.rsplit("/", 1)[-1]):
+                    continue
+                self[pattern_name].append(path)
+            return
+
+        if self.matchers == None:
+            # Some patterns can't be matched while walking the repo, so use the slow path of globbing each pattern
+            self._resolveUsingGlob()
+            return
+
         if self.mode == FileCollection.Mode.CHANGED:
-            # If we're only interested in the files that are new or changed compared to the main branch, we first ask
-            # git for a list of all these files, committed or not
-            committed   = subprocess.run(["git", "diff", "--name-only", "--diff-filter=ACM", "--ignore-space-at-eol", self.main_branch], capture_output = True)
-            uncommitted = subprocess.run(["git", "ls-files", "--others"], capture_output = True)
-            if committed and uncommitted:
-                changed_files =  committed.stdout.decode("UTF-8").split("\n")
-                changed_files += uncommitted.stdout.decode("UTF-8").split("\n")
+            # If we're only interested in the files that are new or changed compared to the main branch, we only need
+            # to consider the files git reports (and the files that depend on them)
+            changed_files = self._getChangedFiles()
+            if self.dependencies != None:
+                changed_files = self.dependencies.expand(changed_files, [path for path, is_dir, link_depth in self._walk() if not is_dir and self.match(path, False, link_depth) != None])
+            candidates = [(file_path, False, -1) for file_path in changed_files if os.path.lexists(file_path)]
+        else:
+            candidates = self._walk()
+
+        # Each path is assigned to the first pattern that matches it, optionally filtered by the file name globs
+        check_name = self.mode == FileCollection.Mode.FILTERED
+        for path, is_dir, link_depth in candidates:
+            if check_name and not self.file_name_regex.match(path.rsplit("/", 1)[-1]):
+                continue
+            pattern_name = self.match(path, is_dir, link_depth)
+            if pattern_name != None:
+                self[pattern_name].append(path)
+
+    def match(self, path, is_dir = False, link_depth = -1):
+        """ Return the name of the first pattern that matches the path (relative to the repo root, in posix notation),
+            or None if no pattern matches. Like pathlib, a "**" doesn't descend into symlinked directories; link_depth
+            is the index of the deepest path component that is a symlinked directory (or -1 if there's none), so only
+            the patterns that reach that component without a "**" are considered. """
+        if self.matchers == None:
+            return None
+        if path == ".":
+            # Only a bare "**" matches the root of the repo itself
+            return self.root_matcher
+        if link_depth >= 0:
+            for i, (regex, dirs_only) in enumerate(self.regexes):
+                if self.prefixes[i][3] > link_depth and (is_dir or not dirs_only) and regex.fullmatch(path):
+                    return self.matchers[i]
+            return None
+        match = (self.dir_regex if is_dir else self.file_regex).fullmatch(path)
+        if match == None:
+            return None
+        return self.matchers[int(match.lastgroup[1:])]
+
+    def matchFile(self, path):
+        """ Return the name of the pattern that selects the file, either directly or through one of the directories
+            it's in (like "dir/**" does), or None if it isn't selected at all. A match on the file itself takes
+            precedence, then the nearest directory. """
+        pattern_name = self.match(path)
+        parent = path.rsplit("/", 1)[0] if "/" in path else None
+        while pattern_name == None and parent != None:
+            pattern_name = self.match(parent, True)
+            parent = parent.rsplit("/", 1)[0] if "/" in parent else None
+        return pattern_name
+
+    def _compilePatterns(self):
+        """ Compile all patterns, in order of priority, into a single regex (and a separate one for directories, as
+            patterns ending with "**" only match directories). This allows to find the first matching pattern for a
+            path in a single pass. If a pattern can't be compiled, self.matchers is set to None. """
+        self.matchers     = []
+        self.prefixes     = []
+        self.regexes      = []
+        self.root_matcher = None
+        file_regexes   = []
+        dir_regexes    = []
+        for pattern_name in self.patterns:
+            patterns = self.patterns[pattern_name]
+            # Each pattern name can be associated with multiple patterns, so make sure we always have a list
+            if type(patterns) == str:
+                patterns = [patterns]
+            for pattern in patterns:
+                compiled = self._translateGlob(pattern)
+                if compiled == None:
+                    self.matchers = None
+                    return
+                regex, dirs_only, prefix, recursive, depth = compiled
+                parts = pathlib.PurePosixPath(pattern).parts
+                if parts == ("**",) and self.root_matcher == None:
+                    self.root_matcher = pattern_name
+                group = f"(?P<p{len(self.matchers)}>{regex})"
+                if not dirs_only:
+                    file_regexes.append(group)
+                dir_regexes.append(group)
+                self.matchers.append(pattern_name)
+                self.prefixes.append((prefix, recursive, depth, parts.index("**") if "**" in parts else len(parts)))
+                self.regexes.append((re.compile(regex), dirs_only))
+
+        # An empty alternation would match the empty string, so use a regex that never matches in that case
+        self.file_regex = re.compile("|".join(file_regexes) if len(file_regexes) > 0 else "(?!)")
+        self.dir_regex  = re.compile("|".join(dir_regexes)  if len(dir_regexes)  > 0 else "(?!)")
+
+    @staticmethod
+    def _translateGlob(pattern):
+        """ Translate a glob pattern to a regex following the semantics of pathlib.Path.glob(). Returns a tuple of the
+            regex, whether it only matches directories, the literal leading path components, whether it may match
+            at any depth and the number of components. Returns None for patterns that can't be matched while walking
+            the repo (absolute paths or paths containing ".."). """
+        parts = pathlib.PurePosixPath(pattern).parts
+        if len(parts) == 0 or parts[0] == "/" or ".." in parts:
+            return None
+
+        regex     = ""
+        prefix    = []
+        literal   = True
+        dirs_only = False
+        for i, part in enumerate(parts):
+            if part == "**":
+                literal = False
+                if i == len(parts) - 1:
+                    # A trailing "**" matches the directory itself and all directories below it
+                    if regex.endswith("/"):
+                        regex = regex[:-1] + "(?:/[^/]+)*"
+                    else:
+                        regex += "[^/]+(?:/[^/]+)*"
+                    dirs_only = True
+                else:
+                    regex += "(?:[^/]+/)*"
+                continue
+            if literal and not any([c in part for c in "*?["]):
+                prefix.append(part)
+            else:
+                literal = False
+            regex += FileCollection._translateComponent(part)
+            if i < len(parts) - 1:
+                regex += "/"
+
+        return regex, dirs_only, prefix, "**" in parts, len(parts)
+
+    @staticmethod
+    def _translateComponent(part):
+        """ Translate a single path component of a glob to a regex, like fnmatch does, except that wildcards never
+            match the path separator. """
+        regex = ""
+        i, n = 0, len(part)
+        while i < n:
+            c = part[i]
+            i += 1
+            if c == "*":
+                regex += "[^/]*"
+            elif c == "?":
+                regex += "[^/]"
+            elif c == "[":
+                j = i
+                if j < n and part[j] == "!":
+                    j += 1
+                if j < n and part[j] == "]":
+                    j += 1
+                while j < n and part[j] != "]":
+                    j += 1
+                if j >= n:
+                    regex += "\\["
+                else:
+                    stuff = re.sub(r"([&~|\[])", r"\\\1", part[i:j].replace("\\", "\\\\"))
+                    i = j + 1
+                    if stuff[0] == "!":
+                        stuff = "^" + stuff[1:]
+                    elif stuff[0] == "^":
+                        stuff = "\\" + stuff
+                    regex += f"[{stuff}]"
+            else:
+                regex += re.escape(c)
+        return regex
+
+    def _needsDescent(self, dir_parts, link_depth = -1):
+        """ Check if any pattern might match something below the directory with the given path components. If the
+            directory is (below) a symlinked directory, only the patterns that reach it without a "**" count. """
+        for prefix, recursive, depth, static_depth in self.prefixes:
+            if static_depth <= link_depth:
+                continue
+            common = min(len(dir_parts), len(prefix))
+            if dir_parts[:common] != prefix[:common]:
+                continue
+            if len(dir_parts) < len(prefix) or recursive or len(dir_parts) < depth:
+                return True
+        return False
+
+    def _walk(self):
+        """ Walk the repo once and return all paths that might match a pattern, as tuples of the path, whether it's a
+            directory and the index of the deepest symlinked directory in the path (or -1). Directories that can't
+            contain any matches are skipped, as is the .git directory. """
+        paths       = [(".", True, -1)]
+        link_depths = {".": -1}
+        # Symlinks are followed like pathlib does. As they're never followed by a "**", the depth is bounded by the
+        # patterns, so symlink loops can't lead to endless recursion.
+        for root, dir_names, file_names in os.walk(".", followlinks = True):
+            rel_root = root[2:]
+            parts = rel_root.split("/") if rel_root != "" else []
+            link_depth = link_depths.pop(root)
+            descend = []
+            for dir_name in dir_names:
+                if rel_root == "" and dir_name == ".git":
+                    continue
+                dir_link_depth = len(parts) if os.path.islink(os.path.join(root, dir_name)) else link_depth
+                paths.append((f"{rel_root}/{dir_name}" if rel_root != "" else dir_name, True, dir_link_depth))
+                if self._needsDescent(parts + [dir_name], dir_link_depth):
+                    descend.append(dir_name)
+                    link_depths[os.path.join(root, dir_name)] = dir_link_depth
+            dir_names[:] = descend
+            for file_name in file_names:
+                paths.append((f"{rel_root}/{file_name}" if rel_root != "" else file_name, False, link_depth))
+        return paths
+
+    def _getChangedFiles(self):
+        """ Ask git for a list of all files that are new or changed compared to the main branch, committed or not. """
+        with TRACER.span("git"):
+            committed   = subprocess.run(["git", "diff", "--name-only", "-z", "--diff-filter=ACM", "--ignore-space-at-eol", self.main_branch], capture_output = True)
+            uncommitted = subprocess.run(["git", "ls-files", "-z", "--others"], capture_output = True)
+        changed_files = committed.stdout.decode("UTF-8").split("\0") + uncommitted.stdout.decode("UTF-8").split("\0")
+        return list(dict.fromkeys([file_path for file_path in changed_files if file_path != ""]))
+
+    def _resolveUsingGlob(self):
+        """ Resolve the patterns by globbing them one by one. """
+        if self.mode == FileCollection.Mode.CHANGED:
+            changed_files = set(self._getChangedFiles())
         else:
             # Otherwise we need to keep track of the files that we already encountered
-            combined = []
+            combined = set()
             
         for pattern_name in self.patterns:
             patterns = self.patterns[pattern_name]
-            # Each pattern name can be associated with multiple patterns, so make sure we always have a list
             if type(patterns) == str:
                 patterns = [patterns]
             
@@ -181,22 +610,1751 @@ class FileCollection(dict):
             # file name globs
             for pattern in patterns:
                 for file_path in pathlib.Path().glob(pattern):
+                    posix_path = file_path.as_posix()
                     if self.mode == FileCollection.Mode.CHANGED:
-                        if file_path.as_posix() in changed_files:
-                            self[pattern_name].append(file_path.as_posix())
-                            changed_files.remove(file_path.as_posix())
-                    elif (file_path not in combined) and any([fnmatch.fnmatch(file_path.name, fn_glob) for fn_glob in self.file_name_globs]):
-                        self[pattern_name].append(file_path.as_posix())
-                        combined.append(file_path)
+                        if posix_path in changed_files:
+                            self[pattern_name].append(posix_path)
+                            changed_files.remove(posix_path)
+                    elif (posix_path not in combined) and self.file_name_regex.match(file_path.name):
+                        self[pattern_name].append(posix_path)
+                        combined.add(posix_path)
+
+class FileIndex:
+    """ In-memory index of the paths in the repo that match one of the patterns of a FileCollection.
+
+        The index is built once and then kept up to date by refresh(), which only stats the known directories and
+        files: directories whose modification time changed are re-read, and files whose modification time or size
+        changed are reported as changed. The list of files that git considers changed is cached as well, and only
+        requested again when something in the repo or in the git metadata (HEAD, index, refs) changed. The lock is
+        not held while git is asked for the changed files, so this doesn't hold up a refresh. All methods block, so
+        they should be called in a thread when used from the event loop.
+    """
+
+    POLL_INTERVAL = 2 # In seconds
+
+    def __init__(self, file_collection):
+        self.file_collection = file_collection
+        self.lock            = threading.Lock()
+        self.changed_lock    = threading.Lock() # Held while determining the changed files
+        self.dirs            = {} # Directory path -> (mtime, names of the entries it contains)
+        self.files           = {} # File path -> (mtime, size)
+        self.assignments     = {} # Path -> name of the first pattern that matches it
+        self.changed_files   = None
+        self.git_state       = self._getGitState()
+        self.generation      = 0
+        self.unreported      = set() # Changes not yet reported by poll()
+
+        with self.lock:
+            self._scanDir("", set())
+            if self.file_collection.match(".", True) != None:
+                self.assignments["."] = self.file_collection.match(".", True)
+
+    @staticmethod
+    def isSupported(file_collection):
+        return file_collection.matchers != None
+
+    def getAssignments(self):
+        """ Return a list of tuples of each matching path and the name of the pattern it is assigned to. """
+        with self.lock:
+            return list(self.assignments.items())
+
+    def getChangedFiles(self):
+        """ Return the set of files that are changed compared to the main branch, according to git. """
+        with self.changed_lock:
+            with self.lock:
+                if self.changed_files != None:
+                    return self.changed_files
+                generation = self.generation
+                file_paths = [path for path in self.assignments if path in self.files]
+
+            changed_files = self.file_collection._getChangedFiles()
+            if self.file_collection.dependencies != None:
+                changed_files = self.file_collection.dependencies.expand(changed_files, file_paths)
+            changed_files = set(changed_files)
+
+            # Only keep the answer if nothing changed in the meantime
+            with self.lock:
+                if self.generation == generation:
+                    self.changed_files = changed_files
+            return changed_files
+
+    def refresh(self):
+        """ Bring the index up to date with the file system. Returns the set of paths that have been added, removed or
+            modified since the last refresh. """
+        changed = set()
+        with self.lock:
+            for dir_path in list(self.dirs.keys()):
+                if dir_path not in self.dirs: # Removed while handling a parent directory
+                    continue
+                try:
+                    mtime = os.stat(dir_path if dir_path != "" else ".").st_mtime_ns
+                except OSError:
+                    mtime = None
+                if mtime != self.dirs[dir_path][0]:
+                    self._rescanDir(dir_path, changed)
+
+            for file_path, state in list(self.files.items()):
+                try:
+                    stat_result = os.stat(file_path)
+                    new_state = (stat_result.st_mtime_ns, stat_result.st_size)
+                except OSError:
+                    new_state = None
+                if new_state != state:
+                    changed.add(file_path)
+                    if new_state != None:
+                        self.files[file_path] = new_state
+
+            self.unreported |= changed
+            git_state = self._getGitState()
+            if len(changed) > 0 or git_state != self.git_state:
+                self.git_state     = git_state
+                self.changed_files = None
+                self.generation   += 1
+
+        return changed
+
+    async def poll(self, on_change = None, interval = POLL_INTERVAL):
+        """ Keep refreshing the index in the background. The optional on_change coroutine function is called with the
+            set of changed paths, including the changes picked up by refreshes from elsewhere. """
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.refresh)
+            with self.lock:
+                changed = self.unreported
+                self.unreported = set()
+            if len(changed) > 0 and on_change != None:
+                await on_change(changed)
+
+    def _scanDir(self, dir_path, changed, link_depth = -1):
+        """ Add the directory and everything below it that might match a pattern to the index. The link_depth is the
+            index of the deepest symlinked directory in its path, or -1. """
+        try:
+            mtime   = os.stat(dir_path if dir_path != "" else ".").st_mtime_ns
+            entries = list(os.scandir(dir_path if dir_path != "" else "."))
+        except OSError:
+            return
+        self.dirs[dir_path] = (mtime, set([entry.name for entry in entries]), link_depth)
+        for entry in entries:
+            self._addEntry(dir_path, entry, changed, link_depth)
+
+    def _rescanDir(self, dir_path, changed):
+        """ Re-read a directory of which the modification time changed, and handle the added and removed entries. """
+        old_names, link_depth = self.dirs[dir_path][1:]
+        try:
+            mtime   = os.stat(dir_path if dir_path != "" else ".").st_mtime_ns
+            entries = list(os.scandir(dir_path if dir_path != "" else "."))
+        except OSError:
+            self._removePath(dir_path, changed)
+            return
+        new_names = set([entry.name for entry in entries])
+        self.dirs[dir_path] = (mtime, new_names, link_depth)
+
+        for name in old_names - new_names:
+            self._removePath(f"{dir_path}/{name}" if dir_path != "" else name, changed)
+        for entry in entries:
+            if entry.name not in old_names:
+                self._addEntry(dir_path, entry, changed, link_depth)
+
+    def _addEntry(self, dir_path, entry, changed, link_depth = -1):
+        if dir_path == "" and entry.name == ".git":
+            return
+        path = f"{dir_path}/{entry.name}" if dir_path != "" else entry.name
+        changed.add(path)
+        try:
+            is_dir = entry.is_dir()
+            if is_dir and entry.is_symlink():
+                link_depth = path.count("/")
+        except OSError:
+            return
+        pattern_name = self.file_collection.match(path, is_dir, link_depth)
+        if pattern_name != None:
+            self.assignments[path] = pattern_name
+
+        if is_dir:
+            if self.file_collection._needsDescent(path.split("/"), link_depth):
+                self._scanDir(path, changed, link_depth)
+        else:
+            try:
+                stat_result = entry.stat()
+                self.files[path] = (stat_result.st_mtime_ns, stat_result.st_size)
+            except OSError:
+                pass
+
+    def _removePath(self, path, changed):
+        """ Remove a path, and everything below it if it's a directory, from the index. """
+        prefix = path + "/"
+        for index in (self.dirs, self.files, self.assignments):
+            for key in [key for key in index if key == path or key.startswith(prefix)]:
+                changed.add(key)
+                del index[key]
+
+    def _getGitState(self):
+        """ Collect the modification times of the git metadata that determines what is considered changed. """
+        state = []
+        for path in [".git/HEAD", ".git/index", ".git/packed-refs"]:
+            try:
+                state.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                state.append(None)
+        for root, _, file_names in os.walk(".git/refs"):
+            for file_name in file_names:
+                try:
+                    state.append((root, file_name, os.stat(os.path.join(root, file_name)).st_mtime_ns))
+                except OSError:
+                    pass
+        return state
+
+class DependencyIndex:
+    """ Index of the canonical URL's defined and referenced by the FHIR resources in the repo.
+
+        When a profile or ValueSet changes, the resources that refer to it (examples claiming conformance, derived
+        profiles, bindings, extension usages) might be affected as well. This index allows to extend a set of changed
+        files with all the files that (transitively) depend on them. It is persisted on disk and only the files that
+        changed since the last time are parsed again.
+    """
+
+    REFERENCE_ELEMENTS = set(["baseDefinition", "profile", "targetProfile", "valueSet"])
+    EXTENSION_ELEMENTS = set(["extension", "modifierExtension"])
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.entries    = {} # Path -> [mtime, size, defined canonicals, referenced canonicals]
+        try:
+            with open(self.index_file) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def update(self, file_paths):
+        """ Make sure the index reflects the current state of the given files, and only these files. """
+        dirty = False
+        current = set(file_paths)
+        for file_path in [file_path for file_path in self.entries if file_path not in current]:
+            del self.entries[file_path]
+            dirty = True
+
+        for file_path in file_paths:
+            try:
+                stat_result = os.stat(file_path)
+            except OSError:
+                continue
+            entry = self.entries.get(file_path)
+            if entry == None or entry[0] != stat_result.st_mtime_ns or entry[1] != stat_result.st_size:
+                defines, references = self._extract(file_path)
+                self.entries[file_path] = [stat_result.st_mtime_ns, stat_result.st_size, sorted(defines), sorted(references)]
+                dirty = True
+
+        if dirty:
+            os.makedirs(os.path.dirname(self.index_file), exist_ok = True)
+            tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_file, self.index_file)
+
+    def expand(self, changed_files, file_paths):
+        """ Return the changed files, followed by all files from file_paths that depend on them, directly or
+            indirectly. """
+        self.update(file_paths)
+
+        referrers = {}
+        for file_path, entry in self.entries.items():
+            for canonical in entry[3]:
+                referrers.setdefault(canonical, []).append(file_path)
+
+        result = list(dict.fromkeys(changed_files))
+        seen   = set(result)
+        queue  = list(result)
+        while len(queue) > 0:
+            file_path = queue.pop(0)
+            if file_path not in self.entries:
+                continue
+            for canonical in self.entries[file_path][2]:
+                for referrer in referrers.get(canonical, []):
+                    if referrer not in seen:
+                        seen.add(referrer)
+                        result.append(referrer)
+                        queue.append(referrer)
+        return result
+
+    def _extract(self, file_path):
+        """ Return the sets of canonical URL's defined and referenced by a resource file. """
+        defines    = set()
+        references = set()
+        try:
+            if file_path.lower().endswith(".xml"):
+                # Stream through the file, as we only need the attributes of the elements
+                depth = 0
+                for event, element in ET.iterparse(file_path, events = ("start", "end")):
+                    if event == "end":
+                        depth -= 1
+                        element.clear()
+                        continue
+                    depth += 1
+                    name = element.tag.rsplit("}", 1)[-1]
+                    if depth == 2 and name == "url":
+                        defines.add(element.get("value"))
+                    elif name in self.REFERENCE_ELEMENTS:
+                        references.add(element.get("value"))
+                    elif name in self.EXTENSION_ELEMENTS:
+                        references.add(element.get("url"))
+            elif file_path.lower().endswith(".json"):
+                with open(file_path, "rb") as f:
+                    resource = json.load(f)
+                if isinstance(resource, dict) and isinstance(resource.get("url"), str):
+                    defines.add(resource["url"])
+                self._extractFromJson(resource, references)
+        except (OSError, ET.ParseError, ValueError):
+            pass
+
+        # Versions are not taken into account
+        defines    = set([canonical.split("|")[0] for canonical in defines    if canonical])
+        references = set([canonical.split("|")[0] for canonical in references if canonical])
+        return defines, references - defines
+
+    def _extractFromJson(self, value, references):
+        if isinstance(value, list):
+            for item in value:
+                self._extractFromJson(item, references)
+        elif isinstance(value, dict):
+            for key, child in value.items():
+                if key in self.REFERENCE_ELEMENTS:
+                    for canonical in (child if isinstance(child, list) else [child]):
+                        if isinstance(canonical, str):
+                            references.add(canonical)
+                elif key in self.EXTENSION_ELEMENTS and isinstance(child, list):
+                    for extension in child:
+                        if isinstance(extension, dict) and isinstance(extension.get("url"), str):
+                            references.add(extension["url"])
+                self._extractFromJson(child, references)
+
+class OutcomeBundle:
+    """ Helper methods to read and write the Validator output, which consists of an OperationOutcome per validated
+        file (wrapped in a Bundle if there's more than one), marked with the file it is about. """
+
+    FILE_EXTENSION = "http://hl7.org/fhir/StructureDefinition/operationoutcome-file"
+
+    @staticmethod
+    def read(path):
+        """ Read the Validator output and return the list of OperationOutcome elements it contains. """
+        root = ET.parse(path).getroot()
+        if root.tag == f"{{{FHIR_NS}}}OperationOutcome":
+            return [root]
+        return root.findall(f"{{{FHIR_NS}}}entry/{{{FHIR_NS}}}resource/{{{FHIR_NS}}}OperationOutcome")
+
+    @staticmethod
+    def write(path, outcomes):
+        """ Write the list of OperationOutcome elements as a Bundle, like the Validator does. """
+        bundle = ET.Element(f"{{{FHIR_NS}}}Bundle")
+        ET.SubElement(bundle, f"{{{FHIR_NS}}}type", value = "collection")
+        for outcome in outcomes:
+            entry = ET.SubElement(bundle, f"{{{FHIR_NS}}}entry")
+            ET.SubElement(entry, f"{{{FHIR_NS}}}resource").append(outcome)
+        ET.ElementTree(bundle).write(path, encoding = "UTF-8", xml_declaration = True)
+
+    @staticmethod
+    def getFile(outcome):
+        """ Return the path of the file the outcome is about, or None if it isn't marked. """
+        for extension in outcome.findall(f"{{{FHIR_NS}}}extension"):
+            if extension.get("url") == OutcomeBundle.FILE_EXTENSION:
+                value = extension.find(f"{{{FHIR_NS}}}valueString")
+                if value != None:
+                    return value.get("value")
+        return None
+
+    @staticmethod
+    def setFile(outcome, file_path):
+        """ Mark the outcome with the file it is about. The extension should be placed before the first issue to keep
+            the XML valid. """
+        extension = ET.Element(f"{{{FHIR_NS}}}extension", url = OutcomeBundle.FILE_EXTENSION)
+        ET.SubElement(extension, f"{{{FHIR_NS}}}valueString", value = file_path)
+        children = list(outcome)
+        issues = [i for i, child in enumerate(children) if child.tag == f"{{{FHIR_NS}}}issue"]
+        outcome.insert(issues[0] if len(issues) > 0 else len(children), extension)
+
+class FileCache:
+    """ Base class for a persistent cache that stores its entries as files in a directory. The cache is bounded in
+        size; when it grows too big, the least recently used entries are evicted. """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size  = max_size * 1024 * 1024
+        self.written   = 0
+        os.makedirs(self.cache_dir, exist_ok = True)
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors = True)
+        os.makedirs(self.cache_dir, exist_ok = True)
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits within its maximum size (with some headroom so
+            we don't need to do this on every run). Only does any work if something has been written. """
+        if self.written == 0:
+            return
+        self.written = 0
+
+        entries = []
+        total_size = 0
+        for root, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                path = os.path.join(root, file_name)
+                stat_result = os.stat(path)
+                entries.append((stat_result.st_mtime, stat_result.st_size, path))
+                total_size += stat_result.st_size
+        if total_size <= self.max_size:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size * 0.8:
+                break
+            os.unlink(path)
+            total_size -= size
+
+class ResultCache(FileCache):
+    """ Persistent cache of the Validator outcome per file.
+
+        An outcome is stored under a key that covers everything that might influence it: the content of the file, the
+        profile it is validated against, the Validator version and options, and the state of the ig's. When none of
+        these changed, the stored outcome can be used instead of validating the file again. The cache is bounded in
+        size; when it grows too big, the least recently used outcomes are evicted.
+    """
+
+    DEFAULT_MAX_SIZE = 512 # In MB
+
+    def __init__(self, cache_dir, max_size = DEFAULT_MAX_SIZE):
+        super().__init__(cache_dir, max_size)
+
+    def makeContext(self, engine_args, igs):
+        """ Create the part of the key that is shared by all files validated using the same Validator settings. The ig
+            directories are fingerprinted using the size and modification time of the files they contain. """
+        context = hashlib.sha256()
+        context.update(self._validatorVersion().encode("UTF-8"))
+        context.update("\0".join(engine_args).encode("UTF-8"))
+        for ig in igs:
+            if os.path.isdir(ig):
+                for root, dir_names, file_names in os.walk(ig):
+                    dir_names.sort()
+                    for file_name in sorted(file_names):
+                        file_path = os.path.join(root, file_name)
+                        stat_result = os.stat(file_path)
+                        context.update(f"{file_path}\0{stat_result.st_size}\0{stat_result.st_mtime_ns}\0".encode("UTF-8"))
+        return context.hexdigest()
+
+    def makeKey(self, context, profile, file_path):
+        key = hashlib.sha256()
+        key.update(context.encode("UTF-8"))
+        key.update(f"\0{profile}\0{file_path}\0".encode("UTF-8"))
+        with open(file_path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                key.update(chunk)
+        return key.hexdigest()
+
+    def get(self, key):
+        """ Return the stored OperationOutcome element for the key, or None if it's not in the cache. """
+        path = self._path(key)
+        try:
+            outcome = ET.parse(path).getroot()
+        except (OSError, ET.ParseError):
+            return None
+        os.utime(path) # Keep track of usage for the LRU eviction
+        return outcome
+
+    def put(self, key, outcome):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        ET.ElementTree(outcome).write(tmp_path, encoding = "UTF-8")
+        self.written += os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def isCacheable(outcome):
+        """ Outcomes that report processing problems (e.g. an unreachable terminology server) are transient and should
+            not be cached. """
+        for issue in outcome.iterfind(f"{{{FHIR_NS}}}issue"):
+            severity = issue.find(f"{{{FHIR_NS}}}severity")
+            code     = issue.find(f"{{{FHIR_NS}}}code")
+            if (severity != None and severity.get("value") == "fatal") or (code != None and code.get("value") == "exception"):
+                return False
+        return True
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".xml")
+
+    def _validatorVersion(self):
+        """ Identify the Validator by its version as written in the jar manifest, plus the size of the jar. """
+        version = ""
+        try:
+            with zipfile.ZipFile(VALIDATOR_JAR) as jar:
+                for line in jar.read("META-INF/MANIFEST.MF").decode("UTF-8").splitlines():
+                    if line.startswith("Implementation-Version:"):
+                        version = line.split(":", 1)[1].strip()
+            version += f"-{os.path.getsize(VALIDATOR_JAR)}"
+        except (OSError, KeyError, zipfile.BadZipFile):
+            pass
+        return version
+
+class TerminologyCache(FileCache):
+    """ Persistent cache of the responses of a terminology server.
+
+        The Validator asks the terminology server to validate each code and to expand each ValueSet it encounters,
+        which (especially for the Dutch edition of SNOMED CT) takes up a large part of the validation time. The answers
+        rarely change, so each response is stored under a key made from the request and re-used until it's older than
+        the maximum age. Each entry is stored as a single file: a line of JSON describing the request and response,
+        followed by the request body and the response body.
+    """
+
+    DEFAULT_MAX_SIZE = 256 # In MB
+    DEFAULT_MAX_AGE  = 30  # In days
+
+    # Parameters that differ per Validator session without affecting the answer
+    VOLATILE_PARAMETERS = ["cache-id"]
+
+    def __init__(self, cache_dir, max_size = DEFAULT_MAX_SIZE, max_age = DEFAULT_MAX_AGE):
+        super().__init__(cache_dir, max_size)
+        self.max_age = max_age * 24 * 60 * 60
+
+    def makeKey(self, method, path, headers, body):
+        """ Create the key for a request, given the headers that influence the answer. """
+        key = hashlib.sha256()
+        key.update(f"{method}\0{path}\0".encode("UTF-8"))
+        for name in sorted(headers):
+            key.update(f"{name.lower()}\0{headers[name]}\0".encode("UTF-8"))
+        key.update(self._normalizeBody(body))
+        return key.hexdigest()
+
+    def get(self, key):
+        """ Return a tuple of the stored entry (a dict describing the request and response), the response body and
+            whether the entry is still fresh, or None if the key is not in the cache. """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline())
+                f.seek(meta["request_size"], os.SEEK_CUR)
+                body = f.read()
+        except (OSError, ValueError, KeyError):
+            return None
+        os.utime(path) # Keep track of usage for the LRU eviction
+        return meta, body, time.time() - meta["stored"] < self.max_age
+
+    def put(self, key, method, path, headers, request_body, status, content_type, body):
+        meta = {
+            "method":       method,
+            "path":         path,
+            "headers":      headers,
+            "request_size": len(request_body),
+            "status":       status,
+            "content_type": content_type,
+            "stored":       time.time()
+        }
+        cache_path = self._path(key)
+        os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(meta).encode("UTF-8") + b"\n")
+            f.write(request_body)
+            f.write(body)
+        self.written += os.path.getsize(tmp_path)
+        os.replace(tmp_path, cache_path)
+
+    def getStale(self):
+        """ Return the requests of all entries that are older than the maximum age, as tuples of the method, path,
+            headers and request body. """
+        stale = []
+        for root, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                try:
+                    with open(os.path.join(root, file_name), "rb") as f:
+                        meta = json.loads(f.readline())
+                        if time.time() - meta["stored"] >= self.max_age:
+                            stale.append((meta["method"], meta["path"], meta["headers"], f.read(meta["request_size"])))
+                except (OSError, ValueError, KeyError):
+                    continue
+        return stale
+
+    def _normalizeBody(self, body):
+        """ Leave out the volatile parameters from a FHIR Parameters resource in JSON format. """
+        try:
+            resource = json.loads(body)
+        except ValueError:
+            return body
+        if isinstance(resource, dict) and resource.get("resourceType") == "Parameters":
+            resource["parameter"] = [parameter for parameter in resource.get("parameter", []) if parameter.get("name") not in self.VOLATILE_PARAMETERS]
+        return json.dumps(resource, sort_keys = True).encode("UTF-8")
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+class TerminologyProxy:
+    """ Local stand-in for the terminology server, which is passed to the Validator instead of the actual server.
+
+        Requests are answered from the TerminologyCache when possible and forwarded to the actual server otherwise. If
+        the server can't be reached, stale entries are used as well. In offline mode, requests are answered from the
+        cache only. The proxy is started on first use and shared by all steps and runs.
+    """
+
+    FORWARDED_HEADERS = ["Accept", "Accept-Language", "Content-Type"]
+    DEFAULT_SERVER    = "http://tx.fhir.org"
+    TIMEOUT           = 300 # In seconds
+    WARM_UP_REQUESTS  = 4   # The number of concurrent requests when warming up the cache
+
+    def __init__(self, cache, server = DEFAULT_SERVER, offline = False):
+        self.cache   = cache
+        self.offline = offline
+        self.url     = None
+        self.runner  = None
+        self.session = None
+        self.lock    = asyncio.Lock()
+
+        # Like the Validator, we assume the R4 endpoint of tx.fhir.org when only the host is given
+        self.server = server.rstrip("/")
+        if re.match(r"https?://tx\.fhir\.org$", self.server):
+            self.server += "/r4"
+
+    async def start(self):
+        """ Start the proxy if it isn't running yet, and return its URL. """
+        async with self.lock:
+            if self.runner == None:
+                app = web.Application(client_max_size = 64 * 1024 * 1024)
+                app.router.add_route("*", "/{path:.*}", self._handle)
+                runner = web.AppRunner(app, access_log = None)
+                await runner.setup()
+                site = web.TCPSite(runner, "127.0.0.1", 0)
+                await site.start()
+                self.url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+                self.runner = runner
+        return self.url
+
+    async def stop(self):
+        if self.runner != None:
+            await self.runner.cleanup()
+            self.runner = None
+        if self.session != None:
+            await self.session.close()
+            self.session = None
+        self.cache.evict()
+
+    async def warmUp(self, printer):
+        """ Refresh all entries in the cache that are older than the maximum age, so subsequent runs don't need to
+            wait for the terminology server. """
+        if self.offline:
+            return
+        stale = self.cache.getStale()
+        if len(stale) == 0:
+            return
+        await printer.writeLine(f"\033[1;37mRefreshing {len(stale)} entries in the terminology cache\033[0m")
+        semaphore = asyncio.Semaphore(self.WARM_UP_REQUESTS)
+        async def refresh(method, path, headers, body):
+            async with semaphore:
+                try:
+                    await self._fetch(method, path, headers, body)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    pass
+        await asyncio.gather(*[refresh(*request) for request in stale])
+        self.cache.evict()
+
+    async def _handle(self, request):
+        path    = request.path_qs
+        headers = {name: request.headers[name] for name in self.FORWARDED_HEADERS if name in request.headers}
+        body    = await request.read()
+
+        key = self.cache.makeKey(request.method, path, headers, body)
+        entry = self.cache.get(key)
+        if entry != None and (entry[2] or self.offline):
+            TRACER.count("terminology_requests", result = "cached")
+            return self._makeResponse(entry[0]["status"], entry[0]["content_type"], entry[1])
+        if self.offline:
+            TRACER.count("terminology_requests", result = "unavailable")
+            return self._makeError(503, f"Offline mode: no cached answer for {request.method} {path}")
+
+        try:
+            with TRACER.span("terminology request"):
+                response = self._makeResponse(*await self._fetch(request.method, path, headers, body, key))
+            TRACER.count("terminology_requests", result = "forwarded")
+            return response
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if entry != None: # A stale answer is better than none
+                TRACER.count("terminology_requests", result = "stale")
+                return self._makeResponse(entry[0]["status"], entry[0]["content_type"], entry[1])
+            TRACER.count("terminology_requests", result = "unavailable")
+            return self._makeError(502, f"The terminology server could not be reached: {e}")
+
+    async def _fetch(self, method, path, headers, body, key = None):
+        """ Forward a request to the actual server and store the answer if it's successful. Returns a tuple of the
+            status, content type and body of the response. """
+        if self.session == None:
+            self.session = aiohttp.ClientSession(timeout = aiohttp.ClientTimeout(total = self.TIMEOUT))
+        async with self.session.request(method, self.server + path, headers = headers, data = body) as response:
+            response_body = await response.read()
+            content_type = response.headers.get("Content-Type", "application/fhir+json")
+        if response.status == 200:
+            if key == None:
+                key = self.cache.makeKey(method, path, headers, body)
+            self.cache.put(key, method, path, headers, body, response.status, content_type, response_body)
+        return response.status, content_type, response_body
+
+    def _makeResponse(self, status, content_type, body):
+        return web.Response(status = status, body = body, headers = {"Content-Type": content_type})
+
+    def _makeError(self, status, message):
+        outcome = {
+            "resourceType": "OperationOutcome",
+            "issue": [{"severity": "error", "code": "exception", "diagnostics": message}]
+        }
+        return self._makeResponse(status, "application/fhir+json", json.dumps(outcome).encode("UTF-8"))
+
+class PackageCache(FileCache):
+    """ Cache of the ig directories, compiled into FHIR packages.
+
+        When an ig directory is passed to the Validator, it reads and parses every file in it on each start, just to
+        find the conformance resources. Instead, each directory is compiled into a package (.tgz) that only contains
+        the conformance resources, together with an index describing them. The package is named after the content of
+        the directory, so it's only rebuilt when something in the directory changed.
+
+        Packages given by their id are pinned to the latest version in the FHIR package cache (like the ones installed
+        when building the Docker image), so the Validator doesn't need to ask the package registry which version to
+        use on each start.
+    """
+
+    DEFAULT_MAX_SIZE = 256 # In MB
+
+    # The resource types that the Validator loads from a package
+    CONFORMANCE_TYPES = set(["CapabilityStatement", "CodeSystem", "ConceptMap", "ImplementationGuide", "NamingSystem",
+                             "OperationDefinition", "Questionnaire", "SearchParameter", "StructureDefinition",
+                             "StructureMap", "ValueSet"])
+
+    # The elements that are described in the package index
+    INDEX_ELEMENTS = ["id", "url", "version", "kind", "type", "supplements", "content"]
+
+    def __init__(self, cache_dir, max_size = DEFAULT_MAX_SIZE, fhir_cache_dir = FHIR_PACKAGE_CACHE):
+        super().__init__(cache_dir, max_size)
+        self.fhir_cache_dir = fhir_cache_dir
+        self.states = {} # ig directory -> (fingerprint of its files, path of the package)
+
+    def resolve(self, ig):
+        """ Return what should be passed to the Validator for the ig: the package compiled from it if it's a directory,
+            the pinned version if it's the id of an installed package, or the ig itself otherwise. """
+        if os.path.isdir(ig):
+            try:
+                return self._compile(ig)
+            except OSError:
+                return ig
+        if re.fullmatch(r"[A-Za-z0-9_-]+(\.[A-Za-z0-9_-]+)+", ig) and not os.path.exists(ig):
+            version = self._installedVersion(ig)
+            if version != None:
+                return f"{ig}#{version}"
+        return ig
+
+    def _compile(self, ig):
+        """ Return the path of the package with the content of the ig directory, building it if needed. Like the
+            Validator, only the files directly in the directory are taken into account. """
+        entries = sorted([entry for entry in os.scandir(ig) if entry.is_file() and entry.name.lower().endswith((".xml", ".json"))], key = lambda entry: entry.name)
+        fingerprint = [(entry.name, entry.stat().st_mtime_ns, entry.stat().st_size) for entry in entries] # Cached by scandir
+
+        # Nothing changed since the last time, so we don't need to read the files again
+        state = self.states.get(ig)
+        if state != None and state[0] == fingerprint and os.path.exists(state[1]):
+            return state[1]
+
+        digest = hashlib.sha256()
+        for entry in entries:
+            digest.update(f"{entry.name}\0".encode("UTF-8"))
+            with open(entry.path, "rb") as f:
+                while chunk := f.read(1024 * 1024):
+                    digest.update(chunk)
+            digest.update(b"\0")
+        digest = digest.hexdigest()
+
+        path = os.path.join(self.cache_dir, digest[:32] + ".tgz")
+        if os.path.exists(path):
+            os.utime(path) # Keep track of usage for the LRU eviction
+        else:
+            self._build(ig, entries, digest, path)
+        self.states[ig] = (fingerprint, path)
+        return path
+
+    def _build(self, ig, entries, digest, path):
+        """ Write the package for the files with their index. The package has a name that is unique for its content, so
+            different versions of an ig don't get mixed up by the Validator. """
+        index = []
+        for entry in entries:
+            description = self._describe(entry.path)
+            if description != None and description["resourceType"] in self.CONFORMANCE_TYPES:
+                description["filename"] = entry.name
+                index.append(description)
+
+        manifest = {
+            "name": f"local.ig.{digest[:16]}",
+            "version": "0.0.0",
+            "fhirVersions": ["4.0.1"],
+            "type": "fhir.ig",
+            "dependencies": {}
+        }
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with tarfile.open(tmp_path, "w:gz") as package:
+            self._addToPackage(package, "package/package.json", json.dumps(manifest).encode("UTF-8"))
+            self._addToPackage(package, "package/.index.json", json.dumps({"index-version": 2, "files": index}).encode("UTF-8"))
+            for description in index:
+                package.add(os.path.join(ig, description["filename"]), "package/" + description["filename"])
+        self.written += os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+
+    def _addToPackage(self, package, name, content):
+        info = tarfile.TarInfo(name)
+        info.size  = len(content)
+        info.mtime = time.time()
+        package.addfile(info, io.BytesIO(content))
+
+    def _describe(self, file_path):
+        """ Return the resource type and the indexed elements of a resource file, or None if it's not a FHIR
+            resource. """
+        try:
+            if file_path.lower().endswith(".xml"):
+                description = {}
+                depth = 0
+                for event, element in ET.iterparse(file_path, events = ("start", "end")):
+                    if event == "end":
+                        depth -= 1
+                        element.clear()
+                        continue
+                    depth += 1
+                    namespace, _, name = element.tag[1:].partition("}")
+                    if depth == 1:
+                        if namespace != FHIR_NS:
+                            return None
+                        description["resourceType"] = name
+                    elif depth == 2 and name in self.INDEX_ELEMENTS and name not in description:
+                        description[name] = element.get("value")
+                return description
+            else:
+                with open(file_path, "rb") as f:
+                    resource = json.load(f)
+                if not isinstance(resource, dict) or not isinstance(resource.get("resourceType"), str):
+                    return None
+                description = {"resourceType": resource["resourceType"]}
+                for name in self.INDEX_ELEMENTS:
+                    if isinstance(resource.get(name), str):
+                        description[name] = resource[name]
+                return description
+        except (OSError, ET.ParseError, ValueError):
+            return None
+
+    def _installedVersion(self, package_id):
+        """ Return the latest version of the package in the FHIR package cache, preferring releases over
+            pre-releases, or None if it isn't installed. """
+        try:
+            names = os.listdir(self.fhir_cache_dir)
+        except OSError:
+            return None
+        versions = [name.split("#", 1)[1] for name in names if name.startswith(package_id + "#")]
+        versions = [version for version in versions if os.path.exists(os.path.join(self.fhir_cache_dir, f"{package_id}#{version}", "package", "package.json"))]
+        if len(versions) == 0:
+            return None
+        def versionKey(version):
+            parts = re.split(r"[.-]", version)
+            return (re.fullmatch(r"[0-9.]+", version) != None, [int(part) if part.isdigit() else -1 for part in parts])
+        return max(versions, key = versionKey)
+
+class ResourceGovernor:
+    """ Keeps the Validator and script processes within the CPU and memory limits of the machine or container.
+
+        The limits are read from the cgroup this tool runs in (as set by Docker or the CI runner), falling back to what
+        the machine offers. Each Validator process gets a heap size based on the number of files it validates and the
+        size of the ig's it loads. Before a process is started, the memory it's expected to use is reserved; processes
+        that don't fit in what's left are queued until others finish, rather than having them killed by the OOM
+        killer. The memory actually used by the processes is sampled while they run and reported per step.
+    """
+
+    CGROUP_DIR = "/sys/fs/cgroup"
+    MB         = 1024 * 1024
+
+    RESERVED_MEMORY   = 512 * MB  # For this tool itself, the terminology proxy and the OS
+    JVM_OVERHEAD      = 256 * MB  # Memory used by a JVM besides its heap (metaspace, threads, code cache)
+    MIN_HEAP          = 512 * MB
+    BASE_HEAP         = 1024 * MB # For the Validator itself and the FHIR core package; can be set in qa.yaml
+    JVM_HEAP_FRACTION = 4         # Without -Xmx, the JVM takes a quarter of the memory of the container as its heap
+    HEAP_PER_FILE     = 1 * MB
+    HEAP_PER_IG_BYTE  = 6         # Loaded conformance resources take up several times their size on disk
+    COMPRESSION_RATIO = 5         # Of ig's that have been compiled into packages
+    SCRIPT_MEMORY     = 256 * MB  # The default estimate for a script process
+    SAMPLE_INTERVAL   = 0.5       # In seconds
+
+    # The Usage of the step that is being executed in the current task
+    USAGE = contextvars.ContextVar("usage", default = None)
+
+    class Usage:
+        """ The memory used by the processes of a single step. """
+        def __init__(self):
+            self.current   = {} # Process id -> resident memory in bytes
+            self.peak      = 0
+            self.processes = 0  # The number of processes started by the step
+
+        def update(self, pid, rss):
+            self.current[pid] = rss
+            self.peak = max(self.peak, sum(self.current.values()))
+
+        def remove(self, pid):
+            self.current.pop(pid, None)
+
+    class Reservation:
+        """ An amount of memory claimed for a process. A persistent reservation (like the one of the Validator daemon)
+            is held for a long time, so other processes don't wait for it to be released if nothing else runs. """
+        def __init__(self, governor, amount, persistent = False):
+            self.governor   = governor
+            self.amount     = amount
+            self.persistent = persistent
+            self.held       = False
+
+        async def acquire(self):
+            if self.amount > 0 and not self.held:
+                await self.governor._acquire(self)
+                self.held = True
+
+        async def release(self):
+            if self.held:
+                self.held = False
+                await self.governor._release(self)
+
+        async def __aenter__(self):
+            await self.acquire()
+            return self
+
+        async def __aexit__(self, exc_type, exc_value, traceback):
+            await self.release()
+            return False
+
+    def __init__(self, memory_limit = None):
+        self.detected_limit, self.cpus = self.detectLimits()
+        self.memory_limit = memory_limit if memory_limit != None else self.detected_limit
+        self.budget       = None # No limit if we can't tell
+        if self.memory_limit != None:
+            self.budget = max(self.MIN_HEAP + self.JVM_OVERHEAD, self.memory_limit - self.RESERVED_MEMORY)
+        self.reserved  = 0 # The memory reserved by all processes
+        self.transient = 0 # The number of non-persistent reservations
+        self.condition = asyncio.Condition()
+        self.ig_sizes  = {}
+
+    @classmethod
+    def detectLimits(cls):
+        """ Return the memory (in bytes) and the number of cores available to this process, taking the limits of its
+            cgroup into account. The memory is None if it can't be determined. """
+        memory = None
+        try:
+            with open("/proc/meminfo") as meminfo:
+                for line in meminfo:
+                    if line.startswith("MemTotal:"):
+                        memory = int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        cgroup_memory = cls._readCgroupMemory()
+        if cgroup_memory != None:
+            memory = cgroup_memory if memory == None else min(memory, cgroup_memory)
+
+        cpus = len(os.sched_getaffinity(0))
+        cgroup_cpus = cls._readCgroupCpus()
+        if cgroup_cpus != None:
+            cpus = max(1, min(cpus, cgroup_cpus))
+        return memory, cpus
+
+    @classmethod
+    def _readCgroupMemory(cls):
+        """ Return the memory limit of the cgroup (v2 or v1) in bytes, or None if there's none. """
+        for path in (os.path.join(cls.CGROUP_DIR, "memory.max"), os.path.join(cls.CGROUP_DIR, "memory", "memory.limit_in_bytes")):
+            try:
+                with open(path) as f:
+                    value = f.read().strip()
+            except OSError:
+                continue
+            if value.isdigit() and int(value) < 2 ** 60: # cgroup v1 uses a huge number for "no limit"
+                return int(value)
+            return None
+        return None
+
+    @classmethod
+    def _readCgroupCpus(cls):
+        """ Return the number of cores the CPU quota of the cgroup (v2 or v1) amounts to, or None if there's none. """
+        try:
+            with open(os.path.join(cls.CGROUP_DIR, "cpu.max")) as f:
+                quota, period = f.read().split()
+        except (OSError, ValueError):
+            try:
+                with open(os.path.join(cls.CGROUP_DIR, "cpu", "cpu.cfs_quota_us")) as f:
+                    quota = f.read().strip()
+                with open(os.path.join(cls.CGROUP_DIR, "cpu", "cpu.cfs_period_us")) as f:
+                    period = f.read().strip()
+            except OSError:
+                return None
+        if not quota.isdigit() or not period.isdigit() or int(period) == 0: # "max" or -1 means no limit
+            return None
+        return -(-int(quota) // int(period))
+
+    def validatorHeap(self, num_files, engine_args, base_heap = None):
+        """ Return the heap size (in bytes) for a Validator process that validates the given number of files, using
+            the ig's in the engine arguments, on top of the base heap (in bytes, defaults to BASE_HEAP). A larger heap
+            than the JVM would use by default is capped at the memory budget, but the heap is never made smaller than
+            that default. Returns None if the memory of the machine is unknown, in which case the JVM should pick its
+            own heap size. """
+        if self.detected_limit == None and self.memory_limit == None:
+            return None
+        default_heap = (self.detected_limit if self.detected_limit != None else self.memory_limit) // self.JVM_HEAP_FRACTION
+        heap = (base_heap if base_heap != None else self.BASE_HEAP) + num_files * self.HEAP_PER_FILE + self._getIgSize(engine_args) * self.HEAP_PER_IG_BYTE
+        if self.budget != None:
+            heap = min(heap, self.budget - self.JVM_OVERHEAD)
+        heap = max(default_heap, heap)
+        return -(-heap // self.MB) * self.MB
+
+    @staticmethod
+    def javaOptions(heap):
+        """ Return the JVM options for the heap size returned by validatorHeap(). """
+        return [f"-Xmx{heap // ResourceGovernor.MB}m"] if heap != None else []
+
+    def footprint(self, heap):
+        """ Return the memory a JVM with the given heap size is expected to use, or 0 if it isn't known. """
+        return heap + self.JVM_OVERHEAD if heap != None else 0
+
+    def reserve(self, amount, persistent = False):
+        """ Return a Reservation for the given amount of memory, to be acquired before starting a process. """
+        return ResourceGovernor.Reservation(self, amount, persistent)
+
+    def fits(self, amount):
+        """ Check if the amount of memory can be reserved right away. """
+        return amount == 0 or self.budget == None or self.reserved + amount <= self.budget or self.transient == 0
+
+    async def monitor(self, pid, group = True):
+        """ Sample the resident memory of a process (or the process group it leads) until cancelled, and account it to
+            the step being executed. The first samples are taken quickly, to catch short-lived processes as well. """
+        usage = self.USAGE.get()
+        if usage == None:
+            return
+        usage.processes += 1
+        interval = self.SAMPLE_INTERVAL / 8
+        try:
+            while True:
+                rss = await asyncio.to_thread(self.measureRss, pid, group)
+                if rss != None:
+                    usage.update(pid, rss)
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, self.SAMPLE_INTERVAL)
+        finally:
+            usage.remove(pid)
+
+    @staticmethod
+    def measureRss(pid, group = True):
+        """ Return the resident memory (in bytes) of a process, or of all processes in the process group it leads, or
+            None if it can't be determined. """
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        def readStat(stat_pid):
+            with open(f"/proc/{stat_pid}/stat") as f:
+                return f.read().rsplit(")", 1)[1].split()
+        try:
+            if not group:
+                return int(readStat(pid)[21]) * page_size
+            total = 0
+            for name in os.listdir("/proc"):
+                if name.isdigit():
+                    try:
+                        fields = readStat(name)
+                    except OSError: # The process has ended in the meantime
+                        continue
+                    if int(fields[2]) == pid: # The process group
+                        total += int(fields[21]) * page_size
+            return total
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def _getIgSize(self, engine_args):
+        """ Return the total size of the ig's in the engine arguments, as far as they can be found on disk. """
+        igs = tuple([engine_args[i + 1] for i in range(len(engine_args) - 1) if engine_args[i] == "-ig"])
+        if igs not in self.ig_sizes:
+            size = 0
+            for ig in igs:
+                if os.path.isdir(ig):
+                    size += self._getDirSize(ig)
+                elif os.path.isfile(ig):
+                    size += os.path.getsize(ig) * (self.COMPRESSION_RATIO if ig.endswith(".tgz") else 1)
+                else:
+                    # A package id, optionally with a version; take the largest installed version
+                    package_id, _, version = ig.partition("#")
+                    names = os.listdir(FHIR_PACKAGE_CACHE) if os.path.isdir(FHIR_PACKAGE_CACHE) else []
+                    names = [name for name in names if name == ig or (version == "" and name.startswith(package_id + "#"))]
+                    size += max([self._getDirSize(os.path.join(FHIR_PACKAGE_CACHE, name)) for name in names], default = 0)
+            self.ig_sizes[igs] = size
+        return self.ig_sizes[igs]
+
+    def _getDirSize(self, dir_path):
+        size = 0
+        for root, _, file_names in os.walk(dir_path):
+            for file_name in file_names:
+                try:
+                    size += os.path.getsize(os.path.join(root, file_name))
+                except OSError:
+                    pass
+        return size
+
+    async def _acquire(self, reservation):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.fits(reservation.amount))
+            self.reserved += reservation.amount
+            if not reservation.persistent:
+                self.transient += 1
+
+    async def _release(self, reservation):
+        async with self.condition:
+            self.reserved -= reservation.amount
+            if not reservation.persistent:
+                self.transient -= 1
+            self.condition.notify_all()
+
+class ValidatorDaemon:
+    """ A long-lived instance of the HL7 Validator, running in its HTTP server mode.
+
+        Each start of the Validator means booting the JVM and loading the FHIR core package and all ig's, which is
+        where most of the time of a validation step goes. The daemon loads this context once and then validates the
+        files of each step against it. The profile is passed along with each request, so switching profiles doesn't
+        require a reload. Only when the engine options (ig's, terminology and best practice settings) change, a new
+        daemon needs to be started.
+    """
+
+    STARTUP_TIMEOUT = 600 # Loading all ig's can take a while, so be lenient (in seconds)
+    SERVER_CLASS    = "org/hl7/fhir/validation/http/FhirValidatorHttpService.class"
+
+    def __init__(self, engine_args, governor, debug = False, base_heap = None):
+        self.engine_args = engine_args
+        self.governor    = governor
+        self.base_heap   = base_heap
+        self.debug       = debug
+        self.proc        = None
+        self.port        = None
+        self.reservation = None
+
+    @staticmethod
+    def isSupported():
+        """ Check if the installed Validator offers the HTTP server mode. Older versions don't, and we don't want to
+            pay for a JVM start just to find this out. """
+        try:
+            with zipfile.ZipFile(VALIDATOR_JAR) as jar:
+                jar.getinfo(ValidatorDaemon.SERVER_CLASS)
+            return True
+        except (OSError, KeyError, zipfile.BadZipFile):
+            return False
+
+    def isAlive(self):
+        return self.proc != None and self.proc.returncode == None
+
+    async def start(self):
+        """ Start the daemon and wait until it accepts requests. Returns False if the daemon couldn't be started. """
+        with TRACER.span("validator daemon start") as span:
+            started = await self._start()
+            span.set("started", started)
+        return started
+
+    async def _start(self):
+        # Let the OS pick a free port for us
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+
+        # The daemon holds on to its memory for as long as it's running
+        heap = self.governor.validatorHeap(0, self.engine_args, self.base_heap)
+        self.reservation = self.governor.reserve(self.governor.footprint(heap), persistent = True)
+        await self.reservation.acquire()
+
+        command = ["java"] + ResourceGovernor.javaOptions(heap) + ["-jar", VALIDATOR_JAR, "-version", "4.0.1"] + self.engine_args + ["-server", str(self.port)]
+        stdout = None if self.debug else subprocess.DEVNULL
+        self.proc = await asyncio.create_subprocess_exec(*command, stdout = stdout, stderr = subprocess.STDOUT)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.STARTUP_TIMEOUT
+        while loop.time() < deadline:
+            if not self.isAlive():
+                return False
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", self.port)
+                writer.close()
+                return True
+            except OSError:
+                await asyncio.sleep(0.5)
+
+        await self.stop()
+        return False
+
+    async def stop(self):
+        if self.isAlive():
+            self.proc.kill()
+            await self.proc.wait()
+        if self.reservation != None:
+            await self.reservation.release()
+
+    async def validate(self, files, profile, out_file):
+        """ Validate the files, optionally against the given profile, and write the results to out_file in the same
+            format as the Validator CLI does (a Bundle of OperationOutcomes).
+
+            Returns False when the daemon couldn't deliver a result for all files.
+        """
+        with TRACER.span("validator daemon request", files = len(files)) as span:
+            cpu_before, _ = self.getUsage()
+            monitor = asyncio.create_task(self.governor.monitor(self.proc.pid, group = False))
+            try:
+                validated = await self._validate(files, profile, out_file)
+            finally:
+                monitor.cancel()
+                await asyncio.gather(monitor, return_exceptions = True)
+            cpu_after, peak_rss = self.getUsage()
+            if cpu_before != None and cpu_after != None:
+                span.set("daemon_cpu", round(cpu_after - cpu_before, 3))
+                span.set("daemon_peak_rss", peak_rss)
+        return validated
+
+    def getUsage(self):
+        """ Return the CPU time used by the daemon so far (in seconds) and its peak memory usage (in bytes), or None
+            for what couldn't be determined. As the daemon keeps running, this is read from /proc. """
+        cpu, peak_rss = None, None
+        try:
+            with open(f"/proc/{self.proc.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK") # utime and stime
+            with open(f"/proc/{self.proc.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        peak_rss = int(line.split()[1]) * 1024
+        except (OSError, AttributeError, IndexError, ValueError):
+            pass
+        return cpu, peak_rss
+
+    async def _validate(self, files, profile, out_file):
+        params = {}
+        if profile is not None:
+            params["profiles"] = profile
+
+        outcomes = []
+        try:
+            async with aiohttp.ClientSession(f"http://127.0.0.1:{self.port}") as session:
+                for file_path in files:
+                    content_type = "application/fhir+json" if file_path.lower().endswith(".json") else "application/fhir+xml"
+                    with open(file_path, "rb") as f:
+                        body = f.read()
+                    async with session.post("/validateResource", params = params, data = body, headers = {
+                        "Content-Type": content_type,
+                        "Accept": "application/fhir+xml"
+                    }) as response:
+                        if response.status != 200:
+                            return False
+                        outcome = self._parseOutcome(await response.read())
+                    OutcomeBundle.setFile(outcome, file_path)
+                    outcomes.append(outcome)
+        except (aiohttp.ClientError, ET.ParseError, ValueError, OSError):
+            return False
+
+        OutcomeBundle.write(out_file, outcomes)
+        return True
+
+    def _parseOutcome(self, body):
+        """ Parse the OperationOutcome returned by the daemon into an XML element. We ask for XML, but we accept JSON
+            as well. """
+        if body.lstrip().startswith(b"{"):
+            resource = json.loads(body)
+            outcome = ET.Element(f"{{{FHIR_NS}}}{resource['resourceType']}")
+            for key, value in resource.items():
+                if key != "resourceType":
+                    self._jsonToXml(outcome, key, value)
+            return outcome
+        return ET.fromstring(body)
+
+    def _jsonToXml(self, parent, key, value):
+        """ Helper method to convert a (non-resource) FHIR JSON element to its XML representation. """
+        if key.startswith("_"): # Primitive extensions are of no interest for the outcome
+            return
+        if isinstance(value, list):
+            for item in value:
+                self._jsonToXml(parent, key, item)
+        elif isinstance(value, dict):
+            element = ET.SubElement(parent, f"{{{FHIR_NS}}}{key}")
+            # In XML, extensions come first and the id and extension url are attributes
+            for child_key, child_value in sorted(value.items(), key = lambda item: item[0] not in ("extension", "modifierExtension")):
+                if child_key == "id" or (child_key == "url" and key in ("extension", "modifierExtension")):
+                    element.set(child_key, child_value)
+                else:
+                    self._jsonToXml(element, child_key, child_value)
+        else:
+            if isinstance(value, bool):
+                value = "true" if value else "false"
+            ET.SubElement(parent, f"{{{FHIR_NS}}}{key}", value = str(value))
+
+class DaemonManager:
+    """ Keeps the Validator daemon around, to be shared by all steps and runs.
+
+        Only a single daemon is kept. When different engine arguments are needed, it's restarted, but not while it's
+        being used by another step; that step will fall back to a regular Validator run instead. Users of the daemon
+        should obtain it using acquire() and hand it back using release(), fail() or abandon().
+    """
+
+    # Stop trying to use the Validator daemon after it failed this many times
+    MAX_FAILURES = 2
+
+    def __init__(self, governor, base_heap = None):
+        self.governor  = governor
+        self.base_heap = base_heap # Of the daemon, in bytes
+        self.daemon   = None
+        self.failures = 0
+        self.users    = 0
+        self.lock     = asyncio.Lock()
+        self.reported = False # Whether it was reported that the Validator has no HTTP server mode
+
+    async def acquire(self, engine_args, printer, debug = False):
+        """ Get a running Validator daemon for the given engine arguments, (re)starting it if needed. Returns None if
+            no daemon can be used, in which case the caller should fall back to a regular Validator run. """
+        # Steps might run concurrently, so make sure only one of them manages the daemon at a time
+        async with self.lock:
+            if self.failures >= self.MAX_FAILURES:
+                return None
+            if not ValidatorDaemon.isSupported():
+                if debug and not self.reported:
+                    await printer.writeLine("The installed Validator has no HTTP server mode, so the Validator daemon isn't used.")
+                    self.reported = True
+                return None
+
+            if self.daemon != None and not self.daemon.isAlive():
+                await self._stop()
+            if self.daemon != None and self.daemon.engine_args != engine_args:
+                if self.users > 0:
+                    return None
+                await self._stop()
+
+            if self.daemon == None:
+                await printer.writeLine("\033[1;37mStarting the Validator daemon\033[0m")
+                daemon = ValidatorDaemon(engine_args, self.governor, debug, self.base_heap)
+                if not await daemon.start():
+                    await printer.writeLine("\033[0;33mThe Validator daemon could not be started, falling back to a regular Validator run.\033[0m")
+                    self.failures += 1
+                    await daemon.stop()
+                    return None
+                self.daemon = daemon
+
+            self.users += 1
+            return self.daemon
+
+    async def release(self, daemon):
+        """ Hand back a daemon after successful use. """
+        self.users -= 1
+
+    async def fail(self, daemon):
+        """ Hand back a daemon that died or misbehaved, which means it will be stopped. """
+        self.users -= 1
+        self.failures += 1
+        if daemon == self.daemon:
+            await self._stop()
+        else:
+            await daemon.stop()
+
+    async def abandon(self, daemon):
+        """ Hand back a daemon while the request to it is still being processed (because the step was cancelled).
+            If nobody else is using the daemon, it's stopped rather than letting it finish work nobody's waiting for. """
+        self.users -= 1
+        if daemon == self.daemon and self.users == 0:
+            await self._stop()
+
+    async def close(self):
+        if self.daemon != None:
+            await self._stop()
+
+    async def _stop(self):
+        daemon, self.daemon = self.daemon, None
+        await daemon.stop()
+
+class BuiltinCheck:
+    """ Base class for the checks that are built into this tool.
+
+        A check is run in-process over the files of a step. Subclasses implement checkFile(), which is called for each
+        file from a pool of worker threads, so it should only use its arguments and read no more of the file than
+        needed. Subclasses are made available under a name using the register() decorator; this name can then be used
+        as the "builtin" key of a step.
+    """
+
+    REGISTRY = {}
+
+    @staticmethod
+    def register(name):
+        def decorator(cls):
+            BuiltinCheck.REGISTRY[name] = cls
+            return cls
+        return decorator
+
+    def checkFile(self, file_path):
+        """ Check a single file and return a list of problems found (as messages). """
+        raise NotImplementedError
+
+    async def run(self, files, printer, debug = False):
+        """ Check all files and report the problems in the order of the files. Returns True if no problems were
+            found. """
+        loop = asyncio.get_running_loop()
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            results = await asyncio.gather(*[loop.run_in_executor(pool, self._checkFileSafely, file_path) for file_path in files])
+
+        success = True
+        for file_path, problems in zip(files, results):
+            if debug:
+                await printer.writeLine(f"Checking file {file_path}")
+            for problem in problems:
+                await printer.writeLine(problem)
+                success = False
+
+        if not success:
+            await printer.writeLine("\nSome invalid resources were found!")
+        else:
+            await printer.writeLine("No problems found")
+        return success
+
+    def _checkFileSafely(self, file_path):
+        try:
+            return self.checkFile(file_path)
+        except (OSError, ValueError, ET.ParseError) as e:
+            return [f"Resource {pathlib.PurePath(file_path)} could not be read: {e}"]
+
+@BuiltinCheck.register("check-id")
+class ResourceIdCheck(BuiltinCheck):
+    """ Check if Resource.id is present and matches the file name. For XML, only the start of the file is read, up to
+        the id. """
+
+    def checkFile(self, file_path):
+        pure_path = pathlib.PurePath(file_path)
+        if pure_path.suffix.lower() == ".json":
+            found, id = self._readJsonId(file_path)
+        elif pure_path.suffix.lower() == ".xml":
+            found, id = self._readXmlId(file_path)
+        else:
+            return []
+
+        if not found:
+            return [f"Resource {pure_path} has no .id"]
+        elif id != pure_path.stem:
+            return [f"Resource id doesn't match the file name in {pure_path}"]
+        return []
+
+    def _readXmlId(self, file_path):
+        """ Return a tuple of whether the root element has an id child, and the value of it. """
+        depth = 0
+        with open(file_path, "rb") as f:
+            for event, element in ET.iterparse(f, events = ("start", "end")):
+                if event == "start":
+                    depth += 1
+                    if depth == 2 and element.tag == f"{{{FHIR_NS}}}id":
+                        return True, element.get("value")
+                else:
+                    depth -= 1
+                    element.clear()
+        return False, None
+
+    def _readJsonId(self, file_path):
+        """ Return a tuple of whether the root object has an "id" key, and its value. """
+        with open(file_path, encoding = "utf-8-sig") as f:
+            resource = json.load(f)
+        if isinstance(resource, dict) and "id" in resource:
+            return True, resource["id"]
+        return False, None
+
+@BuiltinCheck.register("check-well-formed")
+class WellFormednessCheck(BuiltinCheck):
+    """ Check if a file is well-formed XML or JSON and contains a FHIR resource, optionally of one of the given
+        resource types. XML files are streamed through the parser without building the document. """
+
+    def __init__(self, resource_types = None):
+        self.resource_types = resource_types
+
+    def checkFile(self, file_path):
+        problem, resource_type = self.inspect(file_path)
+        if problem == None:
+            problem = self.checkResourceType(file_path, resource_type, self.resource_types)
+        return [problem] if problem != None else []
+
+    @staticmethod
+    def inspect(file_path):
+        """ Return a tuple of the problem with the file (or None if it's fine) and the resource type it contains. """
+        pure_path = pathlib.PurePath(file_path)
+        try:
+            if pure_path.suffix.lower() == ".xml":
+                resource_type = None
+                with open(file_path, "rb") as f:
+                    for event, element in ET.iterparse(f, events = ("start", "end")):
+                        if event == "start":
+                            if resource_type == None:
+                                namespace, _, name = element.tag[1:].partition("}") if element.tag.startswith("{") else ("", "", element.tag)
+                                if namespace != FHIR_NS:
+                                    return f"Resource {pure_path} doesn't contain a FHIR resource (the root element isn't in the FHIR namespace)", None
+                                resource_type = name
+                        else:
+                            element.clear()
+                return None, resource_type
+            elif pure_path.suffix.lower() == ".json":
+                with open(file_path, encoding = "utf-8-sig") as f:
+                    resource = json.load(f)
+                if not isinstance(resource, dict) or not isinstance(resource.get("resourceType"), str):
+                    return f"Resource {pure_path} doesn't contain a FHIR resource (there's no resourceType)", None
+                return None, resource["resourceType"]
+        except ET.ParseError as e:
+            return f"Resource {pure_path} is not well-formed XML: {e}", None
+        except ValueError as e: # Includes JSON and encoding errors
+            return f"Resource {pure_path} is not well-formed JSON: {e}", None
+        return None, None
+
+    @staticmethod
+    def checkResourceType(file_path, resource_type, resource_types):
+        """ Return the problem if the resource type isn't one of the expected resource types, or None. """
+        if resource_types != None and resource_type != None and resource_type not in resource_types:
+            return f"Resource {pathlib.PurePath(file_path)} has type {resource_type}, while only {', '.join(resource_types)} is expected here"
+        return None
+
+class FusedRun:
+    """ A single Validator run over the files of multiple steps that use the same profile and settings. The run is
+        started by the first of these steps that gets to execute, with its output going to that step; afterwards, each
+        step picks the outcomes for its own files from the result. The memory used by the run is tracked separately,
+        and reported with each of the steps. """
+
+    def __init__(self, executor, profile, step_names, files, shards = None, base_heap = None):
+        self.executor   = executor
+        self.profile    = profile
+        self.step_names = step_names
+        self.files      = files
+        self.shards     = shards
+        self.base_heap  = base_heap
+        self.usage      = ResourceGovernor.Usage()
+        self.task       = None
+
+    def start(self, printer):
+        """ Start the run if it isn't running yet, and return the task that produces the dict of file paths and their
+            outcomes (or None if the Validator failed). """
+        if self.task == None:
+            # Account the processes of the run to the run itself rather than to the step that happens to start it
+            context = contextvars.copy_context()
+            context.run(ResourceGovernor.USAGE.set, self.usage)
+            self.task = asyncio.create_task(self.executor._validateFused(self, printer), context = context)
+        return self.task
+
+    def cancel(self):
+        if self.task != None:
+            self.task.cancel()
+
+class Shards:
+    """ Support for splitting a run over multiple machines (like the nodes of a Github matrix build).
+
+        Each node executes the steps on its own part of the files, and writes the results per step to a JSON file in a
+        shared directory. Afterwards, these partial results are merged into the final result. The files are
+        partitioned by their size, which is the same on every node (unlike the timing history), so that every node
+        arrives at the same partitioning, balanced by the amount of content rather than by the number of files.
+    """
+
+    RESULTS = ["skipped", "success", "failure"] # In increasing order of precedence when merging
+
+    def __init__(self, index, count):
+        if count < 1 or index < 1 or index > count:
+            raise ValueError(f"Invalid shard {index}/{count}")
+        self.index = index
+        self.count = count
+
+    @staticmethod
+    def parse(value):
+        """ Parse a shard specification like "2/4" (the second of four shards). """
+        match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", value)
+        if not match:
+            raise ValueError(f"Invalid shard '{value}', expected something like 2/4")
+        return Shards(int(match.group(1)), int(match.group(2)))
+
+    def select(self, selection):
+        """ Return the part of the selection (a dict of pattern names and their files) that belongs to this shard. The
+            files are assigned to the shards in order of decreasing size (and by path for equal sizes), each time to
+            the shard with the lowest total size so far. """
+        assigned = set(CostStore.partition(self.getFiles(selection), self.count, self._fileSize)[self.index - 1])
+        return {pattern_name: [file_path for file_path in files if file_path in assigned] for pattern_name, files in selection.items()}
+
+    @staticmethod
+    def getFiles(selection):
+        """ Return the distinct files in the selection (a dict of pattern names and their files). """
+        return list(dict.fromkeys([file_path for files in selection.values() for file_path in files]))
+
+    def write(self, shard_dir, files, step_results):
+        """ Write the results of this shard: the files it checked and a dict of step names and their result
+            ("success", "failure" or "skipped"). """
+        os.makedirs(shard_dir, exist_ok = True)
+        path = os.path.join(shard_dir, f"shard-{self.index}-of-{self.count}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({"shard": self.index, "count": self.count, "files": sorted(files), "steps": step_results}, f, indent = 2)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    async def merge(shard_dir, selection, printer):
+        """ Combine the results of all shards in the directory and report them. A step fails if it failed on any
+            shard, and is skipped if it was skipped on all shards. Returns False if a step failed, or if the shards
+            didn't check each file of the selection (a dict of pattern names and their files) exactly once. """
+        partials = []
+        for path in sorted(glob.glob(os.path.join(shard_dir, "shard-*-of-*.json"))):
+            with open(path) as f:
+                partials.append(json.load(f))
+        if len(partials) == 0:
+            await printer.writeLine(f"\033[1;31mNo shard results found in {shard_dir}\033[0m")
+            return False
+
+        success  = True
+        count    = partials[0]["count"]
+        partials = [partial for partial in partials if partial["count"] == count] # Leftovers from another partitioning
+        missing  = sorted(set(range(1, count + 1)) - set(partial["shard"] for partial in partials))
+        if len(missing) > 0:
+            await printer.writeLine(f"\033[1;31mThe results of shard(s) {', '.join(str(i) for i in missing)} of {count} are missing\033[0m")
+            success = False
+
+        # The shards should have checked all files of the selection, each of them only once
+        checked = {}
+        for partial in partials:
+            for file_path in partial.get("files", []):
+                checked[file_path] = checked.get(file_path, 0) + 1
+        expected   = set(Shards.getFiles(selection))
+        duplicated = sorted(file_path for file_path, times in checked.items() if times > 1)
+        unchecked  = sorted(expected - set(checked)) if len(missing) == 0 else []
+        unexpected = sorted(set(checked) - expected)
+        for files, problem in [(duplicated, "were checked by more than one shard"), (unchecked, "weren't checked by any shard"), (unexpected, "were checked but aren't part of the selection")]:
+            if len(files) > 0:
+                await printer.writeLine(f"\033[1;31m{len(files)} file(s) {problem}, the shards didn't use the same files:\033[0m")
+                for file_path in files:
+                    await printer.writeLine(f"  {file_path}")
+                success = False
+
+        results = {}
+        for partial in sorted(partials, key = lambda partial: partial["shard"]):
+            for step_name, result in partial["steps"].items():
+                results[step_name] = max(results.get(step_name, "skipped"), result, key = Shards.RESULTS.index)
+
+        for step_name, result in results.items():
+            printer.writeGithubOutput(f"step[{step_name}][skipped]", "true" if result == "skipped" else "false")
+            if result == "skipped":
+                await printer.writeLine(f'\033[1;37mSkipped: "{step_name}"\033[0m')
+                continue
+            printer.writeGithubOutput(f"step[{step_name}][result]", result)
+            if result == "success":
+                await printer.writeLine(f'\033[1;32mPass: "{step_name}"\033[0m')
+            else:
+                await printer.writeLine(f'\033[1;31m"Fail: "{step_name}"\033[0m')
+                success = False
+        return success
+
+    @staticmethod
+    def _fileSize(file_path):
+        try:
+            return os.path.getsize(file_path)
+        except OSError:
+            return 0
+
+class CostStore:
+    """ Persistent record of how long steps and files take, stored in a SQLite database.
+
+        The durations are kept as a moving average over the last runs. The Validator doesn't report how long each file
+        takes, so the duration of each Validator invocation is divided over its files by size. This history is used to
+        balance the work over parallel Validator processes and shards, and to start the longest steps first.
+    """
+
+    SMOOTHING = 0.5 # The weight of the latest duration in the moving average
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS steps (name TEXT PRIMARY KEY, duration REAL, runs INTEGER, updated REAL);
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, duration REAL, runs INTEGER, updated REAL);
+        """)
+        self.file_costs = None # Cached by fileCost()
+        self.rate       = None # The average number of seconds per byte
+
+    def recordStep(self, step_name, duration):
+        with self.connection:
+            self.connection.execute("""
+                INSERT INTO steps (name, duration, runs, updated) VALUES (:name, :duration, 1, :now)
+                ON CONFLICT (name) DO UPDATE SET
+                    duration = duration * (1 - :smoothing) + excluded.duration * :smoothing,
+                    runs     = runs + 1,
+                    updated  = excluded.updated
+            """, {"name": step_name, "duration": duration, "now": time.time(), "smoothing": self.SMOOTHING})
+
+    def recordFiles(self, files, duration):
+        """ Record the duration of a Validator invocation on the files, divided over them by size. """
+        sizes = []
+        for file_path in files:
+            try:
+                sizes.append((file_path, os.path.getsize(file_path)))
+            except OSError:
+                pass
+        total_size = sum([size for _, size in sizes])
+        if total_size == 0:
+            return
+        with self.connection:
+            self.connection.executemany("""
+                INSERT INTO files (path, size, duration, runs, updated) VALUES (:path, :size, :duration, 1, :now)
+                ON CONFLICT (path) DO UPDATE SET
+                    size     = excluded.size,
+                    duration = duration * (1 - :smoothing) + excluded.duration * :smoothing,
+                    runs     = runs + 1,
+                    updated  = excluded.updated
+            """, [{"path": file_path, "size": size, "duration": duration * size / total_size, "now": time.time(), "smoothing": self.SMOOTHING} for file_path, size in sizes])
+        self.file_costs = None
+
+    def stepCost(self, step_name):
+        """ Return the average duration of the step, or 0 if it's not known. """
+        row = self.connection.execute("SELECT duration FROM steps WHERE name = ?", (step_name,)).fetchone()
+        return row[0] if row != None else 0
+
+    def fileCost(self, file_path):
+        """ Return the average duration of the file. For files without history, it's estimated from the size of the
+            file, using the average duration per byte of the known files. """
+        if self.file_costs == None:
+            self.file_costs = dict(self.connection.execute("SELECT path, duration FROM files").fetchall())
+            size, duration = self.connection.execute("SELECT SUM(size), SUM(duration) FROM files").fetchone()
+            self.rate = duration / size if size else 1e-6
+        if file_path in self.file_costs:
+            return self.file_costs[file_path]
+        try:
+            return os.path.getsize(file_path) * self.rate
+        except OSError:
+            return 0
+
+    def slowestSteps(self, limit):
+        """ Return the slowest steps as a list of tuples of the name, average duration and number of runs. """
+        return self.connection.execute("SELECT name, duration, runs FROM steps ORDER BY duration DESC LIMIT ?", (limit,)).fetchall()
+
+    def slowestFiles(self, limit):
+        """ Return the slowest files as a list of tuples of the path, average duration and number of runs. """
+        return self.connection.execute("SELECT path, duration, runs FROM files ORDER BY duration DESC LIMIT ?", (limit,)).fetchall()
+
+    @staticmethod
+    def partition(items, count, cost):
+        """ Divide the items into count groups with a total cost that is as equal as possible, by assigning them in
+            order of decreasing cost to the group with the lowest total cost so far (longest processing time first).
+            The outcome only depends on the items and their costs. """
+        groups = [[] for _ in range(count)]
+        totals = [0] * count
+        costs  = {item: cost(item) for item in items}
+        for item in sorted(costs, key = lambda item: (-costs[item], item)):
+            group = min(range(count), key = lambda i: (totals[i], i))
+            groups[group].append(item)
+            totals[group] += costs[item]
+        return groups
 
 class StepExecutor:
+    # Older versions implemented the builtin checks as scripts, which steps referred to using the "builtin-script" key
+    BUILTIN_SCRIPTS = {
+        "check-id.py": "check-id"
+    }
+
     BUILTIN_STEPS = {
         "check resource ids": {
             "description": "Check if the .id matches the name of the file",
-            "builtin-script": "check-id.py"
+            "builtin": "check-id"
         }
     }
 
+    # The minimum number of files that makes it worth starting an additional Validator process
+    MIN_FILES_PER_SHARD  = 25
+
+    # The maximum length of a line of output from a subprocess
+    LINE_LIMIT = 16 * 1024 * 1024
+
+    # The ways the files can be passed to a user script: as arguments, on stdin or in a file (one path per line)
+    FILE_LIST_PROTOCOLS = ["argv", "stdin", "file"]
+
     def __init__(self, config, file_collection, printer, fail_at, verbosity_level):
         if "steps" in config:
             self.steps = config["steps"]
@@ -211,6 +2369,9 @@ class StepExecutor:
             if "patterns" not in builtin_step: # Default to all patterns if not explicitly set
                 builtin_step["patterns"] = [pattern for pattern in file_collection.patterns]
             self.steps[builtin_step_name] = builtin_step
+        for step in self.steps.values():
+            if "builtin-script" in step and "builtin" not in step:
+                step["builtin"] = self.BUILTIN_SCRIPTS.get(step["builtin-script"], step["builtin-script"])
 
         self.tx_disabled            = False
         self.fail_at                = fail_at
@@ -219,10 +2380,18 @@ class StepExecutor:
         self.file_collection        = file_collection
         self.printer                = printer
 
+        # The number of steps that may be run concurrently
+        self.jobs = 1
+        if "jobs" in config:
+            if type(config["jobs"]) != int:
+                raise ValueError(f"Invalid value for 'jobs' in qa.yaml: {config['jobs']} (expected a number)")
+            self.jobs = max(1, config["jobs"])
+
         # By default, we handle the Nictiz profiling guidelines package. Additional ig's may be defined in the config file.
         self.igs = ["nictiz.fhir.nl.r4.profilingguidelines"]
         if "igs" in config:
             self.igs += [ig for ig in config["igs"]]
+        self.package_cache = None # When set, the ig's are passed to the Validator as pre-built packages
 
         self.ignored_issues = None
         if "ignored issues" in config:
@@ -230,9 +2399,63 @@ class StepExecutor:
 
         self.debug = False
 
+        # Validator steps that only differ in their files are combined into a single Validator run
+        self.fuse_steps = True
+
+        # Before starting the Validator, the files are checked for well-formedness. Files that aren't are left out of
+        # the Validator run, or, in fail-fast mode, the Validator isn't started at all.
+        self.preflight         = True
+        self.fail_fast         = False
+        self.preflight_results = {} # File path -> (mtime_ns, size, problem, resource type), re-used while unchanged
+
+        # The durations of previous runs are used to balance the work
+        self.cost_store = None
+
+        # When the run is split over multiple machines, only the files of this shard are checked
+        self.shards       = None
+        self.shard_files  = [] # The files of this shard, for the last run
+        self.step_results = {} # Step name -> "success", "failure" or "skipped", for the last run
+
+        # Processes are only started when they fit within the memory limits of the machine or container
+        memory_limit = None
+        if "memory limit" in config:
+            memory_limit = config["memory limit"] * ResourceGovernor.MB
+        self.governor = ResourceGovernor(memory_limit)
+        self.validator_heap = None # The base heap of the Validator in MB, if not the default of the governor
+        if "validator heap" in config:
+            self.validator_heap = config["validator heap"]
+
+        # The Validator daemon is started on first use and kept around for subsequent steps and runs
+        self.use_daemon       = True
+        self.daemons          = DaemonManager(self.governor, self.validator_heap * ResourceGovernor.MB if self.validator_heap != None else None)
+
+        # Results of previous Validator runs are re-used when nothing has changed
+        self.result_cache     = None
+        self.use_result_cache = True
+        self.cache_contexts   = {}
+        self.result_cache_size = ResultCache.DEFAULT_MAX_SIZE
+        if "result cache size" in config:
+            self.result_cache_size = config["result cache size"]
+
+        # Answers of the terminology server are cached across runs, using a local proxy in front of the server
+        self.tx_proxy         = None
+        self.tx_server        = TerminologyProxy.DEFAULT_SERVER
+        self.tx_cache_dir     = None
+        self.tx_cache_size    = TerminologyCache.DEFAULT_MAX_SIZE
+        self.tx_cache_max_age = TerminologyCache.DEFAULT_MAX_AGE
+        if "terminology server" in config:
+            self.tx_server = config["terminology server"]
+        if "terminology cache dir" in config:
+            self.tx_cache_dir = config["terminology cache dir"]
+        if "terminology cache size" in config:
+            self.tx_cache_size = config["terminology cache size"]
+        if "terminology cache max age" in config:
+            self.tx_cache_max_age = config["terminology cache max age"]
+
         self.script_src_dir = None
         if "script dir" in config:
             self.script_src_dir = config["script dir"]
+        self.script_state = {} # The (mtime, size) of each script as it was last synced
 
         # Export the variables for external scripts to use
         os.environ["tools_dir"]  = TOOLS_DIR
@@ -262,77 +2485,460 @@ class StepExecutor:
     def setBestPracticeWarnings(self, best_practice_warnings):
         self.best_practice_warnings = best_practice_warnings
 
-    async def execute(self, *step_names):
-        os.environ["debug"] = "1" if self.debug else "0"
-        os.environ["fail_at"] = self.fail_at
+    def setJobs(self, jobs):
+        self.jobs = max(1, jobs)
+
+    def setDaemonUsage(self, use_daemon):
+        self.use_daemon = use_daemon
+
+    def setStepFusion(self, fuse_steps):
+        self.fuse_steps = fuse_steps
+
+    def setPreflight(self, preflight, fail_fast = None):
+        self.preflight = preflight
+        if fail_fast != None:
+            self.fail_fast = fail_fast
+
+    def setCostStore(self, path):
+        """ Record the durations of steps and files in a CostStore at the given path, and use them for scheduling (or
+            don't if path is None). """
+        self.cost_store = CostStore(path) if path != None else None
+
+    def setShards(self, shards):
+        """ Only check the files of the given Shards object, or all files if shards is None. """
+        self.shards = shards
+
+    def setResultCache(self, cache_dir):
+        """ Enable the persistent result cache in the given directory (or disable it if cache_dir is None). """
+        if cache_dir == None:
+            self.result_cache = None
+        else:
+            self.result_cache = ResultCache(cache_dir, self.result_cache_size)
+
+    def setPackageCache(self, cache_dir):
+        """ Compile the ig directories into packages stored in the given directory (or pass them to the Validator
+            as-is if cache_dir is None). """
+        if cache_dir == None:
+            self.package_cache = None
+        else:
+            self.package_cache = PackageCache(cache_dir)
+
+    def setTerminologyCache(self, cache_dir, offline = False):
+        """ Cache the answers of the terminology server in the given directory (unless overridden in the config file),
+            or disable the cache if cache_dir is None. In offline mode, only the cache is used. """
+        if cache_dir == None:
+            self.tx_proxy = None
+        else:
+            if self.tx_cache_dir != None:
+                cache_dir = self.tx_cache_dir
+            cache = TerminologyCache(cache_dir, self.tx_cache_size, self.tx_cache_max_age)
+            self.tx_proxy = TerminologyProxy(cache, self.tx_server, offline)
+
+    async def warmTerminologyCache(self):
+        """ Refresh the outdated answers in the terminology cache. """
+        if self.tx_proxy != None and not self.tx_disabled:
+            await self.tx_proxy.warmUp(self.printer)
+
+    def setResultCacheUsage(self, use_result_cache):
+        """ Set whether the result cache should be used for the next run(s). When not used, results will still not be
+            stored. """
+        self.use_result_cache = use_result_cache
+
+    def fork(self, printer):
+        """ Return a copy of this executor to perform a run with its own Printer, FileCollection and options, so
+            that it can run alongside other runs. The copy shares the Validator daemon and the result cache with this
+            executor. """
+        executor = copy.copy(self)
+        executor.printer         = printer
+        executor.file_collection = copy.copy(self.file_collection)
+        return executor
+
+    async def close(self):
+        """ Release the resources held by this executor, like a running Validator daemon. """
+        await self.daemons.close()
+        if self.tx_proxy != None:
+            await self.tx_proxy.stop()
+
+    def getStepPatterns(self, step_name):
+        """ Return the list of pattern names used by a step. """
+        patterns = self.steps[step_name].get("patterns", [])
+        if type(patterns) == str:
+            patterns = [patterns]
+        return patterns
+
+    async def execute(self, *step_names, only_files = None):
+        """ Execute the given steps. Normally, the files to check are selected by the FileCollection, but they can
+            also be limited to an explicit set of paths using only_files. Returns False if one of the steps failed. """
+        with TRACER.span("sync scripts"):
+            self._syncScripts()
+        self.cache_contexts = {}
+
+        if only_files == None:
+            with TRACER.span("resolve files") as span:
+                await asyncio.to_thread(self.file_collection.resolve)
+                span.set("files", sum([len(files) for files in self.file_collection.values()]))
+            selection = self.file_collection
+        else:
+            selection = {pattern_name: [] for pattern_name in self.file_collection.patterns}
+            for file_path in sorted(only_files):
+                pattern_name = self.file_collection.matchFile(file_path)
+                if pattern_name != None and os.path.isfile(file_path):
+                    selection[pattern_name].append(file_path)
+        if self.shards != None:
+            selection = self.shards.select(selection)
+            self.shard_files = Shards.getFiles(selection)
+        self.step_results = {}
+
+        # Steps are independent of each other, so up to self.jobs steps are run concurrently. The output of each step
+        # is held back until all previous steps are done, so it's printed in the same order as in a sequential run.
+        # The steps that took the longest the previous times are started first.
+        rejected = await self._preflight(step_names, selection) if self.preflight else {}
+        semaphore = asyncio.Semaphore(self.jobs)
+        printers = [BufferedPrinter(self.printer) for _ in step_names]
+        fused_runs = {}
+        if self.fuse_steps and not (self.fail_fast and len(rejected) > 0):
+            fused_runs = self._planFusion(step_names, selection, rejected)
+        async def executeStep(step_name, printer):
+            async with semaphore:
+                return await self._executeStep(step_name, printer, selection, fused_runs.get(step_name), rejected)
+        order = list(range(len(step_names)))
+        if self.cost_store != None and self.jobs > 1:
+            order.sort(key = lambda i: -self.cost_store.stepCost(step_names[i]))
+        tasks = [None] * len(step_names)
+        for i in order:
+            tasks[i] = asyncio.create_task(executeStep(step_names[i], printers[i]))
 
-        self._copyScripts()
-        self.file_collection.resolve()
-    
         overall_success = True
-        for step_name in step_names:
-            step = self.steps[step_name]
-            
-            await self.printer.writeLine("\033[1;37m" + "#" * (len(step_name) + 10) + "\033[0m")
-            await self.printer.writeLine("\033[1;37m" + "#### " + step_name + " ####" + "\033[0m")
-            await self.printer.writeLine("\033[1;37m" + "#" * (len(step_name) + 10) + "\033[0m\n")
-            
-            files = []
-            if "patterns" in step:
-                patterns = step["patterns"]
-                if type(patterns) == str:
-                    patterns = [patterns]
-                for pattern in patterns:
-                    files += self.file_collection[pattern]
+        try:
+            for task, printer in zip(tasks, printers):
+                await printer.release()
+                overall_success &= await task
+        finally:
+            for task in tasks:
+                task.cancel()
+            for fused_run in fused_runs.values():
+                fused_run.cancel()
+            await asyncio.gather(*tasks, *[fused_run.task for fused_run in fused_runs.values() if fused_run.task != None], return_exceptions = True)
+
+        if self.result_cache != None:
+            self.result_cache.evict()
+        if self.package_cache != None:
+            self.package_cache.evict()
         
-            if len(files) == 0:
-                await self.printer.writeLine("\033[1;37mNothing to check, skipping\033[0m")
-                self.printer.writeGithubOutput(f"step[{step_name}][skipped]", "true")
+        return overall_success
+
+    async def _executeStep(self, step_name, printer, selection, fused_run = None, rejected = {}):
+        """ Execute a single step on the files in the selection (a dict of pattern names and their files), sending the
+            output to the provided printer. If the step is part of a FusedRun, the outcomes are taken from there.
+            Files that were rejected by the pre-flight check (a dict of steps, and the files and problems for it) are
+            reported but not validated. Returns False if the step failed. """
+        step = self.steps[step_name]
+        
+        await printer.writeLine("\033[1;37m" + "#" * (len(step_name) + 10) + "\033[0m")
+        await printer.writeLine("\033[1;37m" + "#### " + step_name + " ####" + "\033[0m")
+        await printer.writeLine("\033[1;37m" + "#" * (len(step_name) + 10) + "\033[0m\n")
+        
+        files = []
+        for pattern in self.getStepPatterns(step_name):
+            files += selection[pattern]
+    
+        success = True
+        if len(files) == 0:
+            await printer.writeLine("\033[1;37mNothing to check, skipping\033[0m")
+            printer.writeGithubOutput(f"step[{step_name}][skipped]", "true")
+            self.step_results[step_name] = "skipped"
+        else:
+            printer.writeGithubOutput(f"step[{step_name}][skipped]", "false")
+            if len(rejected) > 0 and "script" not in step and "builtin" not in step:
+                run = self._runPreflightedValidator(step, files, rejected.get(step_name, {}), printer, fused_run)
+            elif fused_run != None:
+                run = self._runFusedValidator(fused_run, files, printer)
+            elif "profile" in step:
+                run = self._runValidator(step["profile"], files, printer, step.get("shards"), self._getBaseHeap(step))
+            elif "script" in step:
+                run = self._runExternalCommand(step["script"], files, printer, step)
+            elif "builtin" in step:
+                run = self._runBuiltinCheck(step, files, printer)
             else:
-                self.printer.writeGithubOutput(f"step[{step_name}][skipped]", "false")
-                if "profile" in step:
-                    success = await self._runValidator(step["profile"], files)
-                elif "script" in step:
-                    success = await self._runExternalCommand(step["script"], files)
-                elif "builtin-script" in step:
-                    success = await self._runExternalCommand(step["builtin-script"], files, builtin = True)
-                else:
-                    success = await self._runValidator(None, files)
-                overall_success &= success
+                run = self._runValidator(None, files, printer, step.get("shards"), self._getBaseHeap(step))
+
+            # The memory used by the processes of this step is tracked by the governor
+            usage = ResourceGovernor.Usage()
+            ResourceGovernor.USAGE.set(usage)
+
+            # When the step times out, it is cancelled, which kills all the processes it started
+            start_time = time.monotonic()
+            with TRACER.span("step", step = step_name, files = len(files)) as span:
+                try:
+                    success = await asyncio.wait_for(run, step.get("timeout"))
+                except asyncio.TimeoutError:
+                    await printer.writeLine(f"\033[0;33mThe step took longer than {step['timeout']} seconds and has been aborted.\033[0m")
+                    success = False
+                span.set("success", success)
+                span.set("peak_rss", usage.peak)
+            TRACER.count("files_checked", len(files))
+            if self.cost_store != None:
+                self.cost_store.recordStep(step_name, time.monotonic() - start_time)
+
+            # Only report the memory usage of steps that started processes, not of builtin or cached steps. The
+            # processes of a fused run are shared by its steps, so they're reported with each of them.
+            peak = usage.peak if usage.processes > 0 else 0
+            if peak > 0:
+                await printer.writeLine(f"\n\033[1;37mPeak memory usage: {peak // ResourceGovernor.MB} MB\033[0m")
+            if fused_run != None and fused_run.usage.processes > 0 and fused_run.usage.peak > 0:
+                await printer.writeLine(f"\033[1;37mPeak memory usage of the single run for {', '.join(fused_run.step_names)}: {fused_run.usage.peak // ResourceGovernor.MB} MB\033[0m")
+                peak = max(peak, fused_run.usage.peak)
+            if peak > 0:
+                printer.writeGithubOutput(f"step[{step_name}][peak-rss]", str(peak))
+
+            if success:
+                await printer.writeLine(f'\n\033[1;32mPass: "{step_name}"\033[0m')
+            else:
+                await printer.writeLine(f'\n\033[1;31m"Fail: "{step_name}"\033[0m')
+            printer.writeGithubOutput(f"step[{step_name}][result]", "success" if success else "failure")
+            self.step_results[step_name] = "success" if success else "failure"
 
-                if success:
-                    await self.printer.writeLine(f'\n\033[1;32mPass: "{step_name}"\033[0m')
-                else:
-                    await self.printer.writeLine(f'\n\033[1;31m"Fail: "{step_name}"\033[0m')
-                self.printer.writeGithubOutput(f"step[{step_name}][result]", "success" if success else "failure")
+        await printer.writeLine("")
+        return success
 
-            await self.printer.writeLine("")
-        
-        return overall_success
+    async def _runBuiltinCheck(self, step, files, printer):
+        """ Run one of the checks that are built into this tool over the files. """
+        if step["builtin"] not in BuiltinCheck.REGISTRY:
+            await printer.writeLine(f"Unknown builtin check in qa.yaml: {step['builtin']} (known checks are {', '.join(sorted(BuiltinCheck.REGISTRY))})")
+            return False
+        check = BuiltinCheck.REGISTRY[step["builtin"]]
+        if "resource types" in step:
+            return await check(step["resource types"]).run(files, printer, self.debug)
+        return await check().run(files, printer, self.debug)
+
+    def _syncScripts(self):
+        """ Bring the copy of the scripts dir up to date, so that script files have their line endings normalized and
+            have the proper permissions for executing. Only files that changed since the last sync are rewritten;
+            files that look binary are copied as-is. """
+        os.makedirs(USER_SCRIPT_DIR, exist_ok = True)
+        src_dir = os.path.join(REPO_DIR, self.script_src_dir) if self.script_src_dir else None
+
+        seen = set()
+        if src_dir != None and os.path.isdir(src_dir):
+            for dir_path, dir_names, file_names in os.walk(src_dir):
+                dir_names[:] = sorted([name for name in dir_names if not name.startswith(".")])
+                rel_dir = os.path.relpath(dir_path, src_dir)
+                for file_name in file_names:
+                    if file_name.startswith("."):
+                        continue
+                    rel_path = os.path.normpath(os.path.join(rel_dir, file_name))
+                    seen.add(rel_path)
+                    self._syncScript(os.path.join(dir_path, file_name), rel_path)
+
+        # Remove whatever is no longer in the scripts dir
+        for dir_path, dir_names, file_names in os.walk(USER_SCRIPT_DIR, topdown = False):
+            rel_dir = os.path.relpath(dir_path, USER_SCRIPT_DIR)
+            for file_name in file_names:
+                rel_path = os.path.normpath(os.path.join(rel_dir, file_name))
+                if rel_path not in seen:
+                    os.unlink(os.path.join(dir_path, file_name))
+                    self.script_state.pop(rel_path, None)
+            if dir_path != USER_SCRIPT_DIR and len(os.listdir(dir_path)) == 0:
+                os.rmdir(dir_path)
+
+    def _syncScript(self, src_path, rel_path):
+        dst_path = os.path.join(USER_SCRIPT_DIR, rel_path)
+        src_stat = os.stat(src_path)
+        state = (src_stat.st_mtime_ns, src_stat.st_size)
+        if self.script_state.get(rel_path) == state and os.path.exists(dst_path):
+            return
+
+        with open(src_path, "rb") as src_file:
+            content = src_file.read()
+        if b"\0" not in content[:8192]:
+            content = content.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
 
-    def _copyScripts(self):
-        """ Create a fresh copy of the scripts dir so that script files have their line endings normalized and have
-            the proper permissions for executing. """
-        shutil.rmtree(USER_SCRIPT_DIR)
-        os.mkdir(USER_SCRIPT_DIR)
-        if (self.script_src_dir):
-            curr_dir = os.getcwd()
-            os.chdir(os.path.join(REPO_DIR, self.script_src_dir))
-            for file_name in glob.glob("*", recursive = False):
-                with open(file_name, "rt") as src_file:
-                    dst_path = os.path.join(USER_SCRIPT_DIR, file_name)
-                    with open(dst_path, "wt") as dest_file:
-                        for line in src_file.readlines():
-                            dest_file.write(line)
-                    os.chmod(dst_path, stat.S_IRUSR | stat.S_IXUSR)
-            os.chdir(curr_dir)
-
-    async def _runValidator(self, profile, files):
-        # Get a name for a temp file, but remove the file itself so we can check if the Validator produced the required
-        # output
+        try:
+            with open(dst_path, "rb") as dst_file:
+                unchanged = dst_file.read() == content
+        except OSError:
+            unchanged = False
+        if not unchanged:
+            # Write to a temporary file first, so a script that's running in a concurrent run isn't affected
+            os.makedirs(os.path.dirname(dst_path), exist_ok = True)
+            fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(dst_path), prefix = ".sync-")
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(content)
+            os.chmod(tmp_path, stat.S_IRUSR | stat.S_IXUSR)
+            os.replace(tmp_path, dst_path)
+        self.script_state[rel_path] = state
+
+    async def _preflight(self, step_names, selection):
+        """ Check the files of the Validator steps for well-formedness and the expected resource types, so that the
+            problems that would make the Validator choke or waste time are found quickly. Returns a dict of the step
+            names and the files that were rejected for that step, with the problem found. """
+        step_files = {}
+        for step_name in step_names:
+            step = self.steps[step_name]
+            if "script" in step or "builtin" in step:
+                continue
+            files = []
+            for pattern in self.getStepPatterns(step_name):
+                files += selection[pattern]
+            step_files[step_name] = self._expandFiles(files)
+
+        all_files = list(dict.fromkeys([file_path for files in step_files.values() for file_path in files]))
+        with TRACER.span("preflight", files = len(all_files)) as span:
+            loop = asyncio.get_running_loop()
+            with concurrent.futures.ThreadPoolExecutor() as pool:
+                results = await asyncio.gather(*[loop.run_in_executor(pool, self._inspectFile, file_path) for file_path in all_files])
+            results = dict(zip(all_files, results))
+
+            rejected = {}
+            for step_name, files in step_files.items():
+                resource_types = self.steps[step_name].get("resource types")
+                for file_path in files:
+                    problem, resource_type = results[file_path]
+                    if problem == None:
+                        problem = WellFormednessCheck.checkResourceType(file_path, resource_type, resource_types)
+                    if problem != None:
+                        rejected.setdefault(step_name, {})[file_path] = problem
+            span.set("rejected", len(set([file_path for files in rejected.values() for file_path in files])))
+        return rejected
+
+    def _inspectFile(self, file_path):
+        """ Return the problem (or None) and the resource type of a file, re-using the result of a previous run if the
+            file hasn't changed since. """
+        try:
+            file_stat = os.stat(file_path)
+        except OSError as e:
+            return f"Resource {pathlib.PurePath(file_path)} can't be read: {e.strerror}", None
+        cached = self.preflight_results.get(file_path)
+        if cached != None and cached[:2] == (file_stat.st_mtime_ns, file_stat.st_size):
+            return cached[2:]
+        try:
+            problem, resource_type = WellFormednessCheck.inspect(file_path)
+        except OSError as e:
+            return f"Resource {pathlib.PurePath(file_path)} can't be read: {e.strerror}", None
+        self.preflight_results[file_path] = (file_stat.st_mtime_ns, file_stat.st_size, problem, resource_type)
+        return problem, resource_type
+
+    async def _runPreflightedValidator(self, step, files, step_rejected, printer, fused_run = None):
+        """ Report the files of a Validator step that were rejected by the pre-flight check, and validate the other
+            files. In fail-fast mode, the Validator isn't run at all once the pre-flight check found a problem in any
+            step. """
+        for problem in step_rejected.values():
+            await printer.writeLine(f"\033[0;31m{problem}\033[0m")
+        if self.fail_fast:
+            await printer.writeLine("\033[0;33mThe Validator has been skipped, because the pre-flight check found problems.\033[0m")
+            return False
+
+        success = len(step_rejected) == 0
+        files = [file_path for file_path in self._expandFiles(files) if file_path not in step_rejected]
+        if len(files) > 0:
+            if fused_run != None:
+                success &= await self._runFusedValidator(fused_run, files, printer)
+            else:
+                success &= await self._runValidator(step.get("profile"), files, printer, step.get("shards"), self._getBaseHeap(step))
+        return success
+
+    def _planFusion(self, step_names, selection, rejected = {}):
+        """ Find the Validator steps that can share a single Validator run, because they use the same profile and
+            settings and only differ in the files they check. Files that were rejected by the pre-flight check for a
+            step are left out. Returns a dict of the names of these steps and the FusedRun they're part of. """
+        groups = {}
+        for step_name in step_names:
+            step = self.steps[step_name]
+            if "script" in step or "builtin" in step:
+                continue
+            files = []
+            for pattern in self.getStepPatterns(step_name):
+                files += selection[pattern]
+            if step_name in rejected:
+                files = [file_path for file_path in self._expandFiles(files) if file_path not in rejected[step_name]]
+            if len(files) == 0:
+                continue
+            key = (step.get("profile"), str(step.get("shards")), str(step.get("timeout")), str(self._getBaseHeap(step)))
+            groups.setdefault(key, []).append((step_name, files))
+
+        fused_runs = {}
+        for (profile, _, _, _), members in groups.items():
+            if len(members) < 2:
+                continue
+            files = []
+            for _, step_files in members:
+                files += self._expandFiles(step_files)
+            first_step = self.steps[members[0][0]]
+            fused_run = FusedRun(self, profile, [step_name for step_name, _ in members], list(dict.fromkeys(files)), first_step.get("shards"), self._getBaseHeap(first_step))
+            for step_name, _ in members:
+                fused_runs[step_name] = fused_run
+        return fused_runs
+
+    async def _validateFused(self, fused_run, printer):
+        """ Validate the files of a FusedRun, and return a dict of the file paths and their outcomes, or None if the
+            Validator failed. """
+        await printer.writeLine(f"\033[1;37mValidating {len(fused_run.files)} files for the steps {', '.join(fused_run.step_names)} in a single run\033[0m")
+        out_path = self._makeOutPath()
+        try:
+            if not await self._produceOutcomes(fused_run.profile, fused_run.files, out_path, printer, fused_run.shards, fused_run.base_heap):
+                return None
+            outcomes = {}
+            normalized = {os.path.abspath(file_path): file_path for file_path in fused_run.files}
+            for outcome in OutcomeBundle.read(out_path):
+                file_path = OutcomeBundle.getFile(outcome)
+                if file_path == None and len(fused_run.files) == 1:
+                    file_path = fused_run.files[0]
+                file_path = normalized.get(os.path.abspath(file_path)) if file_path != None else None
+                if file_path != None:
+                    outcomes[file_path] = outcome
+            return outcomes
+        finally:
+            if os.path.exists(out_path):
+                os.unlink(out_path)
+
+    async def _runFusedValidator(self, fused_run, files, printer):
+        """ Report on the files of a step using the outcomes of the FusedRun it's part of. """
+        # Shield the run from cancellation of this step, as other steps depend on it as well
+        outcomes = await asyncio.shield(fused_run.start(printer))
+        if outcomes == None:
+            if not self.debug:
+                await printer.writeLine("\033[0;33mThere was an error running the validator. Re-run with the --debug option to see the output.\033[0m")
+            return False
+
+        out_path = self._makeOutPath()
+        try:
+            OutcomeBundle.write(out_path, [outcomes[file_path] for file_path in self._expandFiles(files) if file_path in outcomes])
+            return await self._analyzeResults(out_path, printer)
+        finally:
+            if os.path.exists(out_path):
+                os.unlink(out_path)
+
+    def _makeOutPath(self):
+        """ Get a name for a temp file, but remove the file itself so we can check if the Validator produced the
+            required output. """
         out_file = tempfile.mkstemp(".xml")
+        os.close(out_file[0])
         os.unlink(out_file[1])
+        return out_file[1]
 
+    def _getBaseHeap(self, step):
+        """ Return the base heap (in bytes) for the Validator processes of a step, or None to use the default. """
+        validator_heap = step.get("validator heap", self.validator_heap)
+        return validator_heap * ResourceGovernor.MB if validator_heap != None else None
+
+    async def _runValidator(self, profile, files, printer, shards = None, base_heap = None):
+        out_path = self._makeOutPath()
+        try:
+            validated = await self._produceOutcomes(profile, files, out_path, printer, shards, base_heap)
+            success = False
+            if validated:
+                success = await self._analyzeResults(out_path, printer)
+            elif not self.debug:
+                await printer.writeLine("\033[0;33mThere was an error running the validator. Re-run with the --debug option to see the output.\033[0m")
+            return success
+        finally:
+            if os.path.exists(out_path):
+                os.unlink(out_path)
+
+    async def _produceOutcomes(self, profile, files, out_path, printer, shards = None, base_heap = None):
+        """ Validate the files against the profile (if any) and write the outcomes to out_path, taking the outcomes for
+            the files that didn't change since the last time from the result cache. Returns True if the Validator
+            produced its output. """
         # We're opiniated about terminology checking. We want to allow Dutch display values and we don't consider
         # display issues errors.
         tx_opt = ["-sct", "nl", "-display-issues-are-warnings"]
@@ -340,106 +2946,851 @@ class StepExecutor:
             tx_opt += ["-no-extensible-binding-warnings"]
         if self.tx_disabled:
             tx_opt += ["-tx", "n/a"]
+        elif self.tx_proxy != None:
+            tx_opt += ["-tx", await self.tx_proxy.start()]
+        elif self.tx_server != TerminologyProxy.DEFAULT_SERVER:
+            tx_opt += ["-tx", self.tx_server]
         best_practices_opt = ["-best-practice", "warning" if self.best_practice_warnings else "ignore"]
 
         igs = []
-        for ig in self.igs:
+        for ig in await self._getIgs():
             igs += ["-ig", ig]
-
+        engine_args = igs + tx_opt + best_practices_opt
+
+        # Look up the files we validated before with the same settings. Only the rest needs to go to the Validator.
+        use_cache = self.result_cache != None and self.use_result_cache
+        cached    = {}
+        keys      = {}
+        to_check  = files
+        if use_cache:
+            files = self._expandFiles(files)
+            # The address of the terminology proxy differs per run, but it's the actual server that matters
+            if self.tx_proxy != None:
+                context = self._getCacheContext([self.tx_proxy.server if arg == self.tx_proxy.url else arg for arg in engine_args])
+            else:
+                context = self._getCacheContext(engine_args)
+            for file_path in files:
+                keys[file_path] = self.result_cache.makeKey(context, profile, file_path)
+                outcome = self.result_cache.get(keys[file_path])
+                if outcome != None:
+                    cached[file_path] = outcome
+            to_check = [file_path for file_path in files if file_path not in cached]
+            if len(cached) > 0:
+                await printer.writeLine(f"\033[1;37mTaking the results for {len(cached)} of {len(files)} files from the result cache\033[0m")
+
+        validated = True
+        if len(to_check) > 0:
+            validated = await self._validate(profile, to_check, engine_args, out_path, printer, shards, base_heap)
+
+        if validated and use_cache:
+            # Store the fresh outcomes and combine them with the cached ones into a single report
+            outcomes = {}
+            if len(to_check) > 0:
+                normalized = {os.path.abspath(file_path): file_path for file_path in to_check}
+                for outcome in OutcomeBundle.read(out_path):
+                    file_path = OutcomeBundle.getFile(outcome)
+                    if file_path == None and len(to_check) == 1:
+                        file_path = to_check[0]
+                    file_path = normalized.get(os.path.abspath(file_path)) if file_path != None else None
+                    if file_path != None:
+                        outcomes[file_path] = outcome
+                        if ResultCache.isCacheable(outcome):
+                            self.result_cache.put(keys[file_path], outcome)
+            outcomes.update(cached)
+            OutcomeBundle.write(out_path, [outcomes[file_path] for file_path in files if file_path in outcomes])
+
+        return validated
+
+    async def _getIgs(self):
+        """ Return the ig's as they should be passed to the Validator. """
+        if self.package_cache == None:
+            return self.igs
+        with TRACER.span("ig packages"):
+            return await asyncio.to_thread(lambda: [self.package_cache.resolve(ig) for ig in self.igs])
+
+    async def _validate(self, profile, files, engine_args, out_path, printer, shards = None, base_heap = None):
+        """ Validate the files using the Validator daemon if possible, or using a regular Validator run otherwise. The
+            results are written to out_path. Returns True if the Validator produced its output. """
+        printer.startGithubGroup("Run validator")
+        try:
+            validated = False
+            daemon = None
+            if self.use_daemon:
+                daemon = await self.daemons.acquire(engine_args, printer, self.debug)
+            if daemon != None:
+                start_time = time.monotonic()
+                try:
+                    # Unlike the CLI, the daemon has no -recurse option, so it needs the individual files
+                    validated = await daemon.validate(self._expandFiles(files), profile, out_path)
+                except asyncio.CancelledError:
+                    await self.daemons.abandon(daemon)
+                    raise
+                if validated:
+                    await self.daemons.release(daemon)
+                    self._recordFileCosts(files, time.monotonic() - start_time)
+                else:
+                    # The daemon died or misbehaved halfway. Clean up and fall back to a regular Validator run.
+                    await printer.writeLine("\033[0;33mThe Validator daemon failed, falling back to a regular Validator run.\033[0m")
+                    await self.daemons.fail(daemon)
+                    if os.path.exists(out_path):
+                        os.unlink(out_path)
+
+            if not validated:
+                validated = await self._runValidatorCLI(profile, files, engine_args, out_path, printer, shards, base_heap)
+        finally:
+            printer.endGithubGroup()
+
+        return validated
+
+    async def _runValidatorCLI(self, profile, files, engine_args, out_path, printer, shards = None, base_heap = None):
+        """ Validate the files using one or more Validator processes. A single Validator process mostly uses only one
+            core, so large sets of files are split into shards that are validated in parallel, after which the results
+            are merged again. """
         if profile is not None:
             profile_flag = ["-profile", profile]
         else:
             profile_flag = []
-        command = [
-            "java", "-jar", "/tools/validator/validator.jar",
-            '-version', "4.0.1"] + igs + ["-recurse"] + profile_flag + tx_opt + best_practices_opt + [
-            "-output", out_file[1]] + files
-        
-        self.printer.startGithubGroup("Run validator")
-        if self.debug or self.printer.write_github:
+        if self.debug or printer.write_github:
             suppress_output = False
         else:
             suppress_output = True
-        await self._popen(command, suppress_output=suppress_output)
-        self.printer.endGithubGroup()
-        
-        success = False
-        if os.path.exists(out_file[1]):
-            fail_at         = "error" if self.fail_at == "fatal"         else self.fail_at
-            verbosity_level = "error" if self.verbosity_level == "fatal" else self.verbosity_level
-            command = ["python3", "/tools/hl7-fhir-validator-action/analyze_results.py",  "--colorize", "--fail-at", fail_at, "--verbosity-level", verbosity_level]
-            if printer.write_github:
-                command.append("--github")
-            if self.suppress_display_issues:
-                command.append("--suppress-display-issues")
-            if self.ignored_issues:
-                command += ["--ignored-issues", self.ignored_issues]
-            command += [out_file[1]]
-            result = await self._popen(command)
-            if result == 0:
-                success = True
-        elif not self.debug:
-            await self.printer.writeLine("\033[0;33mThere was an error running the validator. Re-run with the --debug option to see the output.\033[0m")
-        
-        os.unlink(out_file[1])
-        return success 
-  
-    async def _runExternalCommand(self, command, files, builtin = False):
-        if builtin:
-            script_dir = BUILTIN_SCRIPT_DIR
+
+        num_shards = self._getShardCount(shards, len(files), engine_args, base_heap)
+        if num_shards > 1:
+            files = self._expandFiles(files)
+            num_shards = min(num_shards, len(files))
+        if num_shards <= 1:
+            heap = self.governor.validatorHeap(len(self._expandFiles(files)), engine_args, base_heap)
+            command = ["java"] + ResourceGovernor.javaOptions(heap) + [
+                "-jar", VALIDATOR_JAR,
+                '-version', "4.0.1"] + engine_args + ["-recurse"] + profile_flag + [
+                "-output", out_path] + files
+            start_time = time.monotonic()
+            await self._popen(command, printer, suppress_output=suppress_output, memory = self.governor.footprint(heap))
+            if os.path.exists(out_path):
+                self._recordFileCosts(files, time.monotonic() - start_time)
+            return os.path.exists(out_path)
+
+        # Balance the shards by the expected duration of the files, so they finish at about the same time
+        if self.cost_store != None:
+            shard_files = CostStore.partition(files, num_shards, self.cost_store.fileCost)
         else:
-            if not self.script_src_dir:
-                await self.printer.writeLine("'script dir' is not set in qa.yaml!")
-                return False
-            script_dir = USER_SCRIPT_DIR
-        result = await self._popen(script_dir + "/" + command + " " + " ".join(files), shell = True)
+            shard_files = [files[i::num_shards] for i in range(num_shards)]
+
+        await printer.writeLine(f"\033[1;37mValidating {len(files)} files in {num_shards} shards\033[0m")
+        shard_paths    = [f"{out_path}.{i}.xml" for i in range(num_shards)]
+        shard_printers = [BufferedPrinter(printer) for _ in range(num_shards)]
+        async def validateShard(i):
+            heap = self.governor.validatorHeap(len(shard_files[i]), engine_args, base_heap)
+            command = ["java"] + ResourceGovernor.javaOptions(heap) + [
+                "-jar", VALIDATOR_JAR,
+                '-version', "4.0.1"] + engine_args + ["-recurse"] + profile_flag + [
+                "-output", shard_paths[i]] + shard_files[i]
+            start_time = time.monotonic()
+            await self._popen(command, shard_printers[i], suppress_output=suppress_output, memory = self.governor.footprint(heap))
+            if os.path.exists(shard_paths[i]):
+                self._recordFileCosts(shard_files[i], time.monotonic() - start_time)
+        tasks = [asyncio.create_task(validateShard(i)) for i in range(num_shards)]
+        try:
+            for task, shard_printer in zip(tasks, shard_printers):
+                await shard_printer.release()
+                await task
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+
+        # Merge the results of all shards into a single report, in the original file order. If one of the shards
+        # failed, the whole run fails.
+        validated = all([os.path.exists(shard_path) for shard_path in shard_paths])
+        if validated:
+            outcomes = []
+            for shard_path in shard_paths:
+                outcomes += OutcomeBundle.read(shard_path)
+            order = {os.path.abspath(file_path): i for i, file_path in enumerate(files)}
+            def position(outcome):
+                file_path = OutcomeBundle.getFile(outcome)
+                return order.get(os.path.abspath(file_path), len(order)) if file_path != None else len(order)
+            OutcomeBundle.write(out_path, sorted(outcomes, key = position))
+        for shard_path in shard_paths:
+            if os.path.exists(shard_path):
+                os.unlink(shard_path)
+        return validated
+
+    def _recordFileCosts(self, files, duration):
+        """ Record the duration of a Validator invocation on the files in the cost store, if there is one. """
+        if self.cost_store != None:
+            self.cost_store.recordFiles(self._expandFiles(files), duration)
+
+    def _getShardCount(self, shards, num_files, engine_args, base_heap = None):
+        """ Determine the number of shards to split a Validator run into. This can be set explicitly for a step;
+            otherwise it is based on the number of available cores (shared with the other concurrently running steps),
+            the available memory and the number of files. """
+        if shards != None and shards != "auto":
+            return max(1, int(shards))
+
+        cores = self.governor.cpus // self.jobs
+        if self.governor.budget == None:
+            by_memory = cores
+        else:
+            footprint = self.governor.footprint(self.governor.validatorHeap(self.MIN_FILES_PER_SHARD, engine_args, base_heap))
+            by_memory = self.governor.budget // (footprint * self.jobs)
+        by_files  = num_files // self.MIN_FILES_PER_SHARD
+        return max(1, min(cores, by_memory, by_files))
+
+    async def _analyzeResults(self, out_path, printer):
+        """ Analyze the Validator output, taking the ignored issues and level settings into account, and report on it.
+            Returns True if the check passes. """
+        fail_at         = "error" if self.fail_at == "fatal"         else self.fail_at
+        verbosity_level = "error" if self.verbosity_level == "fatal" else self.verbosity_level
+        command = ["python3", "/tools/hl7-fhir-validator-action/analyze_results.py",  "--colorize", "--fail-at", fail_at, "--verbosity-level", verbosity_level]
+        if printer.write_github:
+            command.append("--github")
+        if self.suppress_display_issues:
+            command.append("--suppress-display-issues")
+        if self.ignored_issues:
+            command += ["--ignored-issues", self.ignored_issues]
+        command += [out_path]
+        result = await self._popen(command, printer)
         return result == 0
 
-    async def _popen(self, command, shell = False, suppress_output = False):
-        ''' Helper method to open a subprocess, send the output to the Printer as it comes in, and return the results. '''
+    def _expandFiles(self, files):
+        """ Expand the directories in the list of files to the FHIR resources they contain, like the -recurse option of
+            the Validator does. """
+        expanded = []
+        for file_path in files:
+            if os.path.isdir(file_path):
+                for root, dir_names, file_names in os.walk(file_path):
+                    dir_names.sort()
+                    for file_name in sorted(file_names):
+                        if file_name.lower().endswith((".xml", ".json")):
+                            expanded.append(os.path.join(root, file_name))
+            else:
+                expanded.append(file_path)
+        return expanded
+
+    def _getCacheContext(self, engine_args):
+        """ Get the result cache context for the engine arguments. This is computed once per run, as it involves
+            fingerprinting the ig directories. """
+        key = tuple(engine_args)
+        if key not in self.cache_contexts:
+            self.cache_contexts[key] = self.result_cache.makeContext(engine_args, self.igs)
+        return self.cache_contexts[key]
+
+    async def _runExternalCommand(self, command, files, printer, step = {}):
+        """ Run a user script over the files. By default, the "script" setting is run as a shell command line with the
+            files appended to it. When the step has a "file list" or "chunk size" setting, the script is executed
+            directly, and the files are passed as arguments, on stdin or in a file, and they can be split into chunks
+            that are processed in parallel. The output of the chunks is printed in order, and the step fails if the
+            script fails for any of the chunks. """
+        if not self.script_src_dir:
+            await printer.writeLine("'script dir' is not set in qa.yaml!")
+            return False
+        file_list = step.get("file list", "argv")
+        if "file list" not in step and step.get("chunk size") == None:
+            file_list = None
+        elif file_list not in self.FILE_LIST_PROTOCOLS:
+            await printer.writeLine(f"Unknown value for 'file list': {file_list}")
+            return False
+
+        if step.get("chunk size") != None:
+            chunk_size = max(1, int(step["chunk size"]))
+            chunks = [files[i:i + chunk_size] for i in range(0, len(files), chunk_size)]
+        else:
+            chunks = [files]
+        parallel = step.get("parallel", "auto")
+        if parallel == "auto":
+            parallel = self.governor.cpus // self.jobs
+        semaphore = asyncio.Semaphore(max(1, int(parallel)))
+
+        chunk_printers = [BufferedPrinter(printer) for _ in chunks]
+        memory = step["memory"] * ResourceGovernor.MB if "memory" in step else ResourceGovernor.SCRIPT_MEMORY
+        async def runChunk(chunk, chunk_printer):
+            async with semaphore:
+                return await self._runScript(command, chunk, file_list, chunk_printer, memory)
+        tasks = [asyncio.create_task(runChunk(chunk, chunk_printer)) for chunk, chunk_printer in zip(chunks, chunk_printers)]
+
+        success = True
+        try:
+            for task, chunk_printer in zip(tasks, chunk_printers):
+                await chunk_printer.release()
+                success &= await task
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+        return success
+
+    async def _runScript(self, command, files, file_list, printer, memory = 0):
+        """ Run a user script once over the given files, passing them according to the file list protocol. If
+            file_list is None, the command is interpreted by the shell, with the (quoted) files appended to it;
+            otherwise the script is executed directly, so file names are passed on as-is. The given amount of memory
+            is reserved for it. """
+        input = None
+        list_path = None
+        if file_list == None:
+            args = ["/bin/sh", "-c", " ".join([f"{USER_SCRIPT_DIR}/{command}"] + [shlex.quote(file_path) for file_path in files])]
+        else:
+            args = shlex.split(command)
+            args[0] = os.path.join(USER_SCRIPT_DIR, args[0])
+        if file_list == "argv":
+            args += files
+        elif file_list == "stdin":
+            input = "".join([file_path + "\n" for file_path in files]).encode("UTF-8")
+        elif file_list == "file":
+            fd, list_path = tempfile.mkstemp(suffix = ".txt")
+            with os.fdopen(fd, "w", encoding = "UTF-8") as list_file:
+                list_file.writelines([file_path + "\n" for file_path in files])
+            args.append(list_path)
+
+        try:
+            try:
+                result = await self._popen(args, printer, input = input, memory = memory)
+            except OSError as e:
+                if e.errno == errno.ENOEXEC:
+                    # A script without a shebang, which a shell would interpret as a shell script
+                    result = await self._popen(["/bin/sh"] + args, printer, input = input, memory = memory)
+                elif e.errno == errno.E2BIG:
+                    await printer.writeLine("\033[0;33mThere are too many files to pass to the script as arguments. Use the 'chunk size' or 'file list' settings for this step.\033[0m")
+                    return False
+                else:
+                    await printer.writeLine(f"\033[0;33mThe script could not be executed: {e}\033[0m")
+                    return False
+        finally:
+            if list_path != None:
+                os.unlink(list_path)
+        return result == 0
+
+    async def _popen(self, command, printer, suppress_output = False, input = None, memory = 0):
+        ''' Helper method to open a subprocess, send the output to the Printer as it comes in, and return the results.
+            If input is given (as bytes), it's written to the stdin of the subprocess. If memory is given (in bytes), the
+            subprocess isn't started until that amount of memory is available.
+            The subprocess gets its own process group, so when we're cancelled, the whole process tree (e.g. a shell
+            and the JVM it started) is killed. '''
         if suppress_output:
-            stdout = subprocess.DEVNULL
+            stdout = asyncio.subprocess.DEVNULL
         else:
-            stdout = subprocess.PIPE
-        proc = subprocess.Popen(command, stdout = stdout, stderr = subprocess.STDOUT, universal_newlines = True, bufsize = 1, shell = shell)
-        
-        if not suppress_output:
-            while True:
-                line = proc.stdout.readline()
-                if not line:
-                    break
-                await self.printer.write(line)
-        proc.wait()
+            stdout = asyncio.subprocess.PIPE
+        stdin = None if input == None else asyncio.subprocess.PIPE
+
+        # Export the settings of this run for external scripts to use. Runs might be executed concurrently, so these
+        # are passed to the subprocess rather than set globally.
+        env = dict(os.environ)
+        env["debug"]   = "1" if self.debug else "0"
+        env["fail_at"] = self.fail_at
+
+        with TRACER.span("subprocess", command = os.path.basename(command[0]) if command[0] != "java" else "validator") as span:
+            if not self.governor.fits(memory):
+                await printer.writeLine("\033[1;37mWaiting for memory to become available\033[0m")
+                TRACER.count("processes_queued")
+            queue_time = time.monotonic()
+            async with self.governor.reserve(memory):
+                span.set("queued", round(time.monotonic() - queue_time, 6))
+                returncode = await self._runProcess(command, printer, stdout, stdin, env, input, suppress_output)
+            span.set("returncode", returncode)
+        return returncode
+
+    async def _runProcess(self, command, printer, stdout, stdin, env, input, suppress_output):
+        proc = await asyncio.create_subprocess_exec(*command, stdin = stdin, stdout = stdout, stderr = asyncio.subprocess.STDOUT,
+                                                    start_new_session = True, limit = self.LINE_LIMIT, env = env)
+
+        monitor = asyncio.create_task(self.governor.monitor(proc.pid))
+
+        # Feed the input while reading the output, so neither side can block the other
+        feeder = None
+        if input != None:
+            async def feed():
+                try:
+                    proc.stdin.write(input)
+                    await proc.stdin.drain()
+                except ConnectionError: # The subprocess doesn't read all of its input
+                    pass
+                finally:
+                    proc.stdin.close()
+            feeder = asyncio.create_task(feed())
+
+        try:
+            if not suppress_output:
+                while True:
+                    try:
+                        line = await proc.stdout.readline()
+                    except ValueError: # Line exceeds the limit; it has been discarded, so just carry on
+                        continue
+                    if not line:
+                        break
+                    await printer.write(line.decode("UTF-8", errors = "replace"))
+            await proc.wait()
+            if feeder != None:
+                await feeder
+        except asyncio.CancelledError:
+            self._killProcessTree(proc)
+            await proc.wait()
+            if feeder != None:
+                feeder.cancel()
+            raise
+        finally:
+            monitor.cancel()
+            await asyncio.gather(monitor, return_exceptions = True)
         return proc.returncode
 
+    def _killProcessTree(self, proc):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+class Watcher:
+    """ Watch the repo for changes and re-run the affected steps on only the changed files.
+
+        Changes are collected until the repo has been quiet for a while, so a burst of saves (or a git checkout) leads
+        to a single run over all changed files. Changes that come in during a run are handled in a next run.
+    """
+
+    POLL_INTERVAL = 0.5 # In seconds
+    SETTLE_TIME   = 1.0 # In seconds
+
+    def __init__(self, executor, step_names, on_start = None, on_result = None):
+        self.executor    = executor
+        self.step_names  = list(step_names)
+        self.on_start    = on_start
+        self.on_result   = on_result
+        self.pending     = set()
+        self.last_change = 0
+        self.runner      = None
+
+    async def watch(self):
+        """ Watch the repo indefinitely. """
+        file_collection = self.executor.file_collection
+        if not FileIndex.isSupported(file_collection):
+            await self.executor.printer.writeLine("\033[0;33mWatch mode is not supported for patterns outside the repository.\033[0m")
+            return
+        if file_collection.index == None:
+            file_collection.setIndex(await asyncio.to_thread(FileIndex, file_collection))
+        await self.executor.printer.writeLine("\033[1;37mWatching for changes\033[0m")
+        await file_collection.index.poll(self.onChange, self.POLL_INTERVAL)
+
+    async def onChange(self, changed):
+        self.pending |= changed
+        self.last_change = asyncio.get_running_loop().time()
+        if self.runner == None or self.runner.done():
+            self.runner = asyncio.create_task(self._settleAndRun())
+
+    async def _settleAndRun(self):
+        loop = asyncio.get_running_loop()
+        while len(self.pending) > 0:
+            # Wait until no new changes have come in for a while
+            while loop.time() - self.last_change < self.SETTLE_TIME:
+                await asyncio.sleep(self.SETTLE_TIME - (loop.time() - self.last_change))
+
+            files = set([path for path in self.pending if os.path.isfile(path)])
+            self.pending = set()
+
+            # Only run the steps that cover at least one of the changed files
+            pattern_names = set([self.executor.file_collection.matchFile(path) for path in files]) - set([None])
+            step_names = [step_name for step_name in self.step_names if len(pattern_names.intersection(self.executor.getStepPatterns(step_name))) > 0]
+            if len(step_names) == 0:
+                continue
+
+            if self.on_start != None:
+                await self.on_start()
+            await self.executor.printer.writeLine(f"\033[1;37mChanged: {', '.join(sorted(files))}\033[0m\n")
+            result = await self.executor.execute(*step_names, only_files = files)
+            if self.on_result != None:
+                await self.on_result(result)
+
+class RunLog:
+    """ Record of the (HTML formatted) output of a single run, so it can be followed from any number of web sockets,
+        including ones that connect halfway through or reconnect after losing their connection.
+
+        Output is kept in chunks, each with the offset of its first character in the total output of the run. Only the
+        last MAX_SIZE characters are retained; followers that lag further behind will miss part of the output.
+    """
+
+    MAX_SIZE = 4 * 1024 * 1024
+
+    def __init__(self):
+        self.chunks  = []
+        self.offsets = []
+        self.size    = 0
+        self.end     = 0     # The offset of the end of the output
+        self.started = False
+        self.result  = None  # Either "success", "failure" or "cancelled" when the run has finished
+        self.updated = asyncio.Event()
+
+    @property
+    def finished(self):
+        return self.result != None
+
+    @property
+    def first_offset(self):
+        """ The offset of the first character that is still retained. """
+        return self.offsets[0] if len(self.offsets) > 0 else self.end
+
+    def append(self, html):
+        """ Add a chunk of output. """
+        if html == "":
+            return
+        self.chunks.append(html)
+        self.offsets.append(self.end)
+        self.end  += len(html)
+        self.size += len(html)
+
+        # Drop the oldest chunks when we're over the limit, but always keep the last one
+        num_dropped = 0
+        while self.size > self.MAX_SIZE and num_dropped < len(self.chunks) - 1:
+            self.size -= len(self.chunks[num_dropped])
+            num_dropped += 1
+        if num_dropped > 0:
+            del self.chunks[:num_dropped]
+            del self.offsets[:num_dropped]
+        self._notify()
+
+    def start(self):
+        self.started = True
+        self._notify()
+
+    def finish(self, result):
+        self.result = result
+        self._notify()
+
+    def read(self, offset, max_size):
+        """ Return the output from the given offset onwards, up to about max_size characters (but at least one chunk
+            if there's output available). Returns a tuple of the output, the offset after it and whether output was
+            lost because the offset was no longer retained. """
+        lost = offset < self.first_offset
+        offset = min(max(offset, self.first_offset), self.end)
+        if offset == self.end:
+            return "", self.end, lost
+
+        index = bisect.bisect_right(self.offsets, offset) - 1
+        parts = [self.chunks[index][offset - self.offsets[index]:]]
+        size = len(parts[0])
+        index += 1
+        while index < len(self.chunks) and size + len(self.chunks[index]) <= max_size:
+            parts.append(self.chunks[index])
+            size += len(self.chunks[index])
+            index += 1
+        return "".join(parts), offset + size, lost
+
+    async def waitForUpdate(self):
+        await self.updated.wait()
+
+    def _notify(self):
+        """ Wake up all followers, and set up a fresh Event for the next update. """
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+class Job:
+    """ A run of a number of steps, as requested using the web interface (or started by watch mode).
+
+        The options for the run are taken as a snapshot when the job is created, so changes made for later jobs don't
+        affect it while it's waiting in the queue or running.
+    """
+
+    def __init__(self, job_id, steps, options, watch = False):
+        self.job_id   = job_id
+        self.steps    = list(steps)
+        self.options  = types.MappingProxyType(dict(options))
+        self.watch    = watch
+        self.log      = RunLog()
+        self.task     = None
+        self.created  = time.time()
+        self.started  = None
+        self.finished = None
+
+    @property
+    def status(self):
+        """ Either "queued", "running", "success", "failure" or "cancelled". """
+        if self.log.finished:
+            return self.log.result
+        return "running" if self.log.started else "queued"
+
+    def start(self):
+        self.started = time.time()
+        self.log.start()
+
+    def finish(self, result):
+        self.finished = time.time()
+        self.log.finish(result)
+
+    def describe(self):
+        """ Return a summary of the job for the API. """
+        return {
+            "id":       self.job_id,
+            "steps":    self.steps,
+            "status":   self.status,
+            "watch":    self.watch,
+            "options":  dict(self.options),
+            "created":  self.created,
+            "started":  self.started,
+            "finished": self.finished
+        }
+
 class QAServer:
     ''' Class to serve an interactive menu using a web interface. '''
 
-    def __init__(self, executor):
-        self.executor = executor
+    MAX_JOBS   = 10        # The number of finished jobs that are kept (including their output)
+    FRAME_SIZE = 64 * 1024 # The maximum size of the output sent in a single web socket message
 
-        self.app = web.Application()
-        self.app.router.add_get("/ws",              self._handleWebsocket)
-        self.app.router.add_get("/",                self._handleGet)
-        self.app.router.add_post("/file_selection", self._getFileSelection)
-        self.app.router.add_get("/{file}",          self._handleGet)
-        self.app.router.add_post("/",               self._handlePost)
+    def __init__(self, executor, watch_steps = None, workers = 1, warm_tx_cache = False):
+        self.executor      = executor
+        self.watch_steps   = watch_steps
+        self.workers       = max(1, workers)
+        self.warm_tx_cache = warm_tx_cache
 
-        self.ws = web.WebSocketResponse()
+        self.app = web.Application()
+        self.app.router.add_get("/ws",                       self._handleWebsocket)
+        self.app.router.add_get("/",                         self._handleGet)
+        self.app.router.add_post("/file_selection",          self._getFileSelection)
+        self.app.router.add_get("/jobs",                     self._listJobs)
+        self.app.router.add_get("/jobs/{job_id}",            self._getJob)
+        self.app.router.add_post("/jobs/{job_id}/cancel",    self._cancelJob)
+        self.app.router.add_get("/metrics",                  self._getMetrics)
+        self.app.router.add_get("/{file}",                   self._handleGet)
+        self.app.router.add_post("/",                        self._handlePost)
+        self.app.on_startup.append(self._startup)
+        self.app.on_cleanup.append(self._cleanup)
+
+        # Jobs are queued and picked up by a number of workers, each executing one job at a time
+        self.jobs         = {}
+        self.next_job_id  = 1
+        self.jobs_updated = asyncio.Event()
+        self.queue        = asyncio.Queue()
+        self.worker_tasks = []
+
+        self.sockets      = set()
+        self.index_poller = None
     
     def run(self):
         web.run_app(self.app, port = MENU_PORT)
 
+    async def _startup(self, app):
+        """ Keep an index of the files in the repo, so the file selection can be answered without looking at the
+            file system each time. """
+        file_collection = self.executor.file_collection
+        if FileIndex.isSupported(file_collection):
+            file_collection.setIndex(await asyncio.to_thread(FileIndex, file_collection))
+            if self.watch_steps == None:
+                self.index_poller = asyncio.create_task(file_collection.index.poll())
+            else:
+                # In watch mode, the index is polled more often and changes lead to a new run
+                watcher = Watcher(self.executor, self.watch_steps, self._reportWatchStart, self._reportWatchResult)
+                self.index_poller = asyncio.create_task(watcher.watch())
+
+        self.worker_tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        if self.warm_tx_cache:
+            self.worker_tasks.append(asyncio.create_task(self.executor.warmTerminologyCache()))
+
+    async def _cleanup(self, app):
+        if self.index_poller != None:
+            self.index_poller.cancel()
+        for worker_task in self.worker_tasks:
+            worker_task.cancel()
+        running = [job.task for job in self.jobs.values() if job.task != None and not job.task.done()]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions = True)
+        for ws in list(self.sockets):
+            await ws.close()
+        await self.executor.close()
+
     async def _handleWebsocket(self, request):
-        ''' Create and return a websocket when getting a GET request on /ws '''
-        if self.ws.closed:
-            self.ws = web.WebSocketResponse()
-        await self.ws.prepare(request)
+        ''' Create and return a websocket when getting a GET request on /ws. The socket follows the job in progress
+            (if any) and all jobs after it. A client that lost its connection can pick up where it left off using the
+            "job" and "offset" query parameters, which it gets with each message. '''
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        try:
+            job_id = int(request.query["job"]) if "job" in request.query else None
+            offset = int(request.query.get("offset", 0))
+        except ValueError:
+            job_id, offset = None, 0
+
+        self.sockets.add(ws)
+        follower = asyncio.create_task(self._followJobs(ws, job_id, offset))
+        try:
+            # We don't actually expect communication _from_ the socket, but this is the way to keep it open
+            async for message in ws:
+                pass
+        finally:
+            follower.cancel()
+            self.sockets.discard(ws)
+
+        return ws
+
+    async def _followJobs(self, ws, job_id, offset):
+        """ Send the output of the given job from the given offset onwards over the web socket, followed by all later
+            jobs. If no job is given, start with the first job that hasn't finished, or otherwise the next one. """
+        if job_id == None:
+            unfinished = [job.job_id for job in self.jobs.values() if not job.log.finished]
+            job_id = unfinished[0] if len(unfinished) > 0 else self.next_job_id
+
+        while True:
+            if job_id not in self.jobs:
+                if job_id >= self.next_job_id:
+                    # Wait for the job to be created
+                    await self.jobs_updated.wait()
+                else:
+                    # The job is no longer available, so skip to the oldest job we still have
+                    job_id = min([id for id in self.jobs if id > job_id], default = self.next_job_id)
+                    offset = 0
+                continue
+
+            job = self.jobs[job_id]
+            while job.status == "queued":
+                await job.log.waitForUpdate()
+
+            if job.log.started:
+                await ws.send_json({"status": "running", "job": job_id, "watch": job.watch})
+            while True:
+                output, next_offset, lost = job.log.read(offset, self.FRAME_SIZE)
+                if lost:
+                    output = "<span style='color: orange;'>[Part of the output of this run is no longer available]</span>\n" + output
+                if output != "":
+                    with TRACER.span("websocket send", size = len(output)):
+                        await ws.send_json({"output": output, "job": job_id, "offset": next_offset})
+                    offset = next_offset
+                elif job.log.finished:
+                    await ws.send_json({"result": job.log.result, "job": job_id})
+                    break
+                else:
+                    await job.log.waitForUpdate()
+
+            job_id += 1
+            offset = 0
+
+    def _addJob(self, steps, options, watch = False):
+        """ Register a new job. """
+        job = Job(self.next_job_id, steps, options, watch)
+        self.jobs[job.job_id] = job
+        self.next_job_id += 1
+
+        # Forget about the oldest finished jobs
+        finished = [job_id for job_id in self.jobs if self.jobs[job_id].log.finished]
+        for job_id in finished[:max(0, len(self.jobs) - self.MAX_JOBS)]:
+            del self.jobs[job_id]
+
+        self.jobs_updated.set()
+        self.jobs_updated = asyncio.Event()
+        return job
+
+    async def _work(self):
+        """ Take jobs from the queue and execute them, one at a time. """
+        while True:
+            job = await self.queue.get()
+            if job.status != "queued": # Cancelled while waiting in the queue
+                continue
+            job.task = asyncio.create_task(self._executeJob(job))
+            await asyncio.wait([job.task])
+
+    async def _executeJob(self, job):
+        """ Execute a job using its own copy of the executor, set up according to the options of the job. """
+        executor = self.executor.fork(Printer(self.executor.printer.write_github))
+        options = job.options
+        executor.file_collection.setMode(FileCollection.Mode[options["mode"].upper()], options["filters"])
+        executor.setTerminologyOptions(disabled = options["tx_disabled"],
+                                       extensible_binding_warnings = options["extensible_binding_warnings"],
+                                       suppress_display_issues = options["suppress_display_issues"])
+        executor.setLevels(verbosity = options["verbosity_level"], fail_at = options["fail_at"])
+        executor.setBestPracticeWarnings(options["best_practice_warnings"])
+        executor.setDebugging(options["debug"])
+        executor.setResultCacheUsage(options["use_result_cache"])
+        executor.printer.setRunLog(job.log)
+
+        job.start()
+        result = "failure"
+        try:
+            if await executor.execute(*job.steps):
+                result = "success"
+        except asyncio.CancelledError:
+            # Cancelling the execution kills all subprocesses it started
+            result = "cancelled"
+            await executor.printer.writeLine("\n\033[0;33mThe run has been cancelled.\033[0m")
+        finally:
+            await executor.printer.flush()
+            job.finish(result)
+
+    def _getOptions(self, content = None):
+        """ Take a snapshot of the options for a job. These are the current settings of the executor, overridden by
+            the values in the submitted form content (if any). """
+        executor = self.executor
+        options = {
+            "mode":                        executor.file_collection.mode.name.lower(),
+            "filters":                     None,
+            "tx_disabled":                 executor.tx_disabled,
+            "extensible_binding_warnings": executor.extensible_binding_warnings,
+            "suppress_display_issues":     executor.suppress_display_issues,
+            "verbosity_level":             executor.verbosity_level,
+            "fail_at":                     executor.fail_at,
+            "best_practice_warnings":      executor.best_practice_warnings,
+            "debug":                       executor.debug,
+            "use_result_cache":            executor.use_result_cache
+        }
+        if content == None:
+            return options
 
-        # We don't actually expect communication _from_ the socket, but this is the way to keep it open
-        await self.ws.receive()
+        if content.get("check_what") in ["all", "changed", "filtered"]:
+            options["mode"] = content["check_what"]
+            if options["mode"] == "filtered":
+                options["filters"] = content.get("file_name_filters", "").split(",")
 
-        return self.ws
+        if "terminology" in content:
+            if content["terminology"] == "disabled":
+                options["tx_disabled"] = True
+            elif content["terminology"] == "default_tx":
+                options["tx_disabled"] = False
+
+        if "suppress_display_issues" in content:
+            options["suppress_display_issues"] = True
+        if "verbosity_level" in content:
+            options["verbosity_level"] = content["verbosity_level"]
+        if "fail_at" in content:
+            options["fail_at"] = content["fail_at"]
+
+        options["extensible_binding_warnings"] = "extensible_binding_warnings" in content
+        options["best_practice_warnings"]      = "best_practice_warnings" in content
+        options["debug"]                       = "debug" in content
+        options["use_result_cache"]            = "no_cache" not in content
+        return options
+
+    async def _listJobs(self, request):
+        """ List all jobs that are queued, running or recently finished. """
+        return web.json_response({"jobs": [job.describe() for job in self.jobs.values()]})
+
+    async def _getMetrics(self, request):
+        """ Expose the totals of the instrumentation in the Prometheus text format. """
+        lines = [f'qa_jobs{{status="{status}"}} {len([job for job in self.jobs.values() if job.status == status])}' for status in ["queued", "running"]]
+        return web.Response(text = TRACER.formatMetrics() + "# TYPE qa_jobs gauge\n" + "\n".join(lines) + "\n", content_type = "text/plain")
+
+    async def _getJob(self, request):
+        """ Get the status of a single job. """
+        job = self._findJob(request)
+        if job == None:
+            return web.json_response({"error": "Unknown job"}, status = 404)
+        return web.json_response(job.describe())
+
+    async def _cancelJob(self, request):
+        """ Cancel a job. A queued job is simply taken off the queue, while a running job is stopped (including the
+            Validator processes it started). """
+        job = self._findJob(request)
+        if job == None:
+            return web.json_response({"error": "Unknown job"}, status = 404)
+
+        if job.status == "queued":
+            job.finish("cancelled")
+        elif job.status == "running":
+            if job.task == None:
+                return web.json_response({"error": "Runs started by watch mode can't be cancelled"}, status = 409)
+            job.task.cancel()
+            await asyncio.wait([job.task])
+        return web.json_response(job.describe())
+
+    def _findJob(self, request):
+        try:
+            return self.jobs.get(int(request.match_info["job_id"]))
+        except ValueError:
+            return None
 
     async def _handleGet(self, request):
         ''' Handle GET request, which we do expect in two flavors: on the base or on a particular file. Any other
@@ -467,39 +3818,14 @@ class QAServer:
     async def _handlePost(self, request):
         content = await request.post()
 
-        if "check_what" in content:
-            if content["check_what"] == "filtered":
-                self.executor.file_collection.setMode(FileCollection.Mode.FILTERED, content["file_name_filters"].split(","))
-            elif content["check_what"] == "changed":
-                self.executor.file_collection.setMode(FileCollection.Mode.CHANGED)
-            else:
-                self.executor.file_collection.setMode(FileCollection.Mode.ALL)
-
         steps = []
         for key in content:
             if key.startswith("step_"):
                 steps.append(key.replace("step_", ""))
 
-        if "terminology" in content:
-            if content["terminology"] == "disabled":
-                self.executor.setTerminologyOptions(disabled = True)
-            elif content["terminology"] == "default_tx":
-                self.executor.setTerminologyOptions(disabled = False)
-
-        if "suppress_display_issues" in content:
-            self.executor.setTerminologyOptions(suppress_display_issues = True)
-        if "verbosity_level" in content:
-            self.executor.setLevels(verbosity = content["verbosity_level"])
-        if "fail_at" in content:
-            self.executor.setLevels(fail_at = content["fail_at"])
-
-        self.executor.setTerminologyOptions(extensible_binding_warnings = ("extensible_binding_warnings" in content))
-        self.executor.setBestPracticeWarnings("best_practice_warnings" in content)
-        self.executor.setDebugging("debug" in content)
-        
-        self.executor.printer.setSocket(self.ws)
-        asyncio.create_task(self._executeAndReport(steps))
-        return web.Response()
+        job = self._addJob(steps, self._getOptions(content))
+        self.queue.put_nowait(job)
+        return web.json_response(job.describe())
 
     async def _getFileSelection(self, request):
         """ Get (all) the file names that will be affected by the selected validation steps and selection settings.
@@ -527,30 +3853,30 @@ class QAServer:
         if "filters" in content:
             filters = content["filters"].split(",")
         
-        self.executor.file_collection.setMode(mode, filters)
-        self.executor.file_collection.resolve()
+        # Use a copy of the FileCollection, so we don't interfere with running jobs
+        file_collection = copy.copy(self.executor.file_collection)
+        file_collection.setMode(mode, filters)
+        await asyncio.to_thread(file_collection.resolve, refresh = False)
 
         # Retrieve all files for the selected steps
         files = []
         for step_name in step_names:
-            step = self.executor.steps[step_name]
-                       
-            if "patterns" in step:
-                patterns = step["patterns"]
-                if type(patterns) == str:
-                    patterns = [patterns]
-                for pattern in patterns:
-                    files += self.executor.file_collection[pattern]
+            for pattern in self.executor.getStepPatterns(step_name):
+                files += file_collection[pattern]
 
         # Respond with a list of files
         return web.json_response({"files": files})
         
-    async def _executeAndReport(self, steps):
-        """ Execute the QA tooling and report back the result when done using the open web socket. """
-        await self.ws.send_json({"status": "running"})
-        result = await executor.execute(*steps)
-        status = "success" if result else "failure"
-        await self.ws.send_json({"result": status})
+    async def _reportWatchStart(self):
+        """ Register a job for a run started by watch mode, and direct the output of the executor to it. """
+        self.watch_job = self._addJob(self.watch_steps, self._getOptions(), watch = True)
+        self.watch_job.start()
+        self.executor.printer.setRunLog(self.watch_job.log)
+
+    async def _reportWatchResult(self, result):
+        await self.executor.printer.flush()
+        self.executor.printer.setRunLog(None)
+        self.watch_job.finish("success" if result else "failure")
 
 if __name__ == "__main__":
     def __interpretStringAsBool(value):
@@ -569,6 +3895,8 @@ if __name__ == "__main__":
                        help = "Run in batch mode rather then starting a web server to control the process.")
     parser.add_argument("--changed-only", type = __interpretStringAsBool, nargs = '?', const = True, default = False, metavar = 'boolean',
                         help = "Only validate changed files rather than all files (compared to the main branch).")
+    parser.add_argument("--include-dependents", type = __interpretStringAsBool, nargs = '?', const = True, default = None, metavar = 'boolean',
+                        help = "When only validating changed files, also validate the files that refer to the canonical URL's of these files. Defaults to true, except in Github mode.")
     parser.add_argument("--no-tx", type = __interpretStringAsBool, nargs = '?', const = True, default = False, metavar = 'boolean',
                         help = "Disable the use of a terminology server all together.")
     parser.add_argument("--extensible-binding-warnings", type = __interpretStringAsBool, nargs = '?', const = True, default = False, metavar = 'boolean',
@@ -583,32 +3911,132 @@ if __name__ == "__main__":
                         help = "Show messages from this level onwards.")
     parser.add_argument("--debug", type = __interpretStringAsBool, nargs = '?', const = True, default = False, metavar = 'boolean',
                         help = "Display debugging information for when something goes wrong.")
+    parser.add_argument("--validator-daemon", type = __interpretStringAsBool, nargs = '?', const = True, default = True, metavar = 'boolean',
+                        help = "Keep a Validator instance running in the background and re-use it for all steps (if the Validator has an HTTP server mode, see the README).")
+    parser.add_argument("--fuse-steps", type = __interpretStringAsBool, nargs = '?', const = True, default = True, metavar = 'boolean',
+                        help = "Combine the Validator steps that use the same profile into a single Validator run.")
+    parser.add_argument("--preflight", type = __interpretStringAsBool, nargs = '?', const = True, default = True, metavar = 'boolean',
+                        help = "Check the files for well-formedness before running the Validator, and leave out the files that aren't.")
+    parser.add_argument("--fail-fast", type = __interpretStringAsBool, nargs = '?', const = True, default = False, metavar = 'boolean',
+                        help = "Don't run the Validator at all when the pre-flight check finds a problem.")
+    parser.add_argument("--no-cache", type = __interpretStringAsBool, nargs = '?', const = True, default = False, metavar = 'boolean',
+                        help = "Don't use the results of previous Validator runs, but validate all files again.")
+    parser.add_argument("--clear-cache", type = __interpretStringAsBool, nargs = '?', const = True, default = False, metavar = 'boolean',
+                        help = "Remove all stored results of previous Validator runs before starting.")
+    parser.add_argument("--ig-cache", type = __interpretStringAsBool, nargs = '?', const = True, default = True, metavar = 'boolean',
+                        help = "Pass the ig directories to the Validator as pre-built packages, which are only rebuilt when the directories change.")
+    parser.add_argument("--tx-cache", type = __interpretStringAsBool, nargs = '?', const = True, default = True, metavar = 'boolean',
+                        help = "Cache the answers of the terminology server across runs.")
+    parser.add_argument("--tx-offline", type = __interpretStringAsBool, nargs = '?', const = True, default = False, metavar = 'boolean',
+                        help = "Only use the terminology cache, without contacting the terminology server.")
+    parser.add_argument("--warm-tx-cache", type = __interpretStringAsBool, nargs = '?', const = True, default = False, metavar = 'boolean',
+                        help = "Refresh the outdated answers in the terminology cache before starting.")
+    parser.add_argument("--jobs", type = int, metavar = "N",
+                        help = "The number of steps that may be executed concurrently (overrides the 'jobs' setting in qa.yaml).")
+    parser.add_argument("--workers", type = int, default = 1, metavar = "N",
+                        help = "The number of runs requested using the web interface that may be executed concurrently; further runs are queued.")
+    parser.add_argument("--watch", type = __interpretStringAsBool, nargs = '?', const = True, default = False, metavar = 'boolean',
+                        help = "Watch the repository and re-run the affected steps on the files that change.")
     parser.add_argument("--github", type = __interpretStringAsBool, nargs = '?', const = True, default = False, metavar = 'boolean',
                         help = "Add output in Github format. Implies --batch.")
+    parser.add_argument("--shard", type = str, default = "", metavar = "I/N",
+                        help = "Only check the I-th of N parts of the files, and write the results to the shard dir. Implies --batch.")
+    parser.add_argument("--merge", type = __interpretStringAsBool, nargs = '?', const = True, default = False, metavar = 'boolean',
+                        help = "Merge the results of all shards in the shard dir into the final result, instead of checking files.")
+    parser.add_argument("--shard-dir", type = str, metavar = "DIR",
+                        help = "The directory for the results of the shards (defaults to qa-shards in the runner's temp dir on Github, or shards in the cache dir).")
+    parser.add_argument("--trace", type = str, metavar = "FILE",
+                        help = "The file to write a JSON trace of the timings of a batch run to (defaults to trace.json in the cache dir).")
+    parser.add_argument("--timings", type = int, nargs = '?', const = 20, metavar = "N",
+                        help = "Show the N (default 20) slowest steps and files according to the timing history, instead of checking files.")
     parser.add_argument("steps", type = str, nargs = "*", metavar = "step",
                         help = "The steps to execute (make sure to quote them if they contain spaces). If absent, all steps will be executed.")
     args = parser.parse_args()
     if args.github:
         args.batch = True
+    shards = None
+    if args.shard.strip() != "":
+        try:
+            shards = Shards.parse(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        args.batch = True
 
     try:
         MENU_PORT = os.environ["MENU_PORT"]
     except KeyError:
         MENU_PORT = 9000
 
+    if "CACHE_DIR" in os.environ:
+        CACHE_DIR = os.environ["CACHE_DIR"]
+    if "REPO_DIR" in os.environ:
+        REPO_DIR = os.environ["REPO_DIR"]
+    if "USER_SCRIPT_DIR" in os.environ:
+        USER_SCRIPT_DIR = os.environ["USER_SCRIPT_DIR"]
+
     if args.github and "GITHUB_WORKSPACE" in os.environ:
         REPO_DIR = os.environ["GITHUB_WORKSPACE"]
 
     os.chdir(REPO_DIR)
 
+    # Keep the results of the shards out of the repository, so they're not mistaken for files to check. On Github,
+    # the runner's temp dir is used, which is shared with the other steps of the job (for uploading as artifact).
+    if not args.shard_dir:
+        if "RUNNER_TEMP" in os.environ and os.path.isdir(os.environ["RUNNER_TEMP"]):
+            args.shard_dir = os.path.join(os.environ["RUNNER_TEMP"], "qa-shards")
+        elif args.github and os.path.isdir(GITHUB_RUNNER_TEMP):
+            args.shard_dir = os.path.join(GITHUB_RUNNER_TEMP, "qa-shards")
+        else:
+            args.shard_dir = os.path.join(CACHE_DIR, "shards")
+
+    if args.timings != None:
+        cost_store = CostStore(os.path.join(CACHE_DIR, "timings.sqlite"))
+        for title, rows in [("steps", cost_store.slowestSteps(args.timings)), ("files", cost_store.slowestFiles(args.timings))]:
+            print(f"\033[1;37mSlowest {title}\033[0m (average seconds, runs)")
+            for name, duration, runs in rows:
+                print(f"{duration:10.2f} {runs:6d}  {name}")
+            print()
+        sys.exit(0)
+
     with open(CONFIG_FILE) as config_file:
         config = yaml.safe_load(config_file)
     file_collection = FileCollection(config, FileCollection.Mode.CHANGED if args.changed_only else FileCollection.Mode.ALL, args.github)
+    if args.include_dependents == None:
+        # On Github, the cache dir doesn't persist between runs, so the dependency index would have to be built from
+        # the whole repo each time, which defeats the purpose of only checking the changed files
+        args.include_dependents = not args.github
+    if args.include_dependents:
+        file_collection.setDependencyIndex(DependencyIndex(os.path.join(CACHE_DIR, "dependencies.json")))
+
+    if args.merge:
+        # The shards should together have checked the same selection of files as a single run would
+        file_collection.resolve()
+        if not asyncio.run(Shards.merge(args.shard_dir, file_collection, Printer(args.github))):
+            sys.exit(1)
+        sys.exit(0)
+
     printer = Printer(args.github)
-    executor = StepExecutor(config, file_collection, printer, args.fail_at, args.verbosity_level)
+    try:
+        executor = StepExecutor(config, file_collection, printer, args.fail_at, args.verbosity_level)
+    except ValueError as e:
+        print(f"\033[1;31m{e}\033[0m")
+        sys.exit(1)
     executor.setTerminologyOptions(disabled = args.no_tx, extensible_binding_warnings = args.extensible_binding_warnings, suppress_display_issues = args.suppress_display_issues)
     executor.setBestPracticeWarnings(args.best_practice_warnings)
     executor.setDebugging(args.debug)
+    executor.setDaemonUsage(args.validator_daemon)
+    executor.setStepFusion(args.fuse_steps)
+    executor.setPreflight(args.preflight, args.fail_fast)
+    executor.setCostStore(os.path.join(CACHE_DIR, "timings.sqlite"))
+    executor.setShards(shards)
+    if args.jobs != None:
+        executor.setJobs(args.jobs)
+    executor.setResultCache(os.path.join(CACHE_DIR, "results"))
+    executor.setResultCacheUsage(not args.no_cache)
+    executor.setPackageCache(os.path.join(CACHE_DIR, "packages") if args.ig_cache else None)
+    executor.setTerminologyCache(os.path.join(CACHE_DIR, "tx") if args.tx_cache else None, args.tx_offline)
+    if args.clear_cache:
+        executor.result_cache.clear()
    
     if len(args.steps) > 1:
         steps = args.steps
@@ -617,10 +4045,39 @@ if __name__ == "__main__":
     else:
         steps = executor.getSteps()
 
-    if args.batch:
-        result = asyncio.run(executor.execute(*steps))
+    async def __runBatch(steps):
+        try:
+            if args.warm_tx_cache:
+                await executor.warmTerminologyCache()
+            with TRACER.span("run", steps = list(steps)):
+                success = await executor.execute(*steps)
+            if shards != None:
+                shards.write(args.shard_dir, executor.shard_files, executor.step_results)
+            return success
+        finally:
+            await executor.close()
+            try:
+                TRACER.writeTrace(args.trace if args.trace else os.path.join(CACHE_DIR, "trace.json"))
+            except OSError as e:
+                print(f"The trace could not be written: {e}")
+
+    async def __watch(steps):
+        try:
+            if args.warm_tx_cache:
+                await executor.warmTerminologyCache()
+            await Watcher(executor, steps).watch()
+        finally:
+            await executor.close()
+
+    if args.batch and args.watch:
+        try:
+            asyncio.run(__watch(steps))
+        except KeyboardInterrupt:
+            pass
+    elif args.batch:
+        result = asyncio.run(__runBatch(steps))
         if not result:
             sys.exit(1)
     else:
-        server = QAServer(executor)
+        server = QAServer(executor, steps if args.watch else None, args.workers, args.warm_tx_cache)
         server.run()
@@ -1,41 +1,91 @@
-let websocket = new WebSocket("ws://localhost:9000/ws")
+let websocket
 let run_div
+let pending_output = []
 
-websocket.addEventListener('open', function (event) {
-    console.log("Connection opened")
-})
+// The job that's being followed and the offset in its output, so we can pick up where we left off if the connection
+// drops
+let current_job = null
+let current_offset = 0
+let shown_job = null
 
-websocket.addEventListener('message', function (event) {
-    message = JSON.parse(event.data)
-    if ("output" in message) {
-        run_div.insertAdjacentHTML('beforeend', message.output)
-        run_div.scrollTop = run_div.scrollHeight
-    } else if ("result" in message) {
-        setActive(true)
-        let result_msg = document.createElement('p')
-        result_msg.setAttribute("class", "result_msg")
-        console.log(`status: <span class='${message.result}'>${message.result}</span>`)
-        result_msg.insertAdjacentHTML("afterbegin", `status: <span class='${message.result}'>${message.result}</span>`)
-        document.getElementById('runs').insertAdjacentElement("beforeend", result_msg)
-    } else if ("status" in message && message["status"] == "running") {
-        setActive(false)
+function connect() {
+    let url = "ws://localhost:9000/ws"
+    if (current_job != null) {
+        url += `?job=${current_job}&offset=${current_offset}`
     }
-})
+    websocket = new WebSocket(url)
 
-document.getElementById('start_btn').addEventListener('click', async (event) => {
-    if (![0, 1].includes(websocket.readyState)) {
-        websocket = new WebSocket("ws://localhost:9000/ws")
+    websocket.addEventListener('open', function (event) {
+        console.log("Connection opened")
+    })
+
+    websocket.addEventListener('message', function (event) {
+        message = JSON.parse(event.data)
+        if ("output" in message) {
+            appendOutput(message.output)
+            current_offset = message.offset
+        } else if ("result" in message) {
+            flushOutput()
+            setActive(true)
+            let result_msg = document.createElement('p')
+            result_msg.setAttribute("class", "result_msg")
+            console.log(`status: <span class='${message.result}'>${message.result}</span>`)
+            result_msg.insertAdjacentHTML("afterbegin", `status: <span class='${message.result}'>${message.result}</span>`)
+            document.getElementById('runs').insertAdjacentElement("beforeend", result_msg)
+            current_job = message.job + 1
+            current_offset = 0
+        } else if ("status" in message && message["status"] == "running") {
+            if (message.job != shown_job) {
+                // A new job (rather than the one we're reconnecting to), so we need a fresh output block
+                flushOutput()
+                run_div = document.createElement('div')
+                run_div.setAttribute("class", "qa_output")
+                document.getElementById('runs').insertAdjacentElement('beforeend', run_div)
+                shown_job = message.job
+            }
+            current_job = message.job
+            setActive(false)
+        }
+    })
+
+    websocket.addEventListener('close', function (event) {
+        console.log("Connection closed, reconnecting")
+        setTimeout(connect, 1000)
+    })
+}
+connect()
+
+// Output can arrive faster than the browser can render it, so it's collected and added to the page at most once per
+// frame
+function appendOutput(html) {
+    if (pending_output.length == 0) {
+        requestAnimationFrame(flushOutput)
     }
-    run_div = document.createElement('div')
-    run_div.setAttribute("class", "qa_output")
-    document.getElementById('runs').insertAdjacentElement('beforeend', run_div)
+    pending_output.push(html)
+}
+
+function flushOutput() {
+    if (pending_output.length == 0) {
+        return
+    }
+    run_div.insertAdjacentHTML('beforeend', pending_output.join(''))
+    pending_output = []
+    run_div.scrollTop = run_div.scrollHeight
+}
 
+document.getElementById('start_btn').addEventListener('click', async (event) => {
     let response = await fetch(window.location.href, {
         method: 'POST',
         body: new FormData(document.getElementById('qa_form'))
     })
 })
 
+document.getElementById('cancel_btn').addEventListener('click', async (event) => {
+    if (current_job != null) {
+        await fetch(window.location.href + `jobs/${current_job}/cancel`, {method: 'POST'})
+    }
+})
+
 document.getElementById('verbosity_fatal').addEventListener('click', e => document.getElementById('fail_at_fatal').checked = true)
 document.getElementById('verbosity_error').addEventListener('click', e => {
     if (document.getElementById('fail_at_information').checked || document.getElementById('fail_at_warning').checked) {
@@ -111,6 +161,8 @@ function setActive(is_active) {
         document.querySelectorAll("form#qa_form > fieldset").forEach(fieldset => fieldset.setAttribute("disabled", "disabled"))
     }
     
+    document.getElementById('cancel_btn').disabled = is_active
+
     let btn = document.getElementById('start_btn')
     btn.disabled = !is_active
     if (is_active) {
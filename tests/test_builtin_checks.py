@@ -0,0 +1,92 @@
+""" Tests for the checks that are built into the tooling. """
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import entrypoint
+
+class CollectingPrinter(entrypoint.Printer):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    async def writeLine(self, line):
+        self.lines.append(line)
+
+    async def write(self, text):
+        self.lines.append(text)
+
+class ResourceIdCheckTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def check(self, file_name, content):
+        file_path = os.path.join(self.work_dir.name, file_name)
+        with open(file_path, "w") as f:
+            f.write(content)
+        return entrypoint.BuiltinCheck.REGISTRY["check-id"]().checkFile(file_path)
+
+    def test_duplicateIdKeysLastOneWins(self):
+        # Like json.load(), the last occurrence of a key determines the value
+        content = '{"resourceType": "Patient", "id": "other", "name": [{"text": "}"}], "id": "example"}'
+        self.assertEqual(json.loads(content)["id"], "example")
+        self.assertEqual(self.check("example.json", content), [])
+        self.assertEqual(len(self.check("other.json", content)), 1)
+
+    def test_nestedIdIsIgnored(self):
+        self.assertEqual(len(self.check("example.json", '{"resourceType": "Patient", "meta": {"id": "example"}}')), 1)
+
+class BuiltinStepTest(unittest.TestCase):
+    def setUp(self):
+        self.start_dir       = os.getcwd()
+        self.user_script_dir = entrypoint.USER_SCRIPT_DIR
+        self.work_dir        = tempfile.TemporaryDirectory()
+        os.environ["GIT_CONFIG_GLOBAL"] = os.path.join(self.work_dir.name, "gitconfig") # FileCollection adds to the git config
+        entrypoint.USER_SCRIPT_DIR = os.path.join(self.work_dir.name, "user_scripts")
+        os.chdir(self.work_dir.name)
+        with open("example.json", "w") as f:
+            f.write('{"resourceType": "Patient", "id": "example"}')
+
+    def tearDown(self):
+        os.chdir(self.start_dir)
+        entrypoint.USER_SCRIPT_DIR = self.user_script_dir
+        self.work_dir.cleanup()
+        del os.environ["GIT_CONFIG_GLOBAL"]
+
+    def execute(self, step):
+        config = {"patterns": {"all": "*.json"}, "steps": {"step": dict(step, patterns = "all")}}
+        printer = CollectingPrinter()
+        file_collection = entrypoint.FileCollection(config, entrypoint.FileCollection.Mode.ALL)
+        executor = entrypoint.StepExecutor(config, file_collection, printer, "error", "information")
+        try:
+            success = asyncio.run(executor.execute("step"))
+        finally:
+            asyncio.run(executor.close())
+        return success, printer.lines
+
+    def test_unknownBuiltinIsReported(self):
+        success, lines = self.execute({"builtin": "check-nothing"})
+        self.assertFalse(success)
+        self.assertTrue(any(["Unknown builtin check in qa.yaml: check-nothing" in line for line in lines]))
+
+    def test_noMemoryUsageIsReported(self):
+        success, lines = self.execute({"builtin": "check-id"})
+        self.assertTrue(success)
+        self.assertFalse(any(["Peak memory usage" in line for line in lines]))
+
+    def test_builtinScriptKeyIsAccepted(self):
+        success, lines = self.execute({"builtin-script": "check-id.py"})
+        self.assertTrue(success)
+        self.assertTrue(any(["No problems found" in line for line in lines]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+""" Tests for running steps concurrently. """
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import entrypoint
+
+class JobsSettingTest(unittest.TestCase):
+    def setUp(self):
+        self.start_dir = os.getcwd()
+        self.work_dir  = tempfile.TemporaryDirectory()
+        os.environ["GIT_CONFIG_GLOBAL"] = os.path.join(self.work_dir.name, "gitconfig") # FileCollection adds to the git config
+        os.chdir(self.work_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.start_dir)
+        self.work_dir.cleanup()
+        del os.environ["GIT_CONFIG_GLOBAL"]
+
+    def makeExecutor(self, jobs):
+        config = {"jobs": jobs, "patterns": {"all": "*.json"}, "steps": {}}
+        file_collection = entrypoint.FileCollection(config, entrypoint.FileCollection.Mode.ALL)
+        return entrypoint.StepExecutor(config, file_collection, entrypoint.Printer(), "error", "information")
+
+    def test_jobsAreAtLeastOne(self):
+        self.assertEqual(self.makeExecutor(0).jobs, 1)
+        self.assertEqual(self.makeExecutor(-2).jobs, 1)
+        self.assertEqual(self.makeExecutor(3).jobs, 3)
+
+    def test_invalidJobsAreReported(self):
+        for jobs in ["auto", 1.5, True, None]:
+            with self.assertRaisesRegex(ValueError, "Invalid value for 'jobs' in qa.yaml"):
+                self.makeExecutor(jobs)
+
+if __name__ == "__main__":
+    unittest.main()
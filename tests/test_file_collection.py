@@ -0,0 +1,72 @@
+""" Tests for selecting the files to check when only some files changed, like in watch mode. """
+
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import entrypoint
+
+class NullPrinter(entrypoint.Printer):
+    async def writeLine(self, line):
+        pass
+
+    async def write(self, text):
+        pass
+
+class ChangedFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.start_dir       = os.getcwd()
+        self.user_script_dir = entrypoint.USER_SCRIPT_DIR
+        self.work_dir        = tempfile.TemporaryDirectory()
+        os.environ["GIT_CONFIG_GLOBAL"] = os.path.join(self.work_dir.name, "gitconfig") # FileCollection adds to the git config
+        self.repo_dir = os.path.join(self.work_dir.name, "repo")
+        os.makedirs(os.path.join(self.repo_dir, "x", "sub"))
+        os.chdir(self.repo_dir)
+        for path in ["x/a.xml", "x/sub/b.xml", "top.xml"]:
+            with open(path, "w") as f:
+                f.write('<Patient xmlns="http://hl7.org/fhir"><id value="%s"/></Patient>' % os.path.basename(path)[:-4])
+
+        self.config = {
+            "patterns": {
+                "tree":  "x/**",
+                "files": "*.xml"
+            },
+            "steps": {
+                "check tree": {
+                    "patterns": "tree",
+                    "builtin":  "check-id"
+                }
+            }
+        }
+
+    def tearDown(self):
+        os.chdir(self.start_dir)
+        entrypoint.USER_SCRIPT_DIR = self.user_script_dir
+        self.work_dir.cleanup()
+        del os.environ["GIT_CONFIG_GLOBAL"]
+
+    def test_matchFileUsesDirectoryPatterns(self):
+        file_collection = entrypoint.FileCollection(self.config, entrypoint.FileCollection.Mode.ALL)
+        self.assertEqual(file_collection.match("x/sub/b.xml"), None)
+        self.assertEqual(file_collection.matchFile("x/sub/b.xml"), "tree")
+        self.assertEqual(file_collection.matchFile("x/a.xml"), "tree")
+        self.assertEqual(file_collection.matchFile("top.xml"), "files")
+        self.assertEqual(file_collection.matchFile("y/c.xml"), None)
+
+    def test_executeOnlyFilesBelowDirectoryPattern(self):
+        entrypoint.USER_SCRIPT_DIR = os.path.join(self.work_dir.name, "user_scripts")
+        file_collection = entrypoint.FileCollection(self.config, entrypoint.FileCollection.Mode.ALL)
+        executor = entrypoint.StepExecutor(self.config, file_collection, NullPrinter(), "error", "information")
+        try:
+            success = asyncio.run(executor.execute("check tree", only_files = ["x/sub/b.xml"]))
+        finally:
+            asyncio.run(executor.close())
+        self.assertTrue(success)
+        self.assertEqual(executor.step_results["check tree"], "success")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+""" Tests for queueing runs from the web interface as jobs that can be cancelled. """
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+from aiohttp.test_utils import TestClient, TestServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import entrypoint
+
+class NullPrinter(entrypoint.Printer):
+    async def writeLine(self, line):
+        pass
+
+    async def write(self, text):
+        pass
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.start_dir       = os.getcwd()
+        self.repo_dir        = entrypoint.REPO_DIR
+        self.user_script_dir = entrypoint.USER_SCRIPT_DIR
+        self.work_dir        = tempfile.TemporaryDirectory()
+        os.environ["GIT_CONFIG_GLOBAL"] = os.path.join(self.work_dir.name, "gitconfig") # FileCollection adds to the git config
+        entrypoint.REPO_DIR        = os.path.join(self.work_dir.name, "repo")
+        entrypoint.USER_SCRIPT_DIR = os.path.join(self.work_dir.name, "user_scripts")
+        os.makedirs(os.path.join(entrypoint.REPO_DIR, "scripts"))
+        os.chdir(entrypoint.REPO_DIR)
+        self.pid_file = os.path.join(self.work_dir.name, "pid")
+        with open("scripts/slow.sh", "w") as f:
+            f.write(f'#!/bin/sh\necho $$ > {self.pid_file}\nexec sleep 30\n')
+        with open("scripts/fast.sh", "w") as f:
+            f.write('#!/bin/sh\necho "checked $@"\n')
+        with open("a.json", "w") as f:
+            f.write("{}")
+
+        config = {
+            "script dir": "scripts",
+            "patterns": {"all": "*.json"},
+            "steps": {
+                "slow": {"patterns": "all", "script": "slow.sh"},
+                "fast": {"patterns": "all", "script": "fast.sh"}
+            }
+        }
+        file_collection = entrypoint.FileCollection(config, entrypoint.FileCollection.Mode.ALL)
+        self.executor = entrypoint.StepExecutor(config, file_collection, NullPrinter(), "error", "information")
+        self.executor.setTerminologyOptions(disabled = True, extensible_binding_warnings = False, suppress_display_issues = False)
+        self.executor.setDebugging(False)
+        self.executor.setResultCacheUsage(False)
+
+    def tearDown(self):
+        os.chdir(self.start_dir)
+        entrypoint.REPO_DIR        = self.repo_dir
+        entrypoint.USER_SCRIPT_DIR = self.user_script_dir
+        self.work_dir.cleanup()
+        del os.environ["GIT_CONFIG_GLOBAL"]
+
+    @staticmethod
+    def isRunning(pid):
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                return f.read().rsplit(")", 1)[1].split()[0] != "Z" # Killed but not reaped yet
+        except OSError:
+            return False
+
+    def serve(self, test):
+        async def run():
+            async with TestClient(TestServer(entrypoint.QAServer(self.executor).app)) as client:
+                await test(client)
+        asyncio.run(run())
+
+    async def submit(self, client, step_name, **form):
+        response = await client.post("/", data = dict(form, **{f"step_{step_name}": "on", "check_what": "all"}))
+        return (await response.json())["id"]
+
+    async def status(self, client, job_id):
+        return (await (await client.get(f"/jobs/{job_id}")).json())["status"]
+
+    async def waitFor(self, client, job_id, statuses):
+        deadline = time.monotonic() + 10
+        while (status := await self.status(client, job_id)) not in statuses:
+            self.assertLess(time.monotonic(), deadline, f"Job {job_id} is still {status}")
+            await asyncio.sleep(0.05)
+        return status
+
+    def test_jobsRunInOrder(self):
+        async def test(client):
+            first  = await self.submit(client, "fast")
+            second = await self.submit(client, "fast", debug = "on")
+            self.assertEqual(await self.waitFor(client, second, ["success", "failure"]), "success")
+            self.assertEqual(await self.status(client, first), "success")
+            jobs = (await (await client.get("/jobs")).json())["jobs"]
+            self.assertEqual([job["id"] for job in jobs], [first, second])
+            self.assertEqual([job["options"]["debug"] for job in jobs], [False, True])
+            self.assertLessEqual(jobs[0]["finished"], jobs[1]["started"])
+        self.serve(test)
+
+    def test_cancelQueuedAndRunningJobs(self):
+        async def test(client):
+            running = await self.submit(client, "slow")
+            queued  = await self.submit(client, "fast")
+            await self.waitFor(client, running, ["running"])
+            deadline = time.monotonic() + 10
+            while not os.path.exists(self.pid_file) or os.path.getsize(self.pid_file) == 0:
+                self.assertLess(time.monotonic(), deadline)
+                await asyncio.sleep(0.05)
+            with open(self.pid_file) as f:
+                pid = int(f.read())
+            self.assertEqual(await self.status(client, queued), "queued")
+
+            response = await client.post(f"/jobs/{queued}/cancel")
+            self.assertEqual((await response.json())["status"], "cancelled")
+            response = await client.post(f"/jobs/{running}/cancel")
+            self.assertEqual((await response.json())["status"], "cancelled")
+            self.assertFalse(self.isRunning(pid)) # The script has been killed
+
+            # The cancelled job stays cancelled, and the queue moves on
+            third = await self.submit(client, "fast")
+            self.assertEqual(await self.waitFor(client, third, ["success", "failure"]), "success")
+            self.assertEqual(await self.status(client, queued), "cancelled")
+        self.serve(test)
+
+    def test_unknownJob(self):
+        async def test(client):
+            self.assertEqual((await client.get("/jobs/99")).status, 404)
+            self.assertEqual((await client.post("/jobs/99/cancel")).status, 404)
+        self.serve(test)
+
+if __name__ == "__main__":
+    unittest.main()
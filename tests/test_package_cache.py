@@ -0,0 +1,82 @@
+""" Tests for compiling ig directories into packages for the Validator. """
+
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import entrypoint
+
+class PackageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.ig_dir   = os.path.join(self.work_dir.name, "ig")
+        self.fhir_dir = os.path.join(self.work_dir.name, "packages")
+        os.makedirs(os.path.join(self.ig_dir, "sub"))
+        os.makedirs(self.fhir_dir)
+        self.writeFile("profile.xml", '<StructureDefinition xmlns="http://hl7.org/fhir"><id value="p"/><url value="http://example.org/p"/><kind value="resource"/><type value="Patient"/></StructureDefinition>')
+        self.writeFile("codes.json", json.dumps({"resourceType": "CodeSystem", "id": "c", "url": "http://example.org/c", "content": "complete"}))
+        self.writeFile("example.json", json.dumps({"resourceType": "Patient", "id": "e"}))
+        self.writeFile("other.xml", "<notes/>")
+        self.writeFile("sub/nested.json", json.dumps({"resourceType": "ValueSet", "id": "v"}))
+        self.cache = entrypoint.PackageCache(os.path.join(self.work_dir.name, "cache"), fhir_cache_dir = self.fhir_dir)
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def writeFile(self, name, content):
+        with open(os.path.join(self.ig_dir, name), "w") as f:
+            f.write(content)
+
+    def test_packageContainsConformanceResources(self):
+        path = self.cache.resolve(self.ig_dir)
+        self.assertTrue(path.endswith(".tgz"))
+        with tarfile.open(path) as package:
+            self.assertEqual(sorted(package.getnames()), ["package/.index.json", "package/codes.json", "package/package.json", "package/profile.xml"])
+            index = json.load(package.extractfile("package/.index.json"))
+        descriptions = {description["filename"]: description for description in index["files"]}
+        self.assertEqual(descriptions["profile.xml"], {"resourceType": "StructureDefinition", "id": "p", "url": "http://example.org/p", "kind": "resource", "type": "Patient", "filename": "profile.xml"})
+        self.assertEqual(descriptions["codes.json"]["content"], "complete")
+
+    def test_unchangedDirectoryIsNotReadAgain(self):
+        path = self.cache.resolve(self.ig_dir)
+        with unittest.mock.patch.object(entrypoint.hashlib, "sha256", side_effect = AssertionError("files are read again")):
+            self.assertEqual(self.cache.resolve(self.ig_dir), path)
+
+        # Files outside of what the Validator loads don't matter
+        self.writeFile("sub/nested.json", json.dumps({"resourceType": "ValueSet", "id": "changed"}))
+        self.writeFile("readme.txt", "notes")
+        with unittest.mock.patch.object(entrypoint.hashlib, "sha256", side_effect = AssertionError("files are read again")):
+            self.assertEqual(self.cache.resolve(self.ig_dir), path)
+
+    def test_packageIsNamedAfterContent(self):
+        path = self.cache.resolve(self.ig_dir)
+        self.writeFile("codes.json", json.dumps({"resourceType": "CodeSystem", "id": "c", "url": "http://example.org/c", "content": "fragment"}))
+        changed_path = self.cache.resolve(self.ig_dir)
+        self.assertNotEqual(changed_path, path)
+
+        # Touching a file without changing it gives the same package, and a new cache finds the existing one
+        os.utime(os.path.join(self.ig_dir, "profile.xml"), (0, 0))
+        self.assertEqual(self.cache.resolve(self.ig_dir), changed_path)
+        cache = entrypoint.PackageCache(self.cache.cache_dir, fhir_cache_dir = self.fhir_dir)
+        with unittest.mock.patch.object(cache, "_build", side_effect = AssertionError("package is built again")):
+            self.assertEqual(cache.resolve(self.ig_dir), changed_path)
+
+    def test_installedPackagesArePinned(self):
+        for version in ["1.0.0", "1.2.0", "1.10.0-beta", "2.0.0"]:
+            os.makedirs(os.path.join(self.fhir_dir, f"example.fhir#{version}", "package"))
+            if version != "2.0.0": # Incomplete installation
+                with open(os.path.join(self.fhir_dir, f"example.fhir#{version}", "package", "package.json"), "w") as f:
+                    f.write("{}")
+        self.assertEqual(self.cache.resolve("example.fhir"), "example.fhir#1.2.0")
+        self.assertEqual(self.cache.resolve("example.fhir#1.0.0"), "example.fhir#1.0.0")
+        self.assertEqual(self.cache.resolve("other.fhir"), "other.fhir")
+        self.assertEqual(self.cache.resolve("profiles/profile.xml"), "profiles/profile.xml")
+
+if __name__ == "__main__":
+    unittest.main()
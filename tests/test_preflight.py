@@ -0,0 +1,120 @@
+""" Tests for the pre-flight check of the files before they're passed to the Validator. """
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import entrypoint
+
+class CollectingPrinter(entrypoint.Printer):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    async def writeLine(self, line):
+        self.lines.append(line)
+
+    async def write(self, text):
+        self.lines.append(text)
+
+class InspectTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def inspect(self, file_name, content):
+        file_path = os.path.join(self.work_dir.name, file_name)
+        with open(file_path, "w", encoding = "UTF-8") as f:
+            f.write(content)
+        return entrypoint.WellFormednessCheck.inspect(file_path)
+
+    def test_resourceTypeIsFound(self):
+        self.assertEqual(self.inspect("a.xml", '<?xml version="1.0"?><Patient xmlns="http://hl7.org/fhir"><id value="a"/></Patient>'), (None, "Patient"))
+        self.assertEqual(self.inspect("a.json", '\ufeff{"resourceType": "Observation"}'), (None, "Observation"))
+        self.assertEqual(self.inspect("a.txt", "not a resource"), (None, None))
+
+    def test_problemsAreReported(self):
+        problem, resource_type = self.inspect("a.xml", '<Patient xmlns="http://hl7.org/fhir"><id value="a"/>')
+        self.assertIn("is not well-formed XML", problem)
+        self.assertIn("isn't in the FHIR namespace", self.inspect("b.xml", "<Patient/>")[0])
+        self.assertIn("is not well-formed JSON", self.inspect("a.json", '{"resourceType": ')[0])
+        self.assertIn("there's no resourceType", self.inspect("b.json", "[]")[0])
+
+class PreflightTest(unittest.TestCase):
+    def setUp(self):
+        self.start_dir = os.getcwd()
+        self.work_dir  = tempfile.TemporaryDirectory()
+        os.environ["GIT_CONFIG_GLOBAL"] = os.path.join(self.work_dir.name, "gitconfig") # FileCollection adds to the git config
+        os.chdir(self.work_dir.name)
+        os.makedirs("resources")
+        self.writeFile("resources/patient.json", {"resourceType": "Patient"})
+        self.writeFile("resources/observation.json", {"resourceType": "Observation"})
+        with open("resources/broken.json", "w") as f:
+            f.write("{")
+
+        config = {
+            "patterns": {"all": "resources/*.json"},
+            "steps": {
+                "any": {"patterns": "all"},
+                "patients": {"patterns": "all", "resource types": ["Patient"]},
+                "script": {"patterns": "all", "script": "check.sh"}
+            }
+        }
+        self.printer = CollectingPrinter()
+        file_collection = entrypoint.FileCollection(config, entrypoint.FileCollection.Mode.ALL)
+        self.executor = entrypoint.StepExecutor(config, file_collection, self.printer, "error", "information")
+        self.runs = []
+        async def runValidator(profile, files, printer, *args):
+            self.runs.append(sorted(files))
+            return True
+        self.executor._runValidator = runValidator
+
+    def tearDown(self):
+        os.chdir(self.start_dir)
+        self.work_dir.cleanup()
+        del os.environ["GIT_CONFIG_GLOBAL"]
+
+    def writeFile(self, file_path, resource):
+        with open(file_path, "w") as f:
+            json.dump(resource, f)
+
+    def preflight(self, *step_names):
+        selection = {"all": sorted(os.path.join("resources", file_name) for file_name in os.listdir("resources"))}
+        return asyncio.run(self.executor._preflight(list(step_names), selection))
+
+    def test_filesAreRejectedPerStep(self):
+        rejected = self.preflight("any", "patients", "script")
+        self.assertEqual(sorted(rejected.keys()), ["any", "patients"]) # Scripts get to see every file
+        self.assertEqual(list(rejected["any"].keys()), ["resources/broken.json"])
+        self.assertEqual(sorted(rejected["patients"].keys()), ["resources/broken.json", "resources/observation.json"])
+        self.assertIn("only Patient is expected here", rejected["patients"]["resources/observation.json"])
+
+    def test_unchangedFilesAreNotInspectedAgain(self):
+        self.preflight("any")
+        with unittest.mock.patch.object(entrypoint.WellFormednessCheck, "inspect", side_effect = AssertionError("inspected again")):
+            self.assertEqual(list(self.preflight("any")["any"].keys()), ["resources/broken.json"])
+        self.writeFile("resources/broken.json", {"resourceType": "Patient"})
+        self.assertEqual(self.preflight("any"), {})
+
+    def test_rejectedFilesAreNotValidated(self):
+        success = asyncio.run(self.executor._runPreflightedValidator({}, ["resources"], self.preflight("any")["any"], self.printer))
+        self.assertFalse(success)
+        self.assertEqual(self.runs, [["resources/observation.json", "resources/patient.json"]])
+        self.assertTrue(any(["resources/broken.json is not well-formed JSON" in line for line in self.printer.lines]))
+
+    def test_failFastSkipsTheValidator(self):
+        self.executor.setPreflight(True, fail_fast = True)
+        success = asyncio.run(self.executor._runPreflightedValidator({}, ["resources"], self.preflight("any")["any"], self.printer))
+        self.assertFalse(success)
+        self.assertEqual(self.runs, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+""" Tests for caching the Validator outcome per file. """
+
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import entrypoint
+
+def makeOutcome(severity = "error", code = "processing"):
+    return ET.fromstring(f'<OperationOutcome xmlns="http://hl7.org/fhir"><issue><severity value="{severity}"/><code value="{code}"/></issue></OperationOutcome>')
+
+class NullPrinter(entrypoint.Printer):
+    async def writeLine(self, line):
+        pass
+
+    async def write(self, text):
+        pass
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.cache = entrypoint.ResultCache(os.path.join(self.work_dir.name, "results"))
+        self.file_path = os.path.join(self.work_dir.name, "a.xml")
+        with open(self.file_path, "w") as f:
+            f.write("<Patient/>")
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def test_keyCoversContentProfileAndContext(self):
+        key = self.cache.makeKey("context", "profile", self.file_path)
+        self.assertEqual(self.cache.makeKey("context", "profile", self.file_path), key)
+        self.assertNotEqual(self.cache.makeKey("other context", "profile", self.file_path), key)
+        self.assertNotEqual(self.cache.makeKey("context", "other profile", self.file_path), key)
+        self.assertNotEqual(self.cache.makeKey("context", None, self.file_path), key)
+        with open(self.file_path, "w") as f:
+            f.write("<Observation/>")
+        self.assertNotEqual(self.cache.makeKey("context", "profile", self.file_path), key)
+
+    def test_contextCoversEngineArgsAndIgs(self):
+        ig_dir = os.path.join(self.work_dir.name, "ig")
+        os.makedirs(ig_dir)
+        with open(os.path.join(ig_dir, "profile.xml"), "w") as f:
+            f.write("<StructureDefinition/>")
+        context = self.cache.makeContext(["-ig", ig_dir], [ig_dir])
+        self.assertEqual(self.cache.makeContext(["-ig", ig_dir], [ig_dir]), context)
+        self.assertNotEqual(self.cache.makeContext(["-ig", ig_dir, "-tx", "n/a"], [ig_dir]), context)
+        with open(os.path.join(ig_dir, "profile.xml"), "w") as f:
+            f.write("<StructureDefinition><id value='changed'/></StructureDefinition>")
+        self.assertNotEqual(self.cache.makeContext(["-ig", ig_dir], [ig_dir]), context)
+
+    def test_storedOutcomeIsReturned(self):
+        self.assertEqual(self.cache.get("0123abcd"), None)
+        self.cache.put("0123abcd", makeOutcome())
+        self.assertEqual(ET.tostring(self.cache.get("0123abcd")), ET.tostring(makeOutcome()))
+
+    def test_transientOutcomesAreNotCacheable(self):
+        self.assertTrue(entrypoint.ResultCache.isCacheable(makeOutcome()))
+        self.assertFalse(entrypoint.ResultCache.isCacheable(makeOutcome(severity = "fatal")))
+        self.assertFalse(entrypoint.ResultCache.isCacheable(makeOutcome(code = "exception")))
+
+    def test_leastRecentlyUsedAreEvicted(self):
+        cache = entrypoint.ResultCache(os.path.join(self.work_dir.name, "small"), max_size = 1)
+        outcome = ET.fromstring('<OperationOutcome xmlns="http://hl7.org/fhir"><text value="%s"/></OperationOutcome>' % ("x" * 100 * 1024))
+        keys = [f"{i:02d}" + "0" * 62 for i in range(15)]
+        for i, key in enumerate(keys):
+            cache.put(key, outcome)
+            os.utime(cache._path(key), (1000 + i, 1000 + i))
+        cache.get(keys[0]) # Now the most recently used one
+        cache.evict()
+        remaining = [key for key in keys if os.path.exists(cache._path(key))]
+        self.assertIn(keys[0], remaining)
+        self.assertNotIn(keys[1], remaining)
+        self.assertIn(keys[-1], remaining)
+        self.assertLessEqual(sum([os.path.getsize(cache._path(key)) for key in remaining]), 0.8 * 1024 * 1024)
+
+class CachedRunTest(unittest.TestCase):
+    def setUp(self):
+        self.start_dir = os.getcwd()
+        self.work_dir  = tempfile.TemporaryDirectory()
+        os.environ["GIT_CONFIG_GLOBAL"] = os.path.join(self.work_dir.name, "gitconfig") # FileCollection adds to the git config
+        os.chdir(self.work_dir.name)
+        self.files = ["a.xml", "b.xml"]
+        for file_path in self.files:
+            with open(file_path, "w") as f:
+                f.write(f"<Patient><id value='{file_path}'/></Patient>")
+
+        config = {"patterns": {"all": "*.xml"}, "steps": {}}
+        file_collection = entrypoint.FileCollection(config, entrypoint.FileCollection.Mode.ALL)
+        self.executor = entrypoint.StepExecutor(config, file_collection, NullPrinter(), "error", "information")
+        self.executor.setTerminologyOptions(disabled = True, extensible_binding_warnings = False, suppress_display_issues = False)
+        self.executor.setResultCache(os.path.join(self.work_dir.name, "results"))
+        self.validated = []
+        async def validate(profile, files, engine_args, out_path, printer, shards = None, base_heap = None):
+            self.validated.append(list(files))
+            outcomes = []
+            for file_path in files:
+                outcome = makeOutcome(code = "exception" if "transient" in file_path else "processing")
+                entrypoint.OutcomeBundle.setFile(outcome, file_path)
+                outcomes.append(outcome)
+            entrypoint.OutcomeBundle.write(out_path, outcomes)
+            return True
+        self.executor._validate = validate
+
+    def tearDown(self):
+        os.chdir(self.start_dir)
+        self.work_dir.cleanup()
+        del os.environ["GIT_CONFIG_GLOBAL"]
+
+    def produce(self, files, profile = None):
+        self.executor.cache_contexts = {}
+        out_path = os.path.join(self.work_dir.name, "out.xml")
+        self.assertTrue(asyncio.run(self.executor._produceOutcomes(profile, files, out_path, NullPrinter())))
+        return [entrypoint.OutcomeBundle.getFile(outcome) for outcome in entrypoint.OutcomeBundle.read(out_path)]
+
+    def test_onlyChangedFilesAreValidated(self):
+        self.assertEqual(self.produce(self.files), self.files)
+        self.assertEqual(self.produce(self.files), self.files)
+        with open("b.xml", "a") as f:
+            f.write("\n")
+        self.assertEqual(self.produce(self.files), self.files)
+        self.assertEqual(self.validated, [self.files, ["b.xml"]])
+
+    def test_otherProfileIsValidated(self):
+        self.produce(self.files)
+        self.produce(self.files, "http://example.org/profile")
+        self.assertEqual(self.validated, [self.files, self.files])
+
+    def test_transientOutcomesAreValidatedAgain(self):
+        with open("transient.xml", "w") as f:
+            f.write("<Patient/>")
+        self.produce(["a.xml", "transient.xml"])
+        self.produce(["a.xml", "transient.xml"])
+        self.assertEqual(self.validated, [["a.xml", "transient.xml"], ["transient.xml"]])
+
+    def test_cacheCanBeBypassed(self):
+        self.produce(self.files)
+        self.executor.setResultCacheUsage(False)
+        self.produce(self.files)
+        self.assertEqual(self.validated, [self.files, self.files])
+
+if __name__ == "__main__":
+    unittest.main()
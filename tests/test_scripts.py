@@ -0,0 +1,74 @@
+""" Tests for running user scripts over the files of a step. """
+
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import entrypoint
+
+class CollectingPrinter(entrypoint.Printer):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    async def writeLine(self, line):
+        self.lines.append(line)
+
+    async def write(self, text):
+        self.lines.append(text)
+
+class ScriptStepTest(unittest.TestCase):
+    def setUp(self):
+        self.start_dir       = os.getcwd()
+        self.repo_dir        = entrypoint.REPO_DIR
+        self.user_script_dir = entrypoint.USER_SCRIPT_DIR
+        self.work_dir        = tempfile.TemporaryDirectory()
+        os.environ["GIT_CONFIG_GLOBAL"] = os.path.join(self.work_dir.name, "gitconfig") # FileCollection adds to the git config
+        entrypoint.REPO_DIR        = os.path.join(self.work_dir.name, "repo")
+        entrypoint.USER_SCRIPT_DIR = os.path.join(self.work_dir.name, "user_scripts")
+        os.makedirs(os.path.join(entrypoint.REPO_DIR, "scripts"))
+        os.chdir(entrypoint.REPO_DIR)
+        with open("scripts/show.sh", "w") as f:
+            f.write('#!/bin/sh\nfor arg in "$0" "$@"; do echo "arg: $arg"; done\nwhile read line; do echo "line: $line"; done\n')
+        for file_name in ["a b.json", "c.json"]:
+            with open(file_name, "w") as f:
+                f.write("{}")
+
+    def tearDown(self):
+        os.chdir(self.start_dir)
+        entrypoint.REPO_DIR        = self.repo_dir
+        entrypoint.USER_SCRIPT_DIR = self.user_script_dir
+        self.work_dir.cleanup()
+        del os.environ["GIT_CONFIG_GLOBAL"]
+
+    def execute(self, step):
+        config = {"script dir": "scripts", "patterns": {"all": "*.json"}, "steps": {"step": dict(step, patterns = "all")}}
+        printer = CollectingPrinter()
+        file_collection = entrypoint.FileCollection(config, entrypoint.FileCollection.Mode.ALL)
+        executor = entrypoint.StepExecutor(config, file_collection, printer, "error", "information")
+        try:
+            success = asyncio.run(executor.execute("step"))
+        finally:
+            asyncio.run(executor.close())
+        return success, "".join(printer.lines)
+
+    def test_shellIsUsedByDefault(self):
+        success, output = self.execute({"script": 'show.sh "$0" $HOME < /dev/null'})
+        self.assertTrue(success)
+        self.assertIn(f"arg: {os.environ['HOME']}", output)
+        self.assertIn("arg: a b.json", output)
+        self.assertIn("arg: c.json", output)
+        self.assertNotIn(".txt", output) # No list file is passed to the shell
+
+    def test_fileListOnStdin(self):
+        success, output = self.execute({"script": "show.sh", "file list": "stdin"})
+        self.assertTrue(success)
+        self.assertIn("line: a b.json", output)
+        self.assertNotIn("arg: c.json", output)
+
+if __name__ == "__main__":
+    unittest.main()
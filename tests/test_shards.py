@@ -0,0 +1,88 @@
+""" Tests for splitting a run over multiple machines and merging the results. """
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import entrypoint
+
+class CollectingPrinter(entrypoint.Printer):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    async def writeLine(self, line):
+        self.lines.append(line)
+
+    async def write(self, text):
+        self.lines.append(text)
+
+class ShardsTest(unittest.TestCase):
+    def setUp(self):
+        self.start_dir = os.getcwd()
+        self.work_dir  = tempfile.TemporaryDirectory()
+        os.chdir(self.work_dir.name)
+        self.selection = {"all": [], "some": []}
+        for i in range(20):
+            file_path = f"file-{i}.xml"
+            with open(file_path, "w") as f:
+                f.write("x" * (i % 7) * 100)
+            self.selection["all"].append(file_path)
+            if i % 3 == 0:
+                self.selection["some"].append(file_path)
+        self.shard_dir = os.path.join(self.work_dir.name, "shards")
+
+    def tearDown(self):
+        os.chdir(self.start_dir)
+        self.work_dir.cleanup()
+
+    def runShards(self, count):
+        for index in range(1, count + 1):
+            shards = entrypoint.Shards(index, count)
+            shards.write(self.shard_dir, entrypoint.Shards.getFiles(shards.select(self.selection)), {"step": "success"})
+
+    def merge(self):
+        printer = CollectingPrinter()
+        return asyncio.run(entrypoint.Shards.merge(self.shard_dir, self.selection, printer)), printer.lines
+
+    def test_shardsCoverSelectionOnce(self):
+        parts = [entrypoint.Shards.getFiles(entrypoint.Shards(index, 3).select(self.selection)) for index in range(1, 4)]
+        self.assertEqual(sorted(sum(parts, [])), sorted(self.selection["all"]))
+        self.runShards(3)
+        success, _ = self.merge()
+        self.assertTrue(success)
+
+    def test_mergeFailsOnDuplicatedFiles(self):
+        self.runShards(2)
+        path = os.path.join(self.shard_dir, "shard-1-of-2.json")
+        with open(path) as f:
+            partial = json.load(f)
+        with open(os.path.join(self.shard_dir, "shard-2-of-2.json")) as f:
+            partial["files"].append(json.load(f)["files"][0])
+        with open(path, "w") as f:
+            json.dump(partial, f)
+        success, lines = self.merge()
+        self.assertFalse(success)
+        self.assertTrue(any(["checked by more than one shard" in line for line in lines]))
+
+    def test_mergeFailsOnOtherSelection(self):
+        self.runShards(2)
+        self.selection["all"].append("file-new.xml")
+        success, lines = self.merge()
+        self.assertFalse(success)
+        self.assertTrue(any(["checked by any shard" in line for line in lines]))
+
+    def test_mergeFailsOnMissingShard(self):
+        self.runShards(2)
+        os.remove(os.path.join(self.shard_dir, "shard-2-of-2.json"))
+        success, lines = self.merge()
+        self.assertFalse(success)
+        self.assertTrue(any(["shard(s) 2 of 2 are missing" in line for line in lines]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+""" Tests for validating the files of multiple steps in a single Validator run. """
+
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import entrypoint
+
+class CollectingPrinter(entrypoint.Printer):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    async def writeLine(self, line):
+        self.lines.append(line)
+
+    async def write(self, text):
+        self.lines.append(text)
+
+class StepFusionTest(unittest.TestCase):
+    def setUp(self):
+        self.start_dir = os.getcwd()
+        self.work_dir  = tempfile.TemporaryDirectory()
+        os.environ["GIT_CONFIG_GLOBAL"] = os.path.join(self.work_dir.name, "gitconfig") # FileCollection adds to the git config
+        os.chdir(self.work_dir.name)
+        for dir_name in ["patients", "practitioners", "other"]:
+            os.makedirs(dir_name)
+            for file_name in ["1.xml", "2.xml"]:
+                with open(os.path.join(dir_name, file_name), "w") as f:
+                    f.write('<Patient xmlns="http://hl7.org/fhir"/>')
+
+        self.config = {
+            "patterns": {"patients": "patients/*.xml", "practitioners": "practitioners/*.xml", "other": "other/*.xml"},
+            "steps": {
+                "patients": {"patterns": "patients", "profile": "http://example.org/profile"},
+                "practitioners": {"patterns": "practitioners", "profile": "http://example.org/profile"},
+                "other profile": {"patterns": "other", "profile": "http://example.org/other"},
+                "longer timeout": {"patterns": "other", "profile": "http://example.org/profile", "timeout": 600}
+            }
+        }
+        self.printer   = CollectingPrinter()
+        self.runs      = []   # The profile and files of each Validator run
+        self.analyzed  = []   # The files that are reported on, per step
+        self.validates = True # Whether the Validator produces its output
+        self.makeExecutor()
+
+    def tearDown(self):
+        os.chdir(self.start_dir)
+        self.work_dir.cleanup()
+        del os.environ["GIT_CONFIG_GLOBAL"]
+
+    def makeExecutor(self):
+        file_collection = entrypoint.FileCollection(self.config, entrypoint.FileCollection.Mode.ALL)
+        self.executor = entrypoint.StepExecutor(self.config, file_collection, self.printer, "error", "information")
+        async def produceOutcomes(profile, files, out_path, printer, *args):
+            self.runs.append((profile, sorted(files)))
+            if not self.validates:
+                return False
+            outcomes = []
+            for file_path in files:
+                severity = "error" if file_path == "practitioners/2.xml" else "information"
+                outcome = ET.fromstring(f'<OperationOutcome xmlns="http://hl7.org/fhir"><issue><severity value="{severity}"/><code value="processing"/></issue></OperationOutcome>')
+                entrypoint.OutcomeBundle.setFile(outcome, os.path.abspath(file_path)) # The Validator reports absolute paths
+                outcomes.append(outcome)
+            entrypoint.OutcomeBundle.write(out_path, outcomes)
+            return True
+        async def analyzeResults(out_path, printer):
+            outcomes = entrypoint.OutcomeBundle.read(out_path)
+            self.analyzed.append(sorted([os.path.relpath(entrypoint.OutcomeBundle.getFile(outcome)) for outcome in outcomes]))
+            return all([severity.get("value") != "error" for outcome in outcomes for severity in outcome.iter(f"{{{entrypoint.FHIR_NS}}}severity")])
+        self.executor._produceOutcomes = produceOutcomes
+        self.executor._analyzeResults  = analyzeResults
+
+    def execute(self, *step_names):
+        try:
+            return asyncio.run(self.executor.execute(*step_names))
+        finally:
+            asyncio.run(self.executor.close())
+
+    def test_stepsWithSameSettingsAreFused(self):
+        selection = {"patients": ["patients/1.xml"], "practitioners": ["practitioners/1.xml"], "other": ["other/1.xml"]}
+        fused_runs = self.executor._planFusion(list(self.config["steps"].keys()), selection)
+        self.assertEqual(sorted(fused_runs.keys()), ["patients", "practitioners"])
+        self.assertIs(fused_runs["patients"], fused_runs["practitioners"])
+        self.assertEqual(fused_runs["patients"].files, ["patients/1.xml", "practitioners/1.xml"])
+
+        # Steps without files don't take part
+        selection["practitioners"] = []
+        self.assertEqual(self.executor._planFusion(list(self.config["steps"].keys()), selection), {})
+
+    def test_outcomesAreSplitPerStep(self):
+        self.assertFalse(self.execute("patients", "practitioners", "other profile"))
+        self.assertEqual(sorted(self.runs), [
+            ("http://example.org/other", ["other/1.xml", "other/2.xml"]),
+            ("http://example.org/profile", ["patients/1.xml", "patients/2.xml", "practitioners/1.xml", "practitioners/2.xml"])
+        ])
+        self.assertEqual(sorted(self.analyzed), [["other/1.xml", "other/2.xml"], ["patients/1.xml", "patients/2.xml"], ["practitioners/1.xml", "practitioners/2.xml"]])
+        self.assertEqual(self.executor.step_results, {"patients": "success", "practitioners": "failure", "other profile": "success"})
+
+    def test_failedRunFailsAllSteps(self):
+        self.validates = False
+        self.assertFalse(self.execute("patients", "practitioners"))
+        self.assertEqual(len(self.runs), 1)
+        self.assertEqual(self.analyzed, [])
+        self.assertEqual(self.executor.step_results, {"patients": "failure", "practitioners": "failure"})
+
+    def test_fusionCanBeDisabled(self):
+        self.executor.setStepFusion(False)
+        self.assertFalse(self.execute("patients", "practitioners"))
+        self.assertEqual(sorted([files for _, files in self.runs]), [["patients/1.xml", "patients/2.xml"], ["practitioners/1.xml", "practitioners/2.xml"]])
+
+if __name__ == "__main__":
+    unittest.main()
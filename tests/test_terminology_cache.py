@@ -0,0 +1,149 @@
+""" Tests for caching the answers of the terminology server using a local proxy. """
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import entrypoint
+
+class NullPrinter(entrypoint.Printer):
+    async def writeLine(self, line):
+        pass
+
+    async def write(self, text):
+        pass
+
+class TerminologyProxyTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir  = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.work_dir.name, "tx")
+        self.requests  = []
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    async def handle(self, request):
+        """ The actual terminology server. """
+        self.requests.append((request.method, request.path_qs))
+        if request.path.endswith("/fail"):
+            return web.json_response({"resourceType": "OperationOutcome", "issue": []}, status = 500)
+        return web.json_response({"resourceType": "Parameters", "parameter": [{"name": "result", "valueBoolean": True}], "request": len(self.requests)})
+
+    def serve(self, test):
+        async def run():
+            app = web.Application()
+            app.router.add_route("*", "/{path:.*}", self.handle)
+            self.server = web.AppRunner(app)
+            await self.server.setup()
+            site = web.TCPSite(self.server, "127.0.0.1", 0)
+            await site.start()
+            self.server_url = f"http://127.0.0.1:{self.server.addresses[0][1]}/r4"
+            try:
+                async with aiohttp.ClientSession() as self.session:
+                    await test()
+            finally:
+                await self.server.cleanup()
+        asyncio.run(run())
+
+    async def startProxy(self, max_age = 30, offline = False):
+        proxy = entrypoint.TerminologyProxy(entrypoint.TerminologyCache(self.cache_dir, max_age = max_age), self.server_url, offline)
+        return proxy, await proxy.start()
+
+    async def validateCode(self, proxy_url, cache_id, path = "/CodeSystem/$validate-code"):
+        body = json.dumps({"resourceType": "Parameters", "parameter": [{"name": "cache-id", "valueId": cache_id}, {"name": "code", "valueCode": "123"}]})
+        async with self.session.post(proxy_url + path, data = body, headers = {"Content-Type": "application/fhir+json", "Accept": "application/fhir+json"}) as response:
+            return response.status, await response.json(content_type = None)
+
+    def test_answersAreCached(self):
+        async def test():
+            proxy, url = await self.startProxy()
+            try:
+                status, first = await self.validateCode(url, "session-1")
+                self.assertEqual(status, 200)
+                # The cache id differs per Validator session, but doesn't influence the answer
+                self.assertEqual(await self.validateCode(url, "session-2"), (200, first))
+                self.assertEqual(len(self.requests), 1)
+                self.assertEqual(self.requests[0][1], "/r4/CodeSystem/$validate-code")
+
+                # Errors are passed on, but not cached
+                self.assertEqual((await self.validateCode(url, "session-1", "/fail"))[0], 500)
+                self.assertEqual((await self.validateCode(url, "session-1", "/fail"))[0], 500)
+                self.assertEqual(len(self.requests), 3)
+            finally:
+                await proxy.stop()
+
+            # The cache persists across runs
+            proxy, url = await self.startProxy()
+            try:
+                self.assertEqual(await self.validateCode(url, "session-3"), (200, first))
+                self.assertEqual(len(self.requests), 3)
+            finally:
+                await proxy.stop()
+        self.serve(test)
+
+    def test_outdatedAnswersAreRefreshed(self):
+        async def test():
+            proxy, url = await self.startProxy()
+            await self.validateCode(url, "session-1")
+            await proxy.stop()
+
+            proxy, url = await self.startProxy(max_age = 0)
+            try:
+                status, answer = await self.validateCode(url, "session-2")
+                self.assertEqual(answer["request"], 2)
+                self.assertEqual(len(self.requests), 2)
+
+                # When the server can't be reached, an outdated answer is better than none
+                await self.server.cleanup()
+                self.assertEqual(await self.validateCode(url, "session-3"), (200, answer))
+                status, answer = await self.validateCode(url, "session-3", "/ValueSet/$expand")
+                self.assertEqual(status, 502)
+                self.assertEqual(answer["resourceType"], "OperationOutcome")
+            finally:
+                await proxy.stop()
+        self.serve(test)
+
+    def test_warmUpRefreshesOutdatedAnswers(self):
+        async def test():
+            proxy, url = await self.startProxy()
+            await self.validateCode(url, "session-1")
+            await self.validateCode(url, "session-1", "/ValueSet/$expand")
+            await proxy.stop()
+
+            proxy, url = await self.startProxy(max_age = 0)
+            try:
+                await proxy.warmUp(NullPrinter())
+                self.assertEqual(len(self.requests), 4)
+            finally:
+                await proxy.stop()
+        self.serve(test)
+
+    def test_offlineMode(self):
+        async def test():
+            proxy, url = await self.startProxy()
+            _, answer = await self.validateCode(url, "session-1")
+            await proxy.stop()
+
+            proxy, url = await self.startProxy(max_age = 0, offline = True)
+            try:
+                # Even outdated answers are used, and the server is never contacted
+                self.assertEqual(await self.validateCode(url, "session-2"), (200, answer))
+                status, answer = await self.validateCode(url, "session-2", "/ValueSet/$expand")
+                self.assertEqual(status, 503)
+                self.assertEqual(answer["resourceType"], "OperationOutcome")
+                await proxy.warmUp(NullPrinter())
+                self.assertEqual(len(self.requests), 1)
+            finally:
+                await proxy.stop()
+        self.serve(test)
+
+if __name__ == "__main__":
+    unittest.main()
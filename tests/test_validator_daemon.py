@@ -0,0 +1,240 @@
+""" Tests for validating using a long-lived Validator process in its HTTP server mode. """
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import unittest
+import unittest.mock
+import xml.etree.ElementTree as ET
+import zipfile
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import entrypoint
+
+OUTCOME_XML = """<OperationOutcome xmlns="http://hl7.org/fhir">
+    <issue>
+        <extension url="http://hl7.org/fhir/StructureDefinition/operationoutcome-issue-line">
+            <valueInteger value="3"/>
+        </extension>
+        <severity value="error"/>
+        <code value="processing"/>
+        <details>
+            <text value="Something is wrong"/>
+        </details>
+        <expression value="Patient.name"/>
+        <expression value="Patient.name[0]"/>
+    </issue>
+</OperationOutcome>"""
+
+OUTCOME_JSON = {
+    "resourceType": "OperationOutcome",
+    "issue": [{
+        "severity": "error",
+        "_severity": {"extension": [{"url": "http://example.org/ignored", "valueBoolean": True}]},
+        "code": "processing",
+        "extension": [{"url": "http://hl7.org/fhir/StructureDefinition/operationoutcome-issue-line", "valueInteger": 3}],
+        "details": {"text": "Something is wrong"},
+        "expression": ["Patient.name", "Patient.name[0]"]
+    }]
+}
+
+def canonicalize(element):
+    return ET.canonicalize(ET.tostring(element), strip_text = True)
+
+class CollectingPrinter(entrypoint.Printer):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    async def writeLine(self, line):
+        self.lines.append(line)
+
+    async def write(self, text):
+        self.lines.append(text)
+
+class OutcomeParsingTest(unittest.TestCase):
+    def setUp(self):
+        self.daemon = entrypoint.ValidatorDaemon([], entrypoint.ResourceGovernor())
+
+    def test_xmlIsParsed(self):
+        outcome = self.daemon._parseOutcome(OUTCOME_XML.encode("UTF-8"))
+        self.assertEqual(canonicalize(outcome), canonicalize(ET.fromstring(OUTCOME_XML)))
+
+    def test_jsonIsConvertedToTheSameXml(self):
+        outcome = self.daemon._parseOutcome(json.dumps(OUTCOME_JSON).encode("UTF-8"))
+        self.assertEqual(canonicalize(outcome), canonicalize(ET.fromstring(OUTCOME_XML)))
+
+class DaemonRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.files = []
+        for file_name in ["a.xml", "b.json"]:
+            self.files.append(os.path.join(self.work_dir.name, file_name))
+            with open(self.files[-1], "w") as f:
+                f.write("{}" if file_name.endswith(".json") else "<Patient xmlns='http://hl7.org/fhir'/>")
+        self.out_path = os.path.join(self.work_dir.name, "out.xml")
+        self.requests = []
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    async def handle(self, request):
+        self.requests.append((request.query.get("profiles"), request.content_type))
+        if self.status != 200:
+            return web.Response(status = self.status)
+        if request.content_type == "application/fhir+json":
+            return web.json_response(OUTCOME_JSON)
+        return web.Response(body = OUTCOME_XML, content_type = "application/fhir+xml")
+
+    def validate(self, status = 200):
+        self.status = status
+        async def run():
+            app = web.Application()
+            app.router.add_post("/validateResource", self.handle)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            try:
+                daemon = entrypoint.ValidatorDaemon([], entrypoint.ResourceGovernor())
+                daemon.port = site._server.sockets[0].getsockname()[1]
+                return await daemon._validate(self.files, "http://example.org/profile", self.out_path)
+            finally:
+                await runner.cleanup()
+        return asyncio.run(run())
+
+    def test_outcomesAreWrittenPerFile(self):
+        self.assertTrue(self.validate())
+        self.assertEqual(self.requests, [("http://example.org/profile", "application/fhir+xml"), ("http://example.org/profile", "application/fhir+json")])
+        outcomes = entrypoint.OutcomeBundle.read(self.out_path)
+        self.assertEqual([entrypoint.OutcomeBundle.getFile(outcome) for outcome in outcomes], self.files)
+
+    def test_errorResponseFails(self):
+        self.assertFalse(self.validate(500))
+        self.assertFalse(os.path.exists(self.out_path))
+
+class FakeDaemon:
+    def __init__(self, engine_args, result = True):
+        self.engine_args = engine_args
+        self.result      = result
+        self.files       = None
+        self.stopped     = False
+
+    def isAlive(self):
+        return not self.stopped
+
+    async def validate(self, files, profile, out_path):
+        self.files = files
+        if self.result:
+            entrypoint.OutcomeBundle.write(out_path, [])
+        return self.result
+
+    async def stop(self):
+        self.stopped = True
+
+class DaemonManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir      = tempfile.TemporaryDirectory()
+        self.validator_jar = entrypoint.VALIDATOR_JAR
+        entrypoint.VALIDATOR_JAR = os.path.join(self.work_dir.name, "validator.jar")
+        self.makeJar(True)
+        self.started = []
+        self.manager = entrypoint.DaemonManager(entrypoint.ResourceGovernor())
+
+    def tearDown(self):
+        entrypoint.VALIDATOR_JAR = self.validator_jar
+        self.work_dir.cleanup()
+
+    def makeJar(self, with_server):
+        with zipfile.ZipFile(entrypoint.VALIDATOR_JAR, "w") as jar:
+            jar.writestr("org/hl7/fhir/validation/ValidatorCli.class", b"")
+            if with_server:
+                jar.writestr(entrypoint.ValidatorDaemon.SERVER_CLASS, b"")
+
+    def acquire(self, engine_args, starts = True):
+        async def start(daemon):
+            self.started.append(daemon)
+            return starts
+        async def stop(daemon):
+            pass
+        with unittest.mock.patch.object(entrypoint.ValidatorDaemon, "start", start), unittest.mock.patch.object(entrypoint.ValidatorDaemon, "stop", stop), unittest.mock.patch.object(entrypoint.ValidatorDaemon, "isAlive", lambda daemon: True):
+            return asyncio.run(self.manager.acquire(engine_args, CollectingPrinter()))
+
+    def test_notUsedWithoutServerMode(self):
+        self.makeJar(False)
+        self.assertEqual(self.acquire(["-ig", "a"]), None)
+        self.assertEqual(self.started, [])
+
+    def test_daemonIsShared(self):
+        daemon = self.acquire(["-ig", "a"])
+        self.assertNotEqual(daemon, None)
+        asyncio.run(self.manager.release(daemon))
+        self.assertIs(self.acquire(["-ig", "a"]), daemon)
+        self.assertEqual(len(self.started), 1)
+
+    def test_notRestartedWhileInUse(self):
+        daemon = self.acquire(["-ig", "a"])
+        self.assertEqual(self.acquire(["-ig", "b"]), None)
+        asyncio.run(self.manager.release(daemon))
+        self.assertEqual(self.acquire(["-ig", "b"]).engine_args, ["-ig", "b"])
+
+    def test_givesUpAfterFailures(self):
+        for _ in range(entrypoint.DaemonManager.MAX_FAILURES):
+            self.assertEqual(self.acquire(["-ig", "a"], starts = False), None)
+        self.assertEqual(self.acquire(["-ig", "a"]), None)
+        self.assertEqual(len(self.started), entrypoint.DaemonManager.MAX_FAILURES)
+
+class ExecutorDaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.start_dir = os.getcwd()
+        self.work_dir  = tempfile.TemporaryDirectory()
+        os.environ["GIT_CONFIG_GLOBAL"] = os.path.join(self.work_dir.name, "gitconfig") # FileCollection adds to the git config
+        os.chdir(self.work_dir.name)
+        os.makedirs("resources/sub")
+        for file_path in ["resources/a.xml", "resources/sub/b.json", "resources/sub/notes.txt"]:
+            with open(file_path, "w") as f:
+                f.write("")
+
+        config = {"patterns": {"all": "resources/**"}, "steps": {}}
+        file_collection = entrypoint.FileCollection(config, entrypoint.FileCollection.Mode.ALL)
+        self.executor = entrypoint.StepExecutor(config, file_collection, CollectingPrinter(), "error", "information")
+        self.executor.daemons = unittest.mock.AsyncMock()
+        self.cli_runs = []
+        async def runValidatorCLI(profile, files, engine_args, out_path, printer, shards = None, base_heap = None):
+            self.cli_runs.append(files)
+            return True
+        self.executor._runValidatorCLI = runValidatorCLI
+
+    def tearDown(self):
+        os.chdir(self.start_dir)
+        self.work_dir.cleanup()
+        del os.environ["GIT_CONFIG_GLOBAL"]
+
+    def validate(self, daemon):
+        self.executor.daemons.acquire.return_value = daemon
+        return asyncio.run(self.executor._validate(None, ["resources/sub", "resources/a.xml"], [], "out.xml", CollectingPrinter()))
+
+    def test_directoriesAreExpanded(self):
+        daemon = FakeDaemon([])
+        self.assertTrue(self.validate(daemon))
+        self.assertEqual(daemon.files, ["resources/sub/b.json", "resources/a.xml"])
+        self.executor.daemons.release.assert_awaited_once_with(daemon)
+        self.assertEqual(self.cli_runs, [])
+
+    def test_fallbackToCLIWhenDaemonFails(self):
+        daemon = FakeDaemon([], result = False)
+        self.assertTrue(self.validate(daemon))
+        self.executor.daemons.fail.assert_awaited_once_with(daemon)
+        self.assertEqual(self.cli_runs, [["resources/sub", "resources/a.xml"]])
+
+    def test_fallbackToCLIWithoutDaemon(self):
+        self.assertTrue(self.validate(None))
+        self.assertEqual(self.cli_runs, [["resources/sub", "resources/a.xml"]])
+
+if __name__ == "__main__":
+    unittest.main()